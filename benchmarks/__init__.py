@@ -0,0 +1,2 @@
+"""Performance benchmarks, run as modules from the project root
+(e.g. `python -m benchmarks.bench_chunking`)."""
@@ -0,0 +1,103 @@
+"""Benchmarks the token-aware chunking engine against langchain's splitter.
+
+Usage:
+    python -m benchmarks.bench_chunking --pages 500
+"""
+import argparse
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from knowledge_gpt.core.chunking import TokenChunker, get_encoding
+from knowledge_gpt.core.parsing import strip_consecutive_newlines
+
+RESOURCE_ROOT = Path(__file__).parent.parent.resolve() / "resources"
+
+
+# Page layouts to benchmark: text broken into lines like most parsed PDFs, and
+# flowing text without line breaks, where the splitter has to fall back to words
+LAYOUTS = ["lines", "flowing"]
+
+
+def make_pages(num_pages: int, page_chars: int, layout: str = "lines") -> List[str]:
+    """Cuts a long sample text into pages, repeating it as often as needed.
+    Newlines are collapsed the same way the parsers do it.
+    """
+    text = (RESOURCE_ROOT / "paul_graham_essay.txt").read_text()
+    text = strip_consecutive_newlines(text)
+    if layout == "flowing":
+        text = text.replace("\n", " ")
+    text = text * (num_pages * page_chars // len(text) + 1)
+    return [
+        text[i * page_chars : (i + 1) * page_chars]  # noqa: E203
+        for i in range(num_pages)
+    ]
+
+
+def splitter_chunks(
+    pages: List[str], chunk_size: int, chunk_overlap: int, model_name: str
+) -> List[str]:
+    """The previous implementation: one langchain splitter per page"""
+    chunks = []
+    for page in pages:
+        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            model_name=model_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        chunks.extend(text_splitter.split_text(page))
+    return chunks
+
+
+def chunker_chunks(
+    pages: List[str], chunk_size: int, chunk_overlap: int, model_name: str
+) -> List[str]:
+    chunker = TokenChunker(chunk_size, chunk_overlap, model_name=model_name)
+    return [chunk for chunks in chunker.split_texts(pages) for chunk in chunks]
+
+
+def timed(func: Callable[[], List[str]], repeat: int) -> tuple[float, List[str]]:
+    """Returns the best wall time out of `repeat` runs and the chunks"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = func()
+        best = min(best, time.perf_counter() - start)
+    return best, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--page-chars", type=int, default=3000)
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS)
+    args = parser.parse_args()
+
+    params = (args.chunk_size, args.chunk_overlap, args.model)
+    encoding = get_encoding(args.model)
+
+    for layout in args.layouts:
+        pages = make_pages(args.pages, args.page_chars, layout)
+        print(f"{layout}: {args.pages} pages, {sum(map(len, pages)):,} characters")
+
+        results = {}
+        for name, func in [("splitter", splitter_chunks), ("chunker", chunker_chunks)]:
+            seconds, chunks = timed(lambda: func(pages, *params), args.repeat)
+            results[name] = seconds
+            max_tokens = max(len(encoding.encode_ordinary(chunk)) for chunk in chunks)
+            print(
+                f"{name:>10}: {seconds:8.3f}s  {args.pages / seconds:10.1f} pages/s"
+                f"  {len(chunks):6d} chunks  max {max_tokens} tokens/chunk"
+            )
+
+        print(f"   speedup: {results['splitter'] / results['chunker']:.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
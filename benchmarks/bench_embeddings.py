@@ -0,0 +1,81 @@
+"""Benchmarks the throughput of the local CPU embedding model in chunks/s.
+
+The chunks are cut from the sample essay the same way files are chunked, then
+embedded with each combination of thread count and batch size.
+
+Usage:
+    python -m benchmarks.bench_embeddings --chunks 2000 --threads 1 4
+"""
+import argparse
+import os
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks.bench_chunking import make_pages
+from knowledge_gpt.core.chunking import TokenChunker
+from knowledge_gpt.core.local_embeddings import (
+    DEFAULT_LOCAL_BATCH_SIZE,
+    DEFAULT_LOCAL_MODEL,
+    DEFAULT_ONNX_FILE,
+    LocalEmbeddings,
+)
+
+
+def make_chunks(num_chunks: int, chunk_size: int) -> List[str]:
+    """Chunks enough pages of the sample text to get `num_chunks` chunks"""
+    chunker = TokenChunker(chunk_size, 0)
+    pages = make_pages(num_chunks // 4 + 1, 3000)
+    chunks = [chunk for page in chunker.split_texts(pages) for chunk in page]
+    return (chunks * (num_chunks // len(chunks) + 1))[:num_chunks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument("--model", default=DEFAULT_LOCAL_MODEL)
+    parser.add_argument("--onnx-file", default=DEFAULT_ONNX_FILE)
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1]
+    )
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, DEFAULT_LOCAL_BATCH_SIZE]
+    )
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.chunk_size)
+    print(f"{len(chunks)} chunks of up to {args.chunk_size} tokens, {args.model}\n")
+
+    reference = None
+    for num_threads in args.threads:
+        for batch_size in args.batch_sizes:
+            embeddings = LocalEmbeddings(
+                model=args.model,
+                onnx_file=args.onnx_file,
+                num_threads=num_threads,
+                max_batch_size=batch_size,
+            )
+            embeddings.embed_array(chunks[:batch_size])  # warm up
+
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                vectors = embeddings.embed_array(chunks)
+                best = min(best, time.perf_counter() - start)
+
+            # Batching must not change the vectors, only the time it takes
+            if reference is None:
+                reference = vectors
+            error = float(np.abs(vectors - reference).max())
+            print(
+                f"threads={num_threads:<3d} batch={batch_size:<4d}"
+                f"  {best:8.3f}s  {len(chunks) / best:9.1f} chunks/s"
+                f"  max diff {error:.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
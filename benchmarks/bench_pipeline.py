@@ -0,0 +1,257 @@
+"""Benchmarks the parse, chunk, embed and query stages on synthetic files.
+
+Every file is processed in a fresh process, so the peak RSS reported for a
+stage is the peak of that file's pipeline up to and including the stage.
+Embeddings and answers come from the debug models, so only the code of the
+app is measured.
+
+Usage:
+    python -m benchmarks.bench_pipeline --save baseline
+    # ...change something...
+    python -m benchmarks.bench_pipeline --compare baseline
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+from xml.sax.saxutils import escape
+
+import fitz
+
+from benchmarks.bench_chunking import make_pages
+from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.embedding import embed_files
+from knowledge_gpt.core.parsing import read_file
+from knowledge_gpt.core.qa import query_folder
+from knowledge_gpt.core.utils import get_llm
+
+BASELINE_DIR = Path(__file__).parent.resolve() / "baselines"
+
+FILE_TYPES = ["pdf", "docx", "txt"]
+
+QUERIES = [
+    "What did the author work on before college?",
+    "Why did the author switch from philosophy to AI?",
+    "What was Viaweb and how was it sold?",
+    "What is Y Combinator?",
+    "What did the author learn from painting?",
+]
+
+
+def make_pdf(pages: List[str]) -> bytes:
+    pdf = fitz.open()  # type: ignore
+    for text in pages:
+        page = pdf.new_page()
+        page.insert_textbox(page.rect + (36, 36, -36, -36), text, fontsize=8)
+    data = pdf.tobytes()
+    pdf.close()
+    return data
+
+
+def make_docx(pages: List[str]) -> bytes:
+    """Writes the smallest document docx2txt can read: one paragraph per line"""
+    paragraphs = "".join(
+        f"<w:p><w:r><w:t>{escape(line)}</w:t></w:r></w:p>"
+        for page in pages
+        for line in page.splitlines()
+    )
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+        f'wordprocessingml/2006/main"><w:body>{paragraphs}</w:body></w:document>'
+    )
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("word/document.xml", document)
+    return buffer.getvalue()
+
+
+def make_file(file_type: str, num_pages: int, page_chars: int) -> BytesIO:
+    """Generates a file of the given type from a sample text"""
+    pages = make_pages(num_pages, page_chars)
+    if file_type == "pdf":
+        data = make_pdf(pages)
+    elif file_type == "docx":
+        data = make_docx(pages)
+    elif file_type == "txt":
+        data = "\n\n".join(pages).encode("utf-8")
+    else:
+        raise NotImplementedError(f"File type {file_type} not supported")
+
+    file = BytesIO(data)
+    file.name = f"synthetic_{num_pages}.{file_type}"
+    return file
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def timed(func: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    """Returns the best wall time out of `repeat` runs and the last result"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def warm_up(args: argparse.Namespace) -> None:
+    """Runs every stage once on a small file, so that one-time setup like
+    loading the tokenizer is not part of the measurements"""
+    file = make_file("txt", 1, args.page_chars)
+    chunked = chunk_file(read_file(file), args.chunk_size, args.chunk_overlap)
+    folder_index = embed_files([chunked], "debug", args.vector_store)
+    query_folder(QUERIES[0], folder_index, get_llm("debug"), retrieval=args.retrieval)
+
+
+def run_pipeline(
+    file_type: str, num_pages: int, args: argparse.Namespace
+) -> Dict[str, Dict[str, Any]]:
+    """Runs every stage on one synthetic file and returns the measurements
+    of each stage"""
+    warm_up(args)
+    file = make_file(file_type, num_pages, args.page_chars)
+    results: Dict[str, Dict[str, Any]] = {}
+
+    def record(stage: str, seconds: float, count: int, unit: str) -> None:
+        results[stage] = {
+            "seconds": seconds,
+            "throughput": count / seconds,
+            "unit": unit,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    seconds, parsed = timed(
+        lambda: read_file(file, num_workers=args.workers), args.repeat
+    )
+    record("parse", seconds, num_pages, "pages/s")
+
+    seconds, chunked = timed(
+        lambda: chunk_file(parsed, args.chunk_size, args.chunk_overlap), args.repeat
+    )
+    record("chunk", seconds, len(chunked.docs), "chunks/s")
+
+    seconds, folder_index = timed(
+        lambda: embed_files([chunked], "debug", args.vector_store), args.repeat
+    )
+    record("embed", seconds, len(chunked.docs), "chunks/s")
+
+    queries = [QUERIES[i % len(QUERIES)] for i in range(args.queries)]
+
+    def query_all() -> None:
+        for query in queries:
+            # The debug model answers once, so every query gets its own
+            query_folder(
+                query, folder_index, get_llm("debug"), retrieval=args.retrieval
+            )
+
+    seconds, _ = timed(query_all, args.repeat)
+    record("query", seconds, len(queries), "queries/s")
+
+    return results
+
+
+def run_all(args: argparse.Namespace) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for file_type in args.types:
+        for num_pages in args.pages:
+            # A fresh process per file so that peak RSS is not carried over
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                case = f"{file_type}-{num_pages}p"
+                results[case] = executor.submit(
+                    run_pipeline, file_type, num_pages, args
+                ).result()
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, Dict[str, Any]]],
+    baseline: Dict[str, Dict[str, Dict[str, Any]]],
+    max_slowdown: float,
+) -> List[str]:
+    """Prints the change of every stage against the baseline and returns the
+    stages that got slower than `max_slowdown` times the baseline"""
+    regressions = []
+    print(f"{'case':>12}  {'stage':<6} {'time':>8}  {'peak RSS':>8}")
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            if stage not in baseline.get(case, {}):
+                continue
+            before = baseline[case][stage]
+            time_ratio = result["seconds"] / before["seconds"]
+            rss_ratio = result["peak_rss_mb"] / before["peak_rss_mb"]
+            flag = ""
+            if time_ratio > max_slowdown:
+                regressions.append(f"{case} {stage}")
+                flag = "  REGRESSION"
+            print(f"{case:>12}  {stage:<6} {time_ratio:7.2f}x  {rss_ratio:7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--types", nargs="+", choices=FILE_TYPES, default=FILE_TYPES)
+    parser.add_argument("--pages", nargs="+", type=int, default=[10, 100, 500])
+    parser.add_argument("--page-chars", type=int, default=3000)
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument("--vector-store", default="faiss")
+    parser.add_argument("--retrieval", default="vector")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="NAME", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare with a baseline")
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.2,
+        help="time ratio to the baseline above which a stage counts as a regression",
+    )
+    args = parser.parse_args()
+
+    results = run_all(args)
+
+    print(
+        f"{'case':>12}  {'stage':<6} {'seconds':>9}  {'throughput':>20}"
+        f"  {'peak RSS':>10}"
+    )
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            throughput = f"{result['throughput']:.1f} {result['unit']}"
+            print(
+                f"{case:>12}  {stage:<6} {result['seconds']:9.4f}  {throughput:>20}"
+                f"  {result['peak_rss_mb']:7.1f} MB"
+            )
+    print()
+
+    if args.save:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / f"{args.save}.json"
+        path.write_text(json.dumps(results, indent=2))
+        print(f"Saved baseline to {path}")
+
+    if args.compare:
+        path = BASELINE_DIR / f"{args.compare}.json"
+        regressions = compare(results, json.loads(path.read_text()), args.max_slowdown)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than {args.max_slowdown}x:")
+            print("\n".join(f"  {regression}" for regression in regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
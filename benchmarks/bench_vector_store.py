@@ -0,0 +1,186 @@
+"""Reports recall and latency of the approximate FAISS index types against the
+exact (flat) index.
+
+With --precisions, also reports the memory saved and the recall lost by
+compressing the vectors of a flat index, with and without rescoring the
+candidates with the full precision vectors.
+
+Usage:
+    python -m benchmarks.bench_vector_store --vectors 200000 --dim 1536
+    python -m benchmarks.bench_vector_store --types --precisions float16 int8 \
+        --reduced-dims 256
+"""
+import argparse
+import time
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+
+from knowledge_gpt.core.vector_store import (
+    DEFAULT_RESCORE_FACTOR,
+    PRECISIONS,
+    ChunkFAISS,
+    build_index,
+)
+
+# Search settings to report for each index type
+SEARCH_PARAMS = {
+    "flat": [{}],
+    "ivf_flat": [{"nprobe": nprobe} for nprobe in [1, 4, 16, 64]],
+    "hnsw": [{"ef_search": ef_search} for ef_search in [16, 32, 64, 128]],
+    "ivf_pq": [{"nprobe": nprobe} for nprobe in [4, 16, 64]],
+}
+
+
+def make_vectors(
+    num_vectors: int, num_queries: int, dim: int, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Makes clustered, normalized vectors (embeddings of a corpus are far from
+    uniform) and queries drawn from the same clusters"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(num_vectors // 500, 1), dim))
+
+    def sample(n: int) -> np.ndarray:
+        points = centers[rng.integers(len(centers), size=n)]
+        points = points + rng.normal(scale=0.5, size=(n, dim))
+        points /= np.linalg.norm(points, axis=1, keepdims=True)
+        return points.astype(np.float32)
+
+    return sample(num_vectors), sample(num_queries)
+
+
+def search(
+    vector_store: ChunkFAISS, queries: np.ndarray, k: int
+) -> Tuple[float, np.ndarray]:
+    """Returns the mean latency of single-query searches and the found ids"""
+    found = np.empty((len(queries), k), dtype=np.int64)
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        _, ids = vector_store.index.search(query[None, :], k)
+        found[i] = ids[0]
+    return (time.perf_counter() - start) / len(queries), found
+
+
+def search_rescored(
+    vector_store: ChunkFAISS, queries: np.ndarray, k: int
+) -> Tuple[float, np.ndarray]:
+    """Like `search`, through the vector store so that candidates are
+    rescored"""
+    found = np.empty((len(queries), k), dtype=np.int64)
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        found[i] = [row for row, _ in vector_store.search_rows(query, k)]
+    return (time.perf_counter() - start) / len(queries), found
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    """Fraction of the true k nearest neighbours that were found"""
+    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument(
+        "--types", nargs="*", choices=list(SEARCH_PARAMS), default=list(SEARCH_PARAMS)
+    )
+    parser.add_argument("--precisions", nargs="*", choices=PRECISIONS, default=[])
+    parser.add_argument(
+        "--reduced-dims",
+        type=int,
+        nargs="*",
+        default=[],
+        help="also compress the vectors to these dimensions with PCA",
+    )
+    parser.add_argument("--rescore-factor", type=int, default=DEFAULT_RESCORE_FACTOR)
+    args = parser.parse_args()
+
+    vectors, queries = make_vectors(args.vectors, args.queries, args.dim)
+    ids = np.arange(len(vectors), dtype=np.int64)
+    print(f"{args.vectors:,} vectors of {args.dim} dims, {args.queries} queries\n")
+
+    truth_index = build_index("flat", vectors, ids)
+    _, truth = truth_index.search(queries, args.k)
+
+    rows: List[Tuple[str, str, float, float, float, float]] = []
+    for index_type in args.types:
+        start = time.perf_counter()
+        index = build_index(index_type, vectors, ids)
+        build_seconds = time.perf_counter() - start
+        size_mb = len(faiss.serialize_index(index)) / 2**20
+
+        vector_store = ChunkFAISS(embedding=None, index=index)  # type: ignore
+        for params in SEARCH_PARAMS[index_type]:
+            vector_store.set_search_params(**params)
+            latency, found = search(vector_store, queries, args.k)
+            setting = ", ".join(f"{name}={value}" for name, value in params.items())
+            rows.append(
+                (
+                    index_type,
+                    setting,
+                    recall(found, truth),
+                    latency * 1000,
+                    build_seconds,
+                    size_mb,
+                )
+            )
+
+    if rows:
+        print(
+            f"{'index':>8}  {'setting':<14} {f'recall@{args.k}':>9}"
+            f"  {'ms/query':>8}  {'build s':>7}  {'size MB':>8}"
+        )
+    for index_type, setting, rec, ms, build_seconds, size_mb in rows:
+        print(
+            f"{index_type:>8}  {setting:<14} {rec:9.3f}  {ms:8.3f}"
+            f"  {build_seconds:7.1f}  {size_mb:8.1f}"
+        )
+
+    if args.precisions:
+        compare_precisions(args, vectors, ids, queries, truth)
+
+
+def compare_precisions(
+    args: argparse.Namespace,
+    vectors: np.ndarray,
+    ids: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+) -> None:
+    """Prints the size and recall of flat indexes of compressed vectors. The
+    size is that of the index, the full precision vectors used for rescoring
+    are memory-mapped from disk."""
+    full_size = len(faiss.serialize_index(build_index("flat", vectors, ids)))
+    print(
+        f"\n{'precision':>9}  {'dim':>5}  {'rescore':<7} {f'recall@{args.k}':>9}"
+        f"  {'ms/query':>8}  {'size MB':>8}  {'saved':>6}"
+    )
+    for precision in args.precisions:
+        for dim in [None] + args.reduced_dims:
+            index = build_index("flat", vectors, ids, precision=precision, dim=dim)
+            size = len(faiss.serialize_index(index))
+            for rescore_factor in [0, args.rescore_factor]:
+                vector_store = ChunkFAISS(
+                    embedding=None,  # type: ignore
+                    index=index,
+                    precision=precision,
+                    dim=dim,
+                    rescore_factor=rescore_factor,
+                    vectors=vectors,
+                )
+                latency, found = search_rescored(vector_store, queries, args.k)
+                print(
+                    f"{precision:>9}  {dim or args.dim:5d}"
+                    f"  {'x' + str(rescore_factor) if rescore_factor else 'no':<7}"
+                    f" {recall(found, truth):9.3f}  {latency * 1000:8.3f}"
+                    f"  {size / 2**20:8.1f}  {1 - size / full_size:6.1%}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,601 @@
+"""Headless HTTP API to ingest files into folders and ask questions about them.
+
+Usage:
+    python -m knowledge_gpt.api --port 8000
+
+Endpoints:
+    GET    /folders                            List the folders
+    POST   /folders                            Create a folder: {"name": ...}
+    GET    /folders/{folder_id}                Describe a folder and its files
+    DELETE /folders/{folder_id}                Delete a folder
+    POST   /folders/{folder_id}/files          Upload a file (multipart field
+                                               "file", or the raw bytes with
+                                               ?name=<file name>)
+    DELETE /folders/{folder_id}/files/{id}     Remove a file from a folder
+    POST   /folders/{folder_id}/query          Ask a question: {"query": ...,
+                                               "model", "return_all", "retrieval",
+                                               "chain_type", "max_context_tokens"}
+    POST   /folders/{folder_id}/query_batch    Ask several questions:
+                                               {"queries": [...], "concurrency",
+                                               and the options of /query}
+    GET    /metrics                            Prometheus metrics
+    GET    /health                             Liveness check
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from io import BytesIO
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, TypeVar
+
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.answer_cache import AnswerCache, get_answer_cache
+from knowledge_gpt.core.chunk_store import as_document
+from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.embedding import (
+    DEFAULT_RETRIEVAL,
+    FOLDER_FILE,
+    FolderIndex,
+    get_embeddings,
+    get_vector_store,
+)
+from knowledge_gpt.core.ingestion import save_folder_index
+from knowledge_gpt.core.instrumentation import Trace, get_metrics, timed
+from knowledge_gpt.core.parsing import File, read_file
+from knowledge_gpt.core.qa import (
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_CONTEXT_TOKENS,
+    AnswerWithSources,
+    query_folder,
+    query_folder_batch,
+)
+from knowledge_gpt.core.utils import get_llm
+from knowledge_gpt.core.vector_store import ChunkFAISS
+
+T = TypeVar("T")
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Largest accepted request body, the same as the upload limit of Streamlit
+MAX_UPLOAD_BYTES = 200 * 2**20
+
+# Limits of a batch query, so that one request can't hog the LLM API
+MAX_BATCH_QUERIES = 100
+MAX_BATCH_CONCURRENCY = 16
+
+
+class _ReadWriteLock:
+    """Lets any number of readers or a single writer hold the lock.
+    Waiting writers go first, so that a stream of queries doesn't starve
+    an upload."""
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._writing and not self._waiting_writers
+            )
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[None]:
+        async with self._condition:
+            self._waiting_writers += 1
+            await self._condition.wait_for(
+                lambda: not self._writing and not self._readers
+            )
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class Folder:
+    """A folder of the API: a FolderIndex, created with the first file, and the
+    lock that lets queries run together but not while files change."""
+
+    def __init__(self, id: str, name: str, index: Optional[FolderIndex] = None):
+        self.id = id
+        self.name = name
+        self.index = index
+        self.lock = _ReadWriteLock()
+
+    @property
+    def files(self) -> List[File]:
+        return self.index.files if self.index is not None else []
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "files": [_file_to_dict(file) for file in self.files],
+        }
+
+
+def _file_to_dict(file: File) -> Dict[str, Any]:
+    return {"id": file.id, "name": file.name, "chunks": len(file.docs)}
+
+
+class FolderRegistry:
+    """Folders shared by all the clients of the API, embedded with one model.
+
+    If `index_dir` is given, every folder is saved in a directory of its own
+    when its files change, and the saved folders are loaded (memory-mapped)
+    when the registry is created. Folders without files are not saved.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        vector_store: str,
+        chunk_size: int = 300,
+        chunk_overlap: int = 0,
+        index_dir: Optional[str] = None,
+    ):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.index_dir = index_dir
+        self.folders: Dict[str, Folder] = {}
+
+        if index_dir is not None and os.path.isdir(index_dir):
+            for folder_id in sorted(os.listdir(index_dir)):
+                path = os.path.join(index_dir, folder_id)
+                if os.path.exists(os.path.join(path, FOLDER_FILE)):
+                    index = FolderIndex.load(path, embeddings=embeddings)
+                    # Built now rather than by concurrent queries
+                    index.build_lexical_index()
+                    self.folders[folder_id] = Folder(folder_id, index.name, index)
+
+    def create(self, name: str) -> Folder:
+        folder = Folder(uuid.uuid4().hex, name)
+        self.folders[folder.id] = folder
+        return folder
+
+    def delete(self, folder: Folder) -> None:
+        del self.folders[folder.id]
+        if self.index_dir is not None:
+            shutil.rmtree(os.path.join(self.index_dir, folder.id), ignore_errors=True)
+
+    def parse(self, data: bytes, file_name: str) -> File:
+        """Reads and chunks an uploaded file"""
+        file = BytesIO(data)
+        file.name = file_name
+        return chunk_file(
+            read_file(file), self.chunk_size, self.chunk_overlap, deduplicate=True
+        )
+
+    def add_file(self, folder: Folder, file: File) -> File:
+        """Embeds a chunked file into a folder. A file that is already in the
+        folder is not embedded again. Returns the file as it is indexed."""
+        for indexed in folder.files:
+            if indexed.id == file.id:
+                return indexed
+
+        with timed("embed"):
+            if folder.index is None:
+                index = FolderIndex.from_files(
+                    files=[file],
+                    embeddings=self.embeddings,
+                    vector_store=get_vector_store(self.vector_store),
+                )
+                index.name = folder.name
+                folder.index = index
+                added = index.files[0]
+            else:
+                added = folder.index.add_files([file])[0]
+        self.save(folder)
+        return added
+
+    def remove_file(self, folder: Folder, file_id: str) -> bool:
+        """Removes a file from a folder. Returns whether it was in the folder."""
+        if folder.index is None or not folder.index.remove_files([file_id]):
+            return False
+        self.save(folder)
+        return True
+
+    def save(self, folder: Folder) -> None:
+        """Saves a folder if the registry has an index directory"""
+        index = folder.index
+        if self.index_dir is None or index is None:
+            return
+        if not isinstance(index.index, ChunkFAISS):
+            return
+
+        save_folder_index(index, os.path.join(self.index_dir, folder.id))
+
+
+class ApiHandlers:
+    """Request handlers of the API. Parsing, embedding and answering block, so
+    they run on a thread pool and the event loop keeps serving other requests
+    in the meantime."""
+
+    def __init__(
+        self,
+        registry: FolderRegistry,
+        executor: ThreadPoolExecutor,
+        llm_kwargs: Optional[Dict[str, Any]] = None,
+        answer_cache: Optional[AnswerCache] = None,
+    ):
+        self.registry = registry
+        self.executor = executor
+        self.llm_kwargs = llm_kwargs or {}
+        self.answer_cache = answer_cache
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get("/health", self.health),
+            web.get("/metrics", self.metrics),
+            web.get("/folders", self.list_folders),
+            web.post("/folders", self.create_folder),
+            web.get("/folders/{folder_id}", self.get_folder),
+            web.delete("/folders/{folder_id}", self.delete_folder),
+            web.post("/folders/{folder_id}/files", self.add_file),
+            web.delete("/folders/{folder_id}/files/{file_id}", self.remove_file),
+            web.post("/folders/{folder_id}/query", self.query),
+            web.post("/folders/{folder_id}/query_batch", self.query_batch),
+        ]
+
+    async def _run(
+        self, func: Callable[..., T], *args: Any, operation: Optional[Trace] = None
+    ) -> T:
+        """Runs a blocking function on the thread pool, recording into
+        `operation` if given"""
+
+        def run() -> T:
+            if operation is None:
+                return func(*args)
+            with operation.activate():
+                return func(*args)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run)
+
+    def _get_folder(self, request: web.Request) -> Folder:
+        folder_id = request.match_info["folder_id"]
+        if folder_id not in self.registry.folders:
+            raise _error(web.HTTPNotFound, f"Folder {folder_id} not found")
+        return self.registry.folders[folder_id]
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=get_metrics().to_prometheus(),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    async def list_folders(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [folder.to_dict() for folder in self.registry.folders.values()]
+        )
+
+    async def create_folder(self, request: web.Request) -> web.Response:
+        body = await _json_body(request)
+        folder = self.registry.create(str(body.get("name", "default")))
+        return web.json_response(folder.to_dict(), status=201)
+
+    async def get_folder(self, request: web.Request) -> web.Response:
+        return web.json_response(self._get_folder(request).to_dict())
+
+    async def delete_folder(self, request: web.Request) -> web.Response:
+        folder = self._get_folder(request)
+        async with folder.lock.write():
+            await self._run(self.registry.delete, folder)
+        return web.Response(status=204)
+
+    async def add_file(self, request: web.Request) -> web.Response:
+        folder = self._get_folder(request)
+        data, file_name = await _read_upload(request)
+
+        operation = Trace("ingest")
+        try:
+            # Reading and chunking don't touch the folder, only embedding
+            # waits for the queries on the folder to finish
+            try:
+                parsed = await self._run(
+                    self.registry.parse, data, file_name, operation=operation
+                )
+            except NotImplementedError as e:
+                raise _error(web.HTTPUnsupportedMediaType, str(e))
+            if not any(doc.page_content.strip() for doc in parsed.docs):
+                raise _error(
+                    web.HTTPUnprocessableEntity,
+                    f"No text could be read from {file_name}",
+                )
+
+            async with folder.lock.write():
+                if folder.id not in self.registry.folders:
+                    raise _error(web.HTTPNotFound, f"Folder {folder.id} not found")
+                added = await self._run(
+                    self.registry.add_file, folder, parsed, operation=operation
+                )
+        finally:
+            operation.finish()
+
+        return web.json_response(
+            {"file": _file_to_dict(added), "timings": operation.stages}, status=201
+        )
+
+    async def remove_file(self, request: web.Request) -> web.Response:
+        folder = self._get_folder(request)
+        file_id = request.match_info["file_id"]
+        async with folder.lock.write():
+            removed = await self._run(self.registry.remove_file, folder, file_id)
+        if not removed:
+            raise _error(web.HTTPNotFound, f"File {file_id} not found")
+        return web.Response(status=204)
+
+    async def query(self, request: web.Request) -> web.Response:
+        folder = self._get_folder(request)
+        body = await _json_body(request)
+        query = body.get("query")
+        if not isinstance(query, str) or not query.strip():
+            raise _error(web.HTTPBadRequest, "Please enter a question")
+        max_context_tokens = _max_context_tokens(body)
+
+        try:
+            llm = get_llm(body.get("model", DEFAULT_MODEL), **self.llm_kwargs)
+        except NotImplementedError as e:
+            raise _error(web.HTTPBadRequest, str(e))
+
+        async with folder.lock.read():
+            if folder.index is None:
+                raise _error(web.HTTPConflict, f"Folder {folder.id} has no files")
+
+            operation = Trace("query")
+            try:
+                result = await self._run(
+                    partial(
+                        query_folder,
+                        query,
+                        folder.index,
+                        llm,
+                        return_all=bool(body.get("return_all", False)),
+                        answer_cache=self.answer_cache,
+                        retrieval=body.get("retrieval", DEFAULT_RETRIEVAL),
+                        chain_type=body.get("chain_type", "stuff"),
+                        max_context_tokens=max_context_tokens,
+                    ),
+                    operation=operation,
+                )
+            except NotImplementedError as e:
+                raise _error(web.HTTPBadRequest, str(e))
+            finally:
+                operation.finish()
+
+        return web.json_response(
+            {**_answer_to_dict(result), "timings": operation.stages}
+        )
+
+    async def query_batch(self, request: web.Request) -> web.Response:
+        folder = self._get_folder(request)
+        body = await _json_body(request)
+        queries = body.get("queries")
+        if (
+            not isinstance(queries, list)
+            or not queries
+            or not all(isinstance(query, str) and query.strip() for query in queries)
+        ):
+            raise _error(web.HTTPBadRequest, "Please enter a list of questions")
+        if len(queries) > MAX_BATCH_QUERIES:
+            raise _error(
+                web.HTTPBadRequest,
+                f"At most {MAX_BATCH_QUERIES} questions can be asked at once",
+            )
+        concurrency = body.get("concurrency", DEFAULT_MAX_CONCURRENCY)
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise _error(web.HTTPBadRequest, "concurrency must be a positive integer")
+        max_context_tokens = _max_context_tokens(body)
+
+        try:
+            llm = get_llm(body.get("model", DEFAULT_MODEL), **self.llm_kwargs)
+        except NotImplementedError as e:
+            raise _error(web.HTTPBadRequest, str(e))
+
+        async with folder.lock.read():
+            if folder.index is None:
+                raise _error(web.HTTPConflict, f"Folder {folder.id} has no files")
+
+            operation = Trace("query_batch")
+            try:
+                results = await self._run(
+                    partial(
+                        query_folder_batch,
+                        queries,
+                        folder.index,
+                        llm,
+                        return_all=bool(body.get("return_all", False)),
+                        answer_cache=self.answer_cache,
+                        retrieval=body.get("retrieval", DEFAULT_RETRIEVAL),
+                        chain_type=body.get("chain_type", "stuff"),
+                        max_context_tokens=max_context_tokens,
+                        max_concurrency=min(concurrency, MAX_BATCH_CONCURRENCY),
+                    ),
+                    operation=operation,
+                )
+            except NotImplementedError as e:
+                raise _error(web.HTTPBadRequest, str(e))
+            finally:
+                operation.finish()
+
+        return web.json_response(
+            {
+                "answers": [_answer_to_dict(result) for result in results],
+                "timings": operation.stages,
+            }
+        )
+
+
+def _answer_to_dict(result: AnswerWithSources) -> Dict[str, Any]:
+    return {
+        "answer": result.answer,
+        "sources": [
+            {"content": doc.page_content, "metadata": doc.metadata}
+            for doc in map(as_document, result.sources)
+        ],
+    }
+
+
+def _error(error_class: Callable[..., web.HTTPException], message: str) -> Any:
+    return error_class(
+        text=web.json_response({"error": message}).text,
+        content_type="application/json",
+    )
+
+
+async def _json_body(request: web.Request) -> Dict[str, Any]:
+    if not request.can_read_body:
+        return {}
+    try:
+        body = await request.json()
+    except ValueError:
+        raise _error(web.HTTPBadRequest, "The request body is not valid JSON")
+    if not isinstance(body, dict):
+        raise _error(web.HTTPBadRequest, "The request body must be a JSON object")
+    return body
+
+
+def _max_context_tokens(body: Dict[str, Any]) -> Optional[int]:
+    """Largest prompt of a query, null to fill the context window of the model"""
+    max_context_tokens = body.get("max_context_tokens", DEFAULT_MAX_CONTEXT_TOKENS)
+    if max_context_tokens is not None and (
+        not isinstance(max_context_tokens, int) or max_context_tokens < 1
+    ):
+        raise _error(
+            web.HTTPBadRequest, "max_context_tokens must be a positive integer"
+        )
+    return max_context_tokens
+
+
+async def _read_upload(request: web.Request) -> tuple[bytes, str]:
+    """Returns the bytes and name of an uploaded file"""
+    if request.content_type.startswith("multipart/"):
+        reader = await request.multipart()
+        async for part in reader:
+            if getattr(part, "name", None) == "file":
+                file_name = part.filename  # type: ignore
+                data = await part.read()  # type: ignore
+                if file_name:
+                    return bytes(data), file_name
+        raise _error(web.HTTPBadRequest, 'The upload needs a "file" with a file name')
+
+    file_name = request.query.get("name")
+    if not file_name:
+        raise _error(web.HTTPBadRequest, "The file name is missing: ?name=<name>")
+    return await request.read(), file_name
+
+
+def create_app(
+    registry: FolderRegistry,
+    max_workers: int = 16,
+    llm_kwargs: Optional[Dict[str, Any]] = None,
+    answer_cache: Optional[AnswerCache] = None,
+) -> web.Application:
+    """Creates the API application. Up to `max_workers` uploads and queries
+    are processed at once, the others wait for a free worker."""
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    handlers = ApiHandlers(registry, executor, llm_kwargs, answer_cache)
+
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    app.add_routes(handlers.routes())
+
+    async def shutdown_executor(app: web.Application) -> None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    app.on_cleanup.append(shutdown_executor)
+    return app
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--embedding", default="openai")
+    parser.add_argument(
+        "--embedding-threads",
+        type=int,
+        default=os.environ.get("EMBEDDING_THREADS"),
+        help="CPU threads used by the local embedding model",
+    )
+    parser.add_argument("--vector-store", default="faiss")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument(
+        "--index-dir",
+        default=os.environ.get("INDEX_DIR"),
+        help="directory the folders are saved in and loaded from",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("EMBEDDING_CACHE_DIR"),
+        help="directory chunk embeddings are cached in",
+    )
+    parser.add_argument(
+        "--answer-cache-threshold",
+        type=float,
+        default=os.environ.get("ANSWER_CACHE_THRESHOLD"),
+        help="reuse the answer to a question at least this similar",
+    )
+    args = parser.parse_args()
+
+    openai_api_key = os.environ.get("OPENAI_API_KEY")
+    embedding_kwargs = {}
+    if args.embedding == "openai":
+        embedding_kwargs["openai_api_key"] = openai_api_key
+    elif args.embedding == "local" and args.embedding_threads:
+        embedding_kwargs["num_threads"] = int(args.embedding_threads)
+
+    registry = FolderRegistry(
+        embeddings=get_embeddings(
+            args.embedding, cache_dir=args.cache_dir, **embedding_kwargs
+        ),
+        vector_store=args.vector_store,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        index_dir=args.index_dir,
+    )
+    app = create_app(
+        registry,
+        max_workers=args.workers,
+        llm_kwargs={"openai_api_key": openai_api_key, "temperature": 0},
+        answer_cache=(
+            get_answer_cache(args.answer_cache_threshold)
+            if args.answer_cache_threshold is not None
+            else None
+        ),
+    )
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+"""Indexes every document in a directory into one saved FolderIndex.
+
+Files are read and chunked by a pool of processes while their chunks are
+embedded in batches. Progress is checkpointed in the index directory, so an
+interrupted run picks up where the last checkpoint left off when it is
+started again with the same arguments. Each checkpoint only writes what was
+indexed since the previous one, the whole index is saved once at the end.
+
+Usage:
+    python -m knowledge_gpt.bulk_ingest ./documents ./indexes/documents
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, TextIO, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.chunk_store import ChunkStore
+from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.embedding import (
+    FOLDER_FILE,
+    FolderIndex,
+    get_embeddings,
+    get_vector_store,
+)
+from knowledge_gpt.core.ingestion import save_folder_index
+from knowledge_gpt.core.parsing import (
+    File,
+    get_file_class,
+    get_file_class_by_name,
+    read_file,
+)
+from knowledge_gpt.core.vector_store import ChunkFAISS
+
+# Files ingested so far, saved with the index at the end of a run
+MANIFEST_FILE = "manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+
+# Directory of the index directory that checkpoints are written to until the
+# whole index is saved. Each checkpoint holds the chunks and vectors of the
+# files indexed since the previous one, the files removed and their records.
+CHECKPOINTS_DIR = "checkpoints"
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_VECTORS_FILE = "vectors.npy"
+CHECKPOINT_FORMAT_VERSION = 1
+
+# Files are embedded once their chunks add up to this many
+DEFAULT_EMBED_BATCH_CHUNKS = 2048
+
+# Seconds between two progress reports
+REPORT_INTERVAL = 5.0
+
+
+@dataclass
+class FileRecord:
+    """What is known about a file of the directory after a run"""
+
+    size: int
+    mtime: float
+    file_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+def iter_documents(directory: str) -> Iterator[str]:
+    """Yields the paths, relative to `directory`, of the supported files in it
+    and its subdirectories, in a stable order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            try:
+                get_file_class(name)
+            except NotImplementedError:
+                continue
+            yield os.path.relpath(os.path.join(root, name), directory)
+
+
+def parse_document(
+    directory: str,
+    path: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    model_name: str,
+) -> File:
+    """Worker task: reads and chunks one file. The file is named by its path
+    relative to the directory."""
+    with open(os.path.join(directory, path), "rb") as f:
+        file = BytesIO(f.read())
+    file.name = path
+    return chunk_file(
+        read_file(file), chunk_size, chunk_overlap, model_name, deduplicate=True
+    )
+
+
+def load_manifest(index_path: str) -> Dict[str, FileRecord]:
+    """Returns the records of the files in the index saved at `index_path`,
+    including the files of the checkpoints written since it was saved"""
+    records: Dict[str, FileRecord] = {}
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest["version"] != MANIFEST_FORMAT_VERSION:
+            raise ValueError(f"Unsupported manifest version {manifest['version']}")
+        records.update(
+            (path, FileRecord(**record)) for path, record in manifest["files"].items()
+        )
+
+    for _, checkpoint in iter_checkpoints(index_path):
+        records.update(
+            (path, FileRecord(**record))
+            for path, record in checkpoint["records"].items()
+        )
+    return records
+
+
+def dump_manifest(records: Dict[str, FileRecord]) -> str:
+    return json.dumps(
+        {
+            "version": MANIFEST_FORMAT_VERSION,
+            "files": {path: asdict(record) for path, record in records.items()},
+        }
+    )
+
+
+def iter_checkpoints(index_path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yields the directories of the checkpoints written to an index directory
+    since the index was last saved, in order, with their descriptions"""
+    directory = os.path.join(index_path, CHECKPOINTS_DIR)
+    if not os.path.isdir(directory):
+        return
+    # Checkpoints being written have a temporary name that isn't a number
+    for name in sorted(name for name in os.listdir(directory) if name.isdigit()):
+        path = os.path.join(directory, name)
+        with open(os.path.join(path, CHECKPOINT_FILE)) as f:
+            checkpoint = json.load(f)
+        if checkpoint["version"] != CHECKPOINT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {checkpoint['version']}")
+        yield path, checkpoint
+
+
+def save_checkpoint(
+    index_path: str,
+    number: int,
+    files: List[File],
+    vectors: np.ndarray,
+    removed: List[str],
+    records: Dict[str, FileRecord],
+) -> None:
+    """Writes the files indexed since the previous checkpoint, with the
+    vectors of their chunks, the ids of the files removed from the index and
+    the records of the files processed.
+
+    The checkpoint is written next to the others and renamed once complete,
+    so that a crash never leaves a partially written checkpoint behind.
+    """
+    directory = os.path.join(index_path, CHECKPOINTS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=directory)
+
+    chunks = ChunkStore()
+    entries = []
+    for file in files:
+        rows = chunks.extend(file.docs, file_name=file.name, file_id=file.id).rows
+        entries.append(
+            {
+                "class": type(file).__name__,
+                "name": file.name,
+                "id": file.id,
+                "metadata": dict(file.metadata),
+                "start": rows.start,
+                "stop": rows.stop,
+            }
+        )
+    chunks.save(tmp_path)
+    np.save(os.path.join(tmp_path, CHECKPOINT_VECTORS_FILE), vectors)
+
+    checkpoint = {
+        "version": CHECKPOINT_FORMAT_VERSION,
+        "files": entries,
+        "removed": removed,
+        "records": {path: asdict(record) for path, record in records.items()},
+    }
+    with open(os.path.join(tmp_path, CHECKPOINT_FILE), "w") as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp_path, os.path.join(directory, f"{number:08d}"))
+
+
+def load_checkpoint(
+    path: str, checkpoint: Dict[str, Any]
+) -> Tuple[List[File], np.ndarray]:
+    """Returns the files of a checkpoint, with the vectors of their chunks"""
+    chunks = ChunkStore.load(path)
+    files = [
+        get_file_class_by_name(file["class"])(
+            name=file["name"],
+            id=file["id"],
+            metadata=file["metadata"],
+            docs=chunks[file["start"] : file["stop"]],  # noqa: E203
+        )
+        for file in checkpoint["files"]
+    ]
+    return files, np.load(os.path.join(path, CHECKPOINT_VECTORS_FILE))
+
+
+class Progress:
+    """Reports the throughput of a run every `interval` seconds"""
+
+    def __init__(self, total: int, out: TextIO, interval: float = REPORT_INTERVAL):
+        self.total = total
+        self.out = out
+        self.interval = interval
+        self.files = 0
+        self.pages = 0
+        self.chunks = 0
+        self.failed = 0
+        self._start = time.perf_counter()
+        self._last_report = self._start
+
+    def add(self, file: Optional[File]) -> None:
+        if file is None:
+            self.failed += 1
+        else:
+            self.files += 1
+            self.chunks += len(file.docs)
+            self.pages += len({doc.metadata.get("page") for doc in file.docs})
+        if time.perf_counter() - self._last_report >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        self._last_report = time.perf_counter()
+        seconds = max(self._last_report - self._start, 1e-9)
+        done = self.files + self.failed
+        rate = done / seconds
+        eta = (self.total - done) / rate if rate else float("inf")
+        print(
+            f"{done}/{self.total} files ({self.failed} failed)"
+            f"  {rate:.1f} files/s  {self.pages / seconds:.1f} pages/s"
+            f"  {self.chunks / seconds:.1f} chunks/s  ETA {eta:.0f}s",
+            file=self.out,
+            flush=True,
+        )
+
+
+def ingest_directory(
+    directory: str,
+    index_path: str,
+    embeddings: Embeddings,
+    vector_store: str = "faiss",
+    chunk_size: int = 300,
+    chunk_overlap: int = 0,
+    model_name: str = "gpt-3.5-turbo",
+    num_workers: int = os.cpu_count() or 1,
+    embed_batch_chunks: int = DEFAULT_EMBED_BATCH_CHUNKS,
+    checkpoint_every: int = 500,
+    out: TextIO = sys.stderr,
+    on_checkpoint: Optional[Callable[[int], None]] = None,
+) -> FolderIndex:
+    """Indexes the supported files of a directory into the FolderIndex saved
+    at `index_path`, adding to the index if it exists.
+
+    Files are read and chunked by `num_workers` processes. Their chunks are
+    embedded once at least `embed_batch_chunks` of them are waiting. Every
+    `checkpoint_every` files, the files indexed since the previous checkpoint
+    are written with their vectors, and at the end the whole index is saved
+    together with a manifest of the files it holds. A run started after an
+    interruption adds the checkpoints back to the index first. A file that is
+    in the manifest (or a checkpoint) with the same size and
+    modification time is skipped without being read, a file that changed
+    replaces its previous version. Files that can't be read are recorded as
+    failed and skipped by later runs too, until they change.
+    """
+
+    folder_index: Optional[FolderIndex] = None
+    if os.path.exists(os.path.join(index_path, FOLDER_FILE)):
+        folder_index = FolderIndex.load(index_path, embeddings=embeddings)
+    records = load_manifest(index_path)
+
+    def add_files(files: List[File], vectors: np.ndarray) -> List[File]:
+        nonlocal folder_index
+        if folder_index is None:
+            index = get_vector_store(vector_store)(embedding=embeddings)
+            if not isinstance(index, ChunkFAISS):
+                raise NotImplementedError(
+                    f"Bulk ingestion into a {vector_store} vector store"
+                    " is not supported."
+                )
+            folder_index = FolderIndex(files=[], index=index, embeddings=embeddings)
+        return folder_index.add_files(files, vectors=vectors)
+
+    checkpoint_number = 0
+    for path, checkpoint in iter_checkpoints(index_path):
+        if folder_index is not None:
+            folder_index.remove_files(checkpoint["removed"])
+        add_files(*load_checkpoint(path, checkpoint))
+        checkpoint_number = int(os.path.basename(path))
+
+    todo: List[Tuple[str, FileRecord]] = []
+    for path in iter_documents(directory):
+        stat = os.stat(os.path.join(directory, path))
+        record = records.get(path)
+        if record is None or (record.size, record.mtime) != (
+            stat.st_size,
+            stat.st_mtime,
+        ):
+            todo.append((path, FileRecord(size=stat.st_size, mtime=stat.st_mtime)))
+
+    print(
+        f"{len(todo)} files to index, {len(records)} already done", file=out, flush=True
+    )
+    progress = Progress(len(todo), out)
+
+    # Files that are read but not embedded yet, with their records
+    pending: List[Tuple[str, FileRecord, File]] = []
+    pending_chunks = 0
+    since_checkpoint = 0
+
+    # What changed since the last checkpoint
+    added: List[File] = []
+    added_vectors: List[np.ndarray] = []
+    removed: List[str] = []
+    updated: Dict[str, FileRecord] = {}
+
+    def embed_pending() -> None:
+        nonlocal pending, pending_chunks
+        if not pending:
+            return
+
+        # Older versions of changed files are replaced, unless another
+        # path still has the same contents
+        paths = {path for path, _, _ in pending}
+        replaced = {records[path].file_id for path in paths if path in records}
+        kept = {record.file_id for path, record in records.items() if path not in paths}
+        kept.update(file.id for _, _, file in pending)
+        stale = [file_id for file_id in replaced - kept if file_id is not None]
+        if folder_index is not None and stale:
+            removed.extend(file.id for file in folder_index.remove_files(stale))
+
+        # The same contents under several paths are indexed once
+        indexed = {file.id for file in folder_index.files} if folder_index else set()
+        files = list(
+            {
+                file.id: file
+                for _, _, file in pending
+                if file.docs and file.id not in indexed
+            }.values()
+        )
+        if files:
+            # Embedded here so that checkpoints can keep the vectors
+            vectors = np.array(
+                embeddings.embed_documents(
+                    [doc.page_content for file in files for doc in file.docs]
+                ),
+                dtype=np.float32,
+            )
+            added.extend(add_files(files, vectors))
+            added_vectors.append(vectors)
+
+        for path, record, file in pending:
+            record.file_id = file.id
+            records[path] = updated[path] = record
+        pending, pending_chunks = [], 0
+
+    def checkpoint() -> None:
+        nonlocal since_checkpoint, checkpoint_number
+        embed_pending()
+        if updated:
+            checkpoint_number += 1
+            save_checkpoint(
+                index_path,
+                checkpoint_number,
+                added,
+                np.concatenate(added_vectors) if added_vectors else np.zeros(0),
+                removed,
+                updated,
+            )
+            added.clear()
+            added_vectors.clear()
+            removed.clear()
+            updated.clear()
+        since_checkpoint = 0
+        if on_checkpoint is not None:
+            on_checkpoint(len(records))
+
+    def done(path: str, record: FileRecord, future: Future) -> None:
+        nonlocal pending_chunks, since_checkpoint
+        try:
+            file = future.result()
+        except Exception as e:
+            record.error = f"{e.__class__.__name__}: {e}"
+            records[path] = updated[path] = record
+            progress.add(None)
+            print(f"Failed to read {path}: {record.error}", file=out, flush=True)
+        else:
+            pending.append((path, record, file))
+            pending_chunks += len(file.docs)
+            progress.add(file)
+            if pending_chunks >= embed_batch_chunks:
+                embed_pending()
+
+        since_checkpoint += 1
+        if since_checkpoint >= checkpoint_every:
+            checkpoint()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # A few files per worker are read ahead, the others wait their turn
+        # so that memory stays bounded
+        in_flight: Deque[Tuple[str, FileRecord, Future]] = deque()
+        for path, record in todo:
+            future = executor.submit(
+                parse_document, directory, path, chunk_size, chunk_overlap, model_name
+            )
+            in_flight.append((path, record, future))
+            if len(in_flight) >= num_workers * 4:
+                done(*in_flight.popleft())
+
+        while in_flight:
+            done(*in_flight.popleft())
+
+    embed_pending()
+    if folder_index is not None and (todo or checkpoint_number):
+        # Replaces the index and the checkpoints with the whole index
+        save_folder_index(
+            folder_index,
+            index_path,
+            extra_files={MANIFEST_FILE: dump_manifest(records)},
+        )
+    if on_checkpoint is not None:
+        on_checkpoint(len(records))
+    progress.report()
+
+    if folder_index is None:
+        raise ValueError(f"No text to index in {directory}")
+    return folder_index
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="directory with the files to index")
+    parser.add_argument("index", help="directory the index is saved in")
+    parser.add_argument("--embedding", default="openai")
+    parser.add_argument(
+        "--embedding-threads",
+        type=int,
+        default=os.environ.get("EMBEDDING_THREADS"),
+        help="CPU threads used by the local embedding model",
+    )
+    parser.add_argument("--vector-store", default="faiss")
+    parser.add_argument("--chunk-size", type=int, default=300)
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--embed-batch-chunks", type=int, default=DEFAULT_EMBED_BATCH_CHUNKS
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=500)
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("EMBEDDING_CACHE_DIR"),
+        help="directory chunk embeddings are cached in",
+    )
+    args = parser.parse_args()
+
+    embedding_kwargs = {}
+    if args.embedding == "openai":
+        embedding_kwargs["openai_api_key"] = os.environ.get("OPENAI_API_KEY")
+    elif args.embedding == "local" and args.embedding_threads:
+        embedding_kwargs["num_threads"] = int(args.embedding_threads)
+
+    ingest_directory(
+        args.directory,
+        args.index,
+        embeddings=get_embeddings(
+            args.embedding, cache_dir=args.cache_dir, **embedding_kwargs
+        ),
+        vector_store=args.vector_store,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        model_name=args.model,
+        num_workers=args.workers,
+        embed_batch_chunks=args.embed_batch_chunks,
+        checkpoint_every=args.checkpoint_every,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import count
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+# Cosine similarity above which two queries are considered the same question
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+DEFAULT_MAX_ENTRIES = 1024
+
+# Answers are recomputed after this many seconds
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+
+class _Entry:
+    __slots__ = ("scope", "vector", "answer", "created")
+
+    def __init__(self, scope: Hashable, vector: np.ndarray, answer: Any):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        self.created = time.monotonic()
+
+
+def _normalize(vector: Sequence[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm > 0 else array
+
+
+class AnswerCache:
+    """In-memory cache of answers keyed by the embedding of their query.
+
+    A lookup returns the answer of the most similar cached query in the same
+    scope (e.g. folder index and model) if the cosine similarity of the two
+    queries is at least `threshold`, so rephrasing a question still hits the
+    cache. Entries expire after `ttl_seconds` and the least recently used
+    entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._ids = count()
+        # Entries in least to most recently used order
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._scopes: Dict[Hashable, List[int]] = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"AnswerCache(entries={len(self)}, hits={self.hits},"
+            f" misses={self.misses})"
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that were served from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _is_expired(self, entry: _Entry) -> bool:
+        return (
+            self.ttl_seconds is not None
+            and time.monotonic() - entry.created > self.ttl_seconds
+        )
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        scope_ids = self._scopes[entry.scope]
+        scope_ids.remove(entry_id)
+        if not scope_ids:
+            del self._scopes[entry.scope]
+
+    def get(self, scope: Hashable, query_vector: Sequence[float]) -> Optional[Any]:
+        """Returns the answer cached for the most similar query in the scope,
+        or None if no cached query is similar enough"""
+        vector = _normalize(query_vector)
+
+        with self._lock:
+            for entry_id in list(self._scopes.get(scope, [])):
+                if self._is_expired(self._entries[entry_id]):
+                    self._remove(entry_id)
+
+            entry_ids = self._scopes.get(scope, [])
+            if entry_ids:
+                vectors = np.stack([self._entries[i].vector for i in entry_ids])
+                similarities = vectors @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = entry_ids[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id].answer
+
+            self.misses += 1
+            return None
+
+    def put(self, scope: Hashable, query_vector: Sequence[float], answer: Any) -> None:
+        """Caches the answer to a query, evicting the least recently used
+        entries if the cache is full"""
+        entry_id = next(self._ids)
+        with self._lock:
+            self._entries[entry_id] = _Entry(scope, _normalize(query_vector), answer)
+            self._scopes.setdefault(scope, []).append(entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Removes every entry from the cache and resets the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache(
+    threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    max_entries: int = DEFAULT_MAX_ENTRIES,
+    ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS,
+) -> AnswerCache:
+    """Returns an AnswerCache shared by all the sessions of the app
+    with the given settings."""
+    return AnswerCache(threshold, max_entries=max_entries, ttl_seconds=ttl_seconds)
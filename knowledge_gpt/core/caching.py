@@ -1,10 +1,24 @@
+import threading
+from typing import Dict
+
 import streamlit as st
 from streamlit.runtime.caching.hashing import HashFuncsDict
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 import knowledge_gpt.core.parsing as parsing
 import knowledge_gpt.core.chunking as chunking
 import knowledge_gpt.core.embedding as embedding
-from knowledge_gpt.core.parsing import File
+import knowledge_gpt.core.ingestion as ingestion
+from knowledge_gpt.core.parsing import File, get_file_id
+
+# Number of uploads whose content id is remembered
+MAX_REMEMBERED_UPLOADS = 1024
+
+# Content ids of uploads by upload id. Streamlit creates a new UploadedFile
+# on every rerun, but the upload id stays the same as long as the file
+# is not uploaded again.
+_upload_content_ids: Dict[int, str] = {}
+_upload_lock = threading.Lock()
 
 
 def file_hash_func(file: File) -> str:
@@ -12,6 +26,23 @@ def file_hash_func(file: File) -> str:
     return file.id
 
 
+def upload_hash_func(file: UploadedFile) -> str:
+    """Get a unique hash for an uploaded file. The contents of an upload are
+    hashed once, not on every rerun like Streamlit's own hash does."""
+    with _upload_lock:
+        content_id = _upload_content_ids.get(file.id)
+    if content_id is None:
+        content_id = get_file_id(file)
+        with _upload_lock:
+            _upload_content_ids[file.id] = content_id
+            while len(_upload_content_ids) > MAX_REMEMBERED_UPLOADS:
+                del _upload_content_ids[next(iter(_upload_content_ids))]
+    else:
+        # Saves functions that need the id of the file from hashing it again
+        file.content_id = content_id  # type: ignore
+    return f"{file.name}:{content_id}"
+
+
 @st.cache_data(show_spinner=False)
 def bootstrap_caching():
     """Patch module functions with caching"""
@@ -24,10 +55,20 @@ def bootstrap_caching():
     ]
     file_hash_funcs: HashFuncsDict = {cls: file_hash_func for cls in file_subtypes}
 
-    parsing.read_file = st.cache_data(show_spinner=False)(parsing.read_file)
+    upload_hash_funcs: HashFuncsDict = {UploadedFile: upload_hash_func}
+
+    parsing.read_file = st.cache_data(show_spinner=False, hash_funcs=upload_hash_funcs)(
+        parsing.read_file
+    )
     chunking.chunk_file = st.cache_data(show_spinner=False, hash_funcs=file_hash_funcs)(
         chunking.chunk_file
     )
-    embedding.embed_files = st.cache_data(
+    # Indexes are cached as resources: every session shares the same object,
+    # which for a loaded index is memory-mapped. st.cache_data would pickle
+    # it and give every rerun a private copy of the whole index.
+    embedding.embed_files = st.cache_resource(
         show_spinner=False, hash_funcs=file_hash_funcs
     )(embedding.embed_files)
+    ingestion.ingest_file = st.cache_resource(
+        show_spinner=False, hash_funcs=upload_hash_funcs
+    )(ingestion.ingest_file)
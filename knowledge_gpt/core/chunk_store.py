@@ -0,0 +1,419 @@
+import json
+import mmap
+import os
+from array import array
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    overload,
+)
+
+import numpy as np
+from langchain.docstore.document import Document
+
+# Column value for a page or chunk number that is not set
+_UNSET = 0
+
+# Layout of the columns of a saved store
+_COLUMNS_DTYPE = np.dtype(
+    [
+        ("start", "<u8"),
+        ("end", "<u8"),
+        ("page", "<i4"),
+        ("chunk", "<i4"),
+        ("file", "<i4"),
+    ]
+)
+
+TEXTS_FILE = "chunks.bin"
+COLUMNS_FILE = "chunks.npy"
+TABLES_FILE = "chunks.json"
+
+
+class ChunkView:
+    """Lightweight, read-only view of a single chunk in a ChunkStore.
+
+    Quacks like a langchain Document (`page_content` and `metadata`) without
+    holding any data of its own.
+    """
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "ChunkStore", row: int):
+        self._store = store
+        self._row = row
+
+    @property
+    def row(self) -> int:
+        return self._row
+
+    @property
+    def page_content(self) -> str:
+        return self._store.text(self._row)
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        return self._store.metadata(self._row)
+
+    def to_document(self) -> Document:
+        """Materializes the chunk as a langchain Document"""
+        return Document(page_content=self.page_content, metadata=self.metadata)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, ChunkView)
+            and self._store is other._store
+            and self._row == other._row
+        )
+
+    def __hash__(self) -> int:
+        return hash((id(self._store), self._row))
+
+    def __repr__(self) -> str:
+        return f"ChunkView(row={self._row}, metadata={self.metadata})"
+
+
+class ChunkSlice(Sequence[ChunkView]):
+    """A contiguous range of rows of a ChunkStore, e.g. the chunks of one file"""
+
+    def __init__(self, store: "ChunkStore", start: int, stop: int):
+        self.store = store
+        self.rows = range(start, stop)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @overload
+    def __getitem__(self, i: int) -> ChunkView:
+        ...
+
+    @overload
+    def __getitem__(self, i: slice) -> "ChunkSlice":
+        ...
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[ChunkView, "ChunkSlice"]:
+        if isinstance(i, slice):
+            rows = self.rows[i]
+            if rows.step != 1:
+                raise ValueError("ChunkSlice only supports contiguous slices")
+            return ChunkSlice(self.store, rows.start, rows.stop)
+        return ChunkView(self.store, self.rows[i])
+
+    def __repr__(self) -> str:
+        return f"ChunkSlice(rows={self.rows})"
+
+
+class ChunkStore(Sequence[ChunkView]):
+    """Columnar storage for the chunks of one or more files.
+
+    Instead of one Document (with its own metadata dict) per chunk, the texts
+    are kept in a few large string buffers with offset arrays, and page, chunk
+    and file numbers are kept in integer columns. Rows are read through
+    ChunkView objects, and Documents are only created on demand with
+    `to_document`.
+
+    Only the `page`, `chunk`, `source`, `file_name`, `file_id` and
+    `duplicates` (the sources of the chunks dropped as repeats of a chunk)
+    metadata keys are stored.
+
+    A store can be saved to a directory and loaded back memory-mapped, in which
+    case texts are decoded from the mapped file as they are read. Text buffers
+    are either `str` (offsets in characters) or UTF-8 `bytes`-like objects
+    (offsets in bytes).
+    """
+
+    def __init__(self):
+        # Text buffers. Every `extend` adds one buffer, `compact` joins them.
+        self._buffers: List[str] = []
+        self._buffer_ids = array("I")
+        self._starts = array("Q")
+        self._ends = array("Q")
+
+        self._pages = array("i")
+        self._chunks = array("i")
+        self._files = array("i")
+
+        # (file_name, file_id) for every file in the store
+        self._file_table: List[Tuple[Optional[str], Optional[str]]] = []
+        self._file_numbers: dict[Tuple[Optional[str], Optional[str]], int] = {}
+
+        # Sources that don't follow the "{page}-{chunk}" pattern
+        self._sources: dict[int, str] = {}
+        # Sources of the chunks that repeat a row, for the few rows that have
+        self._duplicates: dict[int, List[str]] = {}
+
+    @classmethod
+    def from_documents(cls, docs: Iterable[Any]) -> "ChunkStore":
+        """Creates a store from Documents, reading the file name and id
+        from their metadata."""
+        store = cls()
+        store.extend(docs)
+        return store
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    @overload
+    def __getitem__(self, i: int) -> ChunkView:
+        ...
+
+    @overload
+    def __getitem__(self, i: slice) -> ChunkSlice:
+        ...
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[ChunkView, ChunkSlice]:
+        return ChunkSlice(self, 0, len(self))[i]
+
+    def __iter__(self) -> Iterator[ChunkView]:
+        return (ChunkView(self, row) for row in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"ChunkStore(chunks={len(self)}, files={len(self._file_table)})"
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        # Memory-mapped buffers can't be pickled
+        state["_buffers"] = [
+            buffer if isinstance(buffer, str) else bytes(buffer)
+            for buffer in self._buffers
+        ]
+        return state
+
+    def text(self, row: int) -> str:
+        buffer = self._buffers[self._buffer_ids[row]]
+        text = buffer[self._starts[row] : self._ends[row]]  # noqa: E203
+        return text if isinstance(text, str) else text.decode("utf-8")
+
+    def metadata(self, row: int) -> dict[str, Any]:
+        metadata: dict[str, Any] = {}
+        page, chunk = int(self._pages[row]), int(self._chunks[row])
+        if page != _UNSET:
+            metadata["page"] = page
+        if chunk != _UNSET:
+            metadata["chunk"] = chunk
+
+        source = self.source(row)
+        if source is not None:
+            metadata["source"] = source
+
+        file_name, file_id = self._file_table[self._files[row]]
+        if file_name is not None:
+            metadata["file_name"] = file_name
+        if file_id is not None:
+            metadata["file_id"] = file_id
+
+        if row in self._duplicates:
+            metadata["duplicates"] = list(self._duplicates[row])
+        return metadata
+
+    def source(self, row: int) -> Optional[str]:
+        if row in self._sources:
+            return self._sources[row]
+        page, chunk = int(self._pages[row]), int(self._chunks[row])
+        if page != _UNSET and chunk != _UNSET:
+            return f"{page}-{chunk}"
+        return None
+
+    def file_id(self, row: int) -> Optional[str]:
+        return self._file_table[self._files[row]][1]
+
+    def duplicates(self, row: int) -> List[str]:
+        """Sources of the chunks that were dropped as repeats of a row"""
+        return self._duplicates.get(row, [])
+
+    def add_duplicates(self, row: int, sources: Iterable[str]) -> None:
+        self._duplicates.setdefault(row, []).extend(sources)
+
+    def _file_number(self, file_name: Optional[str], file_id: Optional[str]) -> int:
+        key = (file_name, file_id)
+        if key not in self._file_numbers:
+            self._file_numbers[key] = len(self._file_table)
+            self._file_table.append(key)
+        return self._file_numbers[key]
+
+    def extend(
+        self,
+        docs: Iterable[Any],
+        file_name: Optional[str] = None,
+        file_id: Optional[str] = None,
+    ) -> ChunkSlice:
+        """Appends documents (or anything with `page_content` and `metadata`)
+        to the store and returns the new rows.
+
+        If `file_name` and `file_id` are not given, they are read from the
+        metadata of each document.
+        """
+        self._thaw()
+
+        start = len(self)
+        texts = []
+        offset = 0
+        buffer_id = len(self._buffers)
+
+        for doc in docs:
+            metadata = doc.metadata
+            text = doc.page_content
+            texts.append(text)
+
+            row = len(self._starts)
+            self._buffer_ids.append(buffer_id)
+            self._starts.append(offset)
+            offset += len(text)
+            self._ends.append(offset)
+
+            page = int(metadata.get("page", _UNSET))
+            chunk = int(metadata.get("chunk", _UNSET))
+            self._pages.append(page)
+            self._chunks.append(chunk)
+
+            source = metadata.get("source")
+            if source is not None and (
+                page == _UNSET or chunk == _UNSET or source != f"{page}-{chunk}"
+            ):
+                self._sources[row] = source
+            if metadata.get("duplicates"):
+                self._duplicates[row] = list(metadata["duplicates"])
+
+            self._files.append(
+                self._file_number(
+                    file_name if file_name is not None else metadata.get("file_name"),
+                    file_id if file_id is not None else metadata.get("file_id"),
+                )
+            )
+
+        self._buffers.append("".join(texts))
+        return ChunkSlice(self, start, len(self))
+
+    def compact(self) -> None:
+        """Joins all text buffers into a single one.
+        Must not be called while other threads read from the store.
+        Stores with a memory-mapped buffer are left as they are."""
+        if len(self._buffers) <= 1 or not all(
+            isinstance(buffer, str) for buffer in self._buffers
+        ):
+            return
+
+        buffer_offsets = [0]
+        for buffer in self._buffers:
+            buffer_offsets.append(buffer_offsets[-1] + len(buffer))
+
+        for row in range(len(self)):
+            shift = buffer_offsets[self._buffer_ids[row]]
+            self._starts[row] += shift
+            self._ends[row] += shift
+
+        self._buffers = ["".join(self._buffers)]
+        self._buffer_ids = array("I", bytes(self._buffer_ids.itemsize * len(self)))
+
+    def _thaw(self) -> None:
+        """Copies columns loaded from disk into growable arrays"""
+        for name, typecode in [
+            ("_buffer_ids", "I"),
+            ("_starts", "Q"),
+            ("_ends", "Q"),
+            ("_pages", "i"),
+            ("_chunks", "i"),
+            ("_files", "i"),
+        ]:
+            column = getattr(self, name)
+            if not isinstance(column, array):
+                setattr(self, name, array(typecode, column.tolist()))
+
+    def save(self, path: str) -> None:
+        """Saves the store to a directory: the UTF-8 texts of all rows in one
+        file, the columns in a numpy file and the file table and sources as
+        JSON."""
+        os.makedirs(path, exist_ok=True)
+
+        ends = array("Q")
+        offset = 0
+        with open(os.path.join(path, TEXTS_FILE), "wb") as f:
+            for row in range(len(self)):
+                data = self.text(row).encode("utf-8")
+                f.write(data)
+                offset += len(data)
+                ends.append(offset)
+
+        columns = np.zeros(len(self), dtype=_COLUMNS_DTYPE)
+        columns["end"] = ends
+        columns["start"][1:] = columns["end"][:-1]
+        columns["page"] = self._pages
+        columns["chunk"] = self._chunks
+        columns["file"] = self._files
+        np.save(os.path.join(path, COLUMNS_FILE), columns)
+
+        tables = {
+            "files": self._file_table,
+            "sources": {str(row): source for row, source in self._sources.items()},
+            "duplicates": {
+                str(row): sources for row, sources in self._duplicates.items()
+            },
+        }
+        with open(os.path.join(path, TABLES_FILE), "w") as f:
+            json.dump(tables, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: bool = True) -> "ChunkStore":
+        """Loads a store saved with `save`. With `mmap_mode`, the texts and
+        columns are memory-mapped instead of read into memory, so loading
+        takes the same time for any size and processes loading the same
+        store share its pages. The store is copied into memory only if
+        chunks are added to it."""
+        store = cls()
+
+        columns = np.load(
+            os.path.join(path, COLUMNS_FILE), mmap_mode="r" if mmap_mode else None
+        )
+        store._buffer_ids = np.zeros(len(columns), dtype=np.uint32)
+        store._starts = columns["start"]
+        store._ends = columns["end"]
+        store._pages = columns["page"]
+        store._chunks = columns["chunk"]
+        store._files = columns["file"]
+
+        with open(os.path.join(path, TEXTS_FILE), "rb") as f:
+            if not mmap_mode:
+                store._buffers = [f.read()]
+            elif os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                store._buffers = [b""]
+            else:
+                store._buffers = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)]
+
+        with open(os.path.join(path, TABLES_FILE)) as f:
+            tables = json.load(f)
+        store._file_table = [tuple(key) for key in tables["files"]]
+        store._file_numbers = {key: i for i, key in enumerate(store._file_table)}
+        store._sources = {int(row): source for row, source in tables["sources"].items()}
+        store._duplicates = {
+            int(row): sources for row, sources in tables.get("duplicates", {}).items()
+        }
+
+        return store
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the texts and columns"""
+        columns = [
+            self._buffer_ids,
+            self._starts,
+            self._ends,
+            self._pages,
+            self._chunks,
+            self._files,
+        ]
+        return sum(len(buffer) for buffer in self._buffers) + sum(
+            column.itemsize * len(column) for column in columns
+        )
+
+
+def as_document(doc: Any) -> Document:
+    """Returns a langchain Document for a Document or a ChunkView"""
+    if isinstance(doc, ChunkView):
+        return doc.to_document()
+    return doc
@@ -1,38 +1,209 @@
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+import numpy as np
+import tiktoken
 from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from knowledge_gpt.core.chunk_store import ChunkStore
+from knowledge_gpt.core.dedup import ChunkDeduplicator
+from knowledge_gpt.core.instrumentation import increment, timed
 from knowledge_gpt.core.parsing import File
 
+# Number of pages tokenized together in one (multi-threaded) tiktoken call
+TOKENIZE_BATCH_SIZE = 32
+
+# Places to end a chunk on, from the most to the least preferred
+SEPARATORS = [b"\n\n", b"\n", b" "]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding for a model, created once per model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+@lru_cache(maxsize=None)
+def _get_token_lengths(model_name: str) -> np.ndarray:
+    """Returns the length in bytes of every token of a model's encoding"""
+    encoding = get_encoding(model_name)
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            # Not every id below n_vocab is a token
+            pass
+    return lengths
+
+
+class TokenChunker:
+    """Splits texts into chunks of at most `chunk_size` tokens.
+
+    Each text is tokenized once and chunk boundaries are placed directly on token
+    offsets. Like langchain's RecursiveCharacterTextSplitter, a chunk ends on the
+    last paragraph break in its window if there is one, then on the last line
+    break, then on the last space, and only then in the middle of a word.
+    """
+
+    def __init__(
+        self, chunk_size: int, chunk_overlap: int = 0, model_name="gpt-3.5-turbo"
+    ):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(
+                f"Chunk overlap ({chunk_overlap}) must be smaller than"
+                f" the chunk size ({chunk_size})"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.model_name = model_name
+        self.encoding = get_encoding(model_name)
+
+    def split_text(self, text: str) -> List[str]:
+        """Splits a single text into chunks"""
+        return self._split_tokens(text, self.encoding.encode_ordinary(text))
+
+    def split_texts(self, texts: List[str]) -> List[List[str]]:
+        """Splits several texts into chunks, tokenizing them in one batch"""
+        batch_tokens = self.encoding.encode_ordinary_batch(texts)
+        return [
+            self._split_tokens(text, tokens)
+            for text, tokens in zip(texts, batch_tokens)
+        ]
+
+    def _split_tokens(self, text: str, tokens: List[int]) -> List[str]:
+        if len(tokens) <= self.chunk_size:
+            text = text.strip()
+            return [text] if text else []
+
+        data = text.encode("utf-8")
+        # offsets[i] is the byte offset in `data` where token i starts
+        token_lengths = _get_token_lengths(self.model_name)[tokens]
+        offsets = np.concatenate(([0], np.cumsum(token_lengths)))
+
+        chunks = []
+        start = 0
+        while start < len(tokens):
+            end = self._find_end(data, offsets, start)
+            chunk = data[offsets[start] : offsets[end]]  # noqa: E203
+            chunk = chunk.decode("utf-8").strip()
+            if chunk:
+                chunks.append(chunk)
+            if end == len(tokens):
+                break
+            start = self._find_start(data, offsets, start, end)
+
+        return chunks
+
+    def _find_end(self, data: bytes, offsets: np.ndarray, start: int) -> int:
+        """Returns the token index at which the chunk starting at `start` ends"""
+        limit = min(start + self.chunk_size, len(offsets) - 1)
+        if limit == len(offsets) - 1:
+            return limit
+
+        lo, hi = offsets[start], offsets[limit]
+        for separator in SEPARATORS:
+            # Look for the last separator that touches a token boundary
+            pos = data.rfind(separator, lo, hi + len(separator))
+            while pos != -1:
+                first = np.searchsorted(offsets, pos, side="left")
+                last = np.searchsorted(offsets, pos + len(separator), side="right")
+                end = min(last - 1, limit)
+                if end >= first and end > start:
+                    return int(end)
+                pos = data.rfind(separator, lo, pos + len(separator) - 1)
+
+        # No separator in the window, split in the middle of a word but never
+        # in the middle of a multi-byte character
+        end = limit
+        while end > start + 1 and _is_continuation(data, offsets[end]):
+            end -= 1
+        return end
+
+    def _find_start(
+        self, data: bytes, offsets: np.ndarray, start: int, end: int
+    ) -> int:
+        """Returns the token index at which the chunk after [start, end) starts"""
+        next_start = max(end - self.chunk_overlap, start + 1)
+        while next_start < end and _is_continuation(data, offsets[next_start]):
+            next_start += 1
+        return next_start
+
+
+def _is_continuation(data: bytes, offset: int) -> bool:
+    """Whether a byte offset falls inside a multi-byte UTF-8 character"""
+    return offset < len(data) and data[offset] & 0xC0 == 0x80
+
+
+def iter_chunks(
+    docs: Iterable[Document],
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    model_name="gpt-3.5-turbo",
+) -> Iterator[Document]:
+    """Lazily chunks a stream of documents into smaller documents
+    according to the specified chunk size and overlap
+    where the size is determined by the number of tokens for the specified model.
+    """
+    chunker = TokenChunker(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        model_name=model_name,
+    )
+
+    docs = iter(docs)
+    while batch := list(islice(docs, TOKENIZE_BATCH_SIZE)):
+        batch_chunks = chunker.split_texts([doc.page_content for doc in batch])
+
+        for doc, chunks in zip(batch, batch_chunks):
+            page = doc.metadata.get("page", 1)
+
+            for i, chunk in enumerate(chunks):
+                yield Document(
+                    page_content=chunk,
+                    metadata={
+                        "page": page,
+                        "chunk": i + 1,
+                        "source": f"{page}-{i + 1}",
+                    },
+                )
+
 
 def chunk_file(
-    file: File, chunk_size: int, chunk_overlap: int = 0, model_name="gpt-3.5-turbo"
+    file: File,
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    model_name="gpt-3.5-turbo",
+    deduplicate: bool = False,
+    near_duplicates: bool = False,
 ) -> File:
     """Chunks each document in a file into smaller documents
     according to the specified chunk size and overlap
     where the size is determined by the number of tokens for the specified model.
+
+    With `deduplicate` (off by default), chunks that repeat an earlier chunk of
+    the file are dropped, and their sources are kept in the `duplicates` metadata of the
+    chunk they repeat. Only exact repeats are dropped unless `near_duplicates`
+    is set (see `ChunkDeduplicator`).
     """
 
-    # split each document into chunks
-    chunked_docs = []
-    for doc in file.docs:
-        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name=model_name,
+    # split each document into chunks, stored in columns rather than
+    # as one Document per chunk
+    with timed("chunk"):
+        chunks = iter_chunks(
+            file.docs,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
+            model_name=model_name,
         )
+        if deduplicate:
+            deduplicator = ChunkDeduplicator(near_duplicates=near_duplicates)
+            chunks = deduplicator.filter(chunks)
+        chunked_docs = ChunkStore.from_documents(chunks)
+        if deduplicate:
+            for row, sources in deduplicator.duplicates.items():
+                chunked_docs.add_duplicates(row, sources)
+    increment("chunks", len(chunked_docs))
 
-        chunks = text_splitter.split_text(doc.page_content)
-
-        for i, chunk in enumerate(chunks):
-            doc = Document(
-                page_content=chunk,
-                metadata={
-                    "page": doc.metadata.get("page", 1),
-                    "chunk": i + 1,
-                    "source": f"{doc.metadata.get('page', 1)}-{i + 1}",
-                },
-            )
-            chunked_docs.append(doc)
-
-    chunked_file = file.copy()
-    chunked_file.docs = chunked_docs
-    return chunked_file
+    return file.derive(chunked_docs)
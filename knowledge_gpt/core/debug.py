@@ -5,13 +5,41 @@ from langchain.embeddings.base import Embeddings
 from langchain.embeddings.fake import FakeEmbeddings as FakeEmbeddingsBase
 from langchain.chat_models.fake import FakeListChatModel
 from typing import Optional
+import re
+import threading
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.schema import BaseMessage
+from pydantic import PrivateAttr
 
 
 class FakeChatModel(FakeListChatModel):
+    """Answers every call with the next of its responses, starting over after
+    the last one. Calls may come from several threads at once, like the
+    questions of a batch or the map steps of a map-reduce chain."""
+
+    streaming: bool = False
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
     def __init__(self, **kwargs):
         responses = ["The answer is 42. SOURCES: 1, 2, 3, 4"]
         super().__init__(responses=responses, **kwargs)
 
+    def _call(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        with self._lock:
+            response = self.responses[self.i % len(self.responses)]
+            self.i += 1
+        if self.streaming and run_manager is not None:
+            # Stream the response word by word like ChatOpenAI streams tokens
+            for token in re.findall(r"\s*\S+", response):
+                run_manager.on_llm_new_token(token)
+        return response
+
 
 class FakeEmbeddings(FakeEmbeddingsBase):
     def __init__(self, **kwargs):
@@ -42,6 +70,11 @@ class FakeVectorStore(VectorStore):
 
     def similarity_search(
         self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return self.similarity_search_by_vector([], k=k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
     ) -> List[Document]:
         return [
             Document(page_content=text, metadata={"source": f"{i+1}-{1}"})
@@ -0,0 +1,153 @@
+import re
+import zlib
+from hashlib import blake2b
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from knowledge_gpt.core.instrumentation import increment
+
+# With near duplicate detection, chunks whose estimated Jaccard similarity
+# (of their word shingles) is at least this are considered the same
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+
+# Number of hash functions of the MinHash signatures...
+NUM_PERMUTATIONS = 64
+# ...split into this many bands for locality sensitive hashing. Chunks that
+# agree on all the hashes of a band are compared, which finds most pairs
+# above a similarity of about (1 / bands) ** (bands / permutations) = 0.5
+NUM_BANDS = 16
+
+# Number of consecutive words in a shingle
+SHINGLE_SIZE = 3
+
+# Largest prime below 2**32, the hash functions are (a * x + b) mod this
+_PRIME = np.uint64(4294967291)
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize_text(text: str) -> str:
+    """Collapses the whitespace of a text, so that chunks that only differ in
+    their layout are exact duplicates. Case is kept, as it can tell apart code
+    identifiers or acronyms ("US" and "us")"""
+    return " ".join(text.split())
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """Hashes of the sequences of `size` consecutive words of a text. Texts
+    with fewer words get a single shingle of all of them."""
+    words = np.array(
+        [zlib.crc32(word.encode("utf-8")) for word in _WORD_RE.findall(text.lower())],
+        dtype=np.uint64,
+    )
+    if len(words) == 0:
+        return words
+    size = min(size, len(words))
+    hashes = np.zeros(len(words) - size + 1, dtype=np.uint64)
+    for i in range(size):
+        window = words[i : len(hashes) + i]  # noqa: E203
+        hashes = (hashes * np.uint64(31) + window) % _PRIME
+    return np.unique(hashes)
+
+
+class MinHasher:
+    """Computes MinHash signatures: the fraction of equal values in the
+    signatures of two sets estimates their Jaccard similarity"""
+
+    def __init__(self, num_permutations: int = NUM_PERMUTATIONS, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, int(_PRIME), size=num_permutations, dtype=np.uint64)
+        self.b = rng.integers(0, int(_PRIME), size=num_permutations, dtype=np.uint64)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        if len(hashes) == 0:
+            return np.full(len(self.a), int(_PRIME), dtype=np.uint64)
+        # Shingle hashes and coefficients are below 2**32, so the products
+        # don't overflow
+        values = (hashes[:, None] * self.a[None, :] + self.b[None, :]) % _PRIME
+        return values.min(axis=0)
+
+
+class ChunkDeduplicator:
+    """Drops chunks that repeat an earlier chunk, like the headers, footers
+    and disclaimers found on every page of a document.
+
+    Exact duplicates (after `normalize_text`) are found by hash. With
+    `near_duplicates`, so are chunks at least `threshold` similar to an
+    earlier one, with MinHash signatures and locality sensitive hashing; this
+    also drops chunks that only differ in a number or a name. The first
+    occurrence of a chunk is kept, and the sources of the chunks that repeat
+    it are recorded in `duplicates`, by the position of the kept chunk among
+    the unique ones.
+    """
+
+    def __init__(
+        self,
+        near_duplicates: bool = False,
+        threshold: float = DEFAULT_DUPLICATE_THRESHOLD,
+        num_permutations: int = NUM_PERMUTATIONS,
+        num_bands: int = NUM_BANDS,
+    ):
+        if num_permutations % num_bands != 0:
+            raise ValueError("The number of permutations must divide into bands")
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.band_size = num_permutations // num_bands
+        self.minhasher = MinHasher(num_permutations)
+
+        self.num_unique = 0
+        self.num_duplicates = 0
+        self.duplicates: Dict[int, List[str]] = {}
+        self._exact: Dict[bytes, int] = {}
+        self._signatures: List[np.ndarray] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(num_bands)]
+
+    def find(self, text: str) -> Optional[int]:
+        """Returns the position of the unique chunk a text repeats, or None
+        if it is new, in which case it is added to the unique chunks"""
+        digest = blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+        if digest in self._exact:
+            return self._exact[digest]
+        if not self.near_duplicates:
+            number = self.num_unique
+            self.num_unique += 1
+            self._exact[digest] = number
+            return None
+
+        signature = self.minhasher.signature(shingle_hashes(text))
+        bands = [
+            band.tobytes() for band in signature.reshape(self.num_bands, self.band_size)
+        ]
+        candidates = {
+            number
+            for band, key in zip(self._buckets, bands)
+            for number in band.get(key, [])
+        }
+        for number in sorted(candidates):
+            similarity = np.mean(self._signatures[number] == signature)
+            if similarity >= self.threshold:
+                self._exact[digest] = number
+                return number
+
+        number = self.num_unique
+        self.num_unique += 1
+        self._exact[digest] = number
+        self._signatures.append(signature)
+        for band, key in zip(self._buckets, bands):
+            band.setdefault(key, []).append(number)
+        return None
+
+    def filter(self, docs: Iterable[Any]) -> Iterator[Any]:
+        """Yields the documents that don't repeat an earlier one"""
+        for doc in docs:
+            number = self.find(doc.page_content)
+            if number is None:
+                yield doc
+                continue
+            self.num_duplicates += 1
+            increment("duplicate_chunks")
+            source = doc.metadata.get("source")
+            if source is not None:
+                self.duplicates.setdefault(number, []).append(source)
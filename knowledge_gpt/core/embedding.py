@@ -1,39 +1,430 @@
-from langchain.vectorstores import VectorStore
-from knowledge_gpt.core.parsing import File
-from langchain.vectorstores.faiss import FAISS
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+import numpy as np
+from langchain.docstore.document import Document
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.embeddings.base import Embeddings
-from typing import List, Type
-from langchain.docstore.document import Document
-from knowledge_gpt.core.debug import FakeVectorStore, FakeEmbeddings
+from langchain.vectorstores import VectorStore
+
+from knowledge_gpt.core.chunk_store import ChunkSlice, ChunkStore, as_document
+from knowledge_gpt.core.debug import FakeEmbeddings, FakeVectorStore
+from knowledge_gpt.core.embedding_cache import CachedEmbeddings, get_embedding_cache
+from knowledge_gpt.core.embedding_executor import (
+    DEFAULT_MAX_WORKERS,
+    ConcurrentEmbeddings,
+)
+from knowledge_gpt.core.instrumentation import (
+    in_current_context,
+    increment,
+    timed,
+)
+from knowledge_gpt.core.lexical_index import BM25Index, reciprocal_rank_fusion
+from knowledge_gpt.core.local_embeddings import LocalEmbeddings
+from knowledge_gpt.core.parsing import File, get_file_class_by_name
+from knowledge_gpt.core.vector_store import (
+    HNSWFAISS,
+    IVFPQFAISS,
+    ChunkFAISS,
+    FlatFAISS,
+    Float16FAISS,
+    Int8FAISS,
+    IVFFlatFAISS,
+)
+
+# Number of documents sent to the embedding model at once when indexing a stream
+DEFAULT_BATCH_SIZE = 128
+
+# Ways of retrieving the chunks relevant to a query: by embedding similarity,
+# by BM25 score over the words of the chunks, or both fused by rank
+RETRIEVAL_MODES = ["vector", "lexical", "hybrid"]
+# Mode the app and the API answer questions with. The library functions
+# search by vector unless told otherwise.
+DEFAULT_RETRIEVAL = "hybrid"
+
+# Description of the files of a saved FolderIndex
+FOLDER_FILE = "folder.json"
+FOLDER_FORMAT_VERSION = 1
+
+
+def _batched(docs: Iterable[Document], batch_size: int) -> Iterator[List[Document]]:
+    iterator = iter(docs)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
 
 
 class FolderIndex:
     """Index for a collection of files (a folder)"""
 
-    def __init__(self, files: List[File], index: VectorStore):
+    def __init__(
+        self,
+        files: List[File],
+        index: VectorStore,
+        chunks: Optional[ChunkStore] = None,
+        embeddings: Optional[Embeddings] = None,
+    ):
         self.name: str = "default"
         self.files = files
         self.index: VectorStore = index
+        # Model the index was embedded with, used to embed queries
+        self.embeddings = embeddings
+
+        # Store holding the chunks of the files, shared with the vector store
+        # if it keeps its chunks in a ChunkStore
+        if chunks is None:
+            chunks = index.chunks if isinstance(index, ChunkFAISS) else ChunkStore()
+        self.chunks = chunks
+
+        # Chunks by (file id, source key), and the ids of the files that have
+        # a chunk with a given source key, so that citations in an answer can
+        # be turned back into chunks without scanning the folder
+        self._chunks_by_source: Dict[Tuple[str, str], Any] = {}
+        self._files_by_source: Dict[str, List[str]] = {}
+        for file in files:
+            self._index_sources(file)
+
+        # Built by `build_lexical_index` or on the first lexical search
+        self._lexical_index: Optional[BM25Index] = None
+        self._lexical_numbers: Dict[str, range] = {}
+
+    def build_lexical_index(self) -> BM25Index:
+        """Builds the BM25 index over the chunks of the files if needed"""
+        if self._lexical_index is None:
+            # Built aside and published at the end, the index may be shared
+            # by the sessions searching it
+            lexical_index = BM25Index()
+            lexical_numbers = {
+                file.id: lexical_index.add(file.docs) for file in self.files
+            }
+            self._lexical_numbers = lexical_numbers
+            self._lexical_index = lexical_index
+        return self._lexical_index
+
+    def search(
+        self,
+        query: str,
+        k: int = 4,
+        mode: str = "vector",
+        query_vector: Optional[List[float]] = None,
+    ) -> List[Document]:
+        """Returns the k chunks most relevant to a query.
+
+        `mode` is one of RETRIEVAL_MODES. "lexical" ranks chunks by BM25 score
+        and never calls the embedding model. "hybrid" fuses the vector and
+        lexical rankings with reciprocal rank fusion, so exact identifiers are
+        found even when their embedding is not similar. If `query_vector` is
+        given, it is used instead of embedding the query.
+        """
+
+        if mode not in RETRIEVAL_MODES:
+            raise NotImplementedError(f"Retrieval mode {mode} not supported.")
+
+        if query_vector is None and mode != "lexical" and self.embeddings is not None:
+            # Embedded here rather than by the vector store, to be timed apart
+            with timed("embed_query"):
+                query_vector = self.embeddings.embed_query(query)
+
+        with timed("search"):
+            return self._search(query, k, mode, query_vector)
+
+    def _search(
+        self, query: str, k: int, mode: str, query_vector: Optional[List[float]]
+    ) -> List[Document]:
+        lexical_docs: List[Document] = []
+        if mode in ("lexical", "hybrid"):
+            lexical_docs = [
+                as_document(doc)
+                for doc, _ in self.build_lexical_index().search(query, k=k)
+            ]
+            if mode == "lexical":
+                return lexical_docs
+
+        if query_vector is not None:
+            vector_docs = self.index.similarity_search_by_vector(query_vector, k=k)
+        else:
+            vector_docs = self.index.similarity_search(query, k=k)
+        if mode == "vector":
+            return vector_docs
+
+        return reciprocal_rank_fusion([vector_docs, lexical_docs], key=_chunk_key, k=k)
+
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = 4,
+        mode: str = "vector",
+        query_vectors: Optional[List[Optional[List[float]]]] = None,
+    ) -> List[List[Document]]:
+        """Like `search` for many queries at once, in order. The queries that
+        have no vector in `query_vectors` are embedded in one request, and a
+        ChunkFAISS index is searched with the matrix of all the vectors in one
+        call instead of once per query."""
+
+        if mode not in RETRIEVAL_MODES:
+            raise NotImplementedError(f"Retrieval mode {mode} not supported.")
+
+        vectors: List[Optional[List[float]]] = list(
+            query_vectors or [None] * len(queries)
+        )
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing and mode != "lexical" and self.embeddings is not None:
+            with timed("embed_query"):
+                embedded = self.embeddings.embed_documents(
+                    [queries[i] for i in missing]
+                )
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+
+        with timed("search"):
+            if (
+                mode == "lexical"
+                or not isinstance(self.index, ChunkFAISS)
+                or any(vector is None for vector in vectors)
+            ):
+                return [
+                    self._search(query, k, mode, vector)
+                    for query, vector in zip(queries, vectors)
+                ]
+
+            all_vector_docs = self.index.similarity_search_by_vectors(
+                vectors, k=k  # type: ignore
+            )
+            if mode == "vector":
+                return all_vector_docs
+
+            lexical_index = self.build_lexical_index()
+            return [
+                reciprocal_rank_fusion(
+                    [
+                        vector_docs,
+                        [as_document(doc) for doc, _ in lexical_index.search(query, k)],
+                    ],
+                    key=_chunk_key,
+                    k=k,
+                )
+                for query, vector_docs in zip(queries, all_vector_docs)
+            ]
 
     @staticmethod
-    def _combine_files(files: List[File]) -> List[Document]:
-        """Combines all the documents in a list of files into a single list."""
+    def _doc_sources(doc: Any) -> List[str]:
+        """The source of a chunk, then those of the repeats it stands for"""
+        metadata = doc.metadata
+        source = metadata.get("source")
+        if source is None:
+            return []
+        return [source] + metadata.get("duplicates", [])
+
+    def _index_sources(self, file: File) -> None:
+        for doc in file.docs:
+            for source in self._doc_sources(doc):
+                if (file.id, source) in self._chunks_by_source:
+                    continue
+                self._chunks_by_source[(file.id, source)] = doc
+                self._files_by_source.setdefault(source, []).append(file.id)
+
+    def _unindex_sources(self, file: File) -> None:
+        for doc in file.docs:
+            for source in self._doc_sources(doc):
+                if self._chunks_by_source.pop((file.id, source), None) is not None:
+                    self._files_by_source[source].remove(file.id)
+                    if not self._files_by_source[source]:
+                        del self._files_by_source[source]
+
+    def add_duplicates(self, file_id: str, duplicates: Dict[int, List[str]]) -> None:
+        """Records the sources of chunks that were dropped from a file as
+        repeats of its chunks (by position in the file, see
+        `ChunkDeduplicator`), so that citing them finds the kept chunk"""
+        file = next(file for file in self.files if file.id == file_id)
+        docs = file.docs
+        if not isinstance(docs, ChunkSlice) or docs.store is not self.chunks:
+            raise ValueError(f"File {file.name} was not indexed by this index")
 
-        all_texts = []
+        self._unindex_sources(file)
+        for position, sources in duplicates.items():
+            self.chunks.add_duplicates(docs.rows[position], sources)
+        self._index_sources(file)
+
+    def add_files(
+        self, files: List[File], vectors: Optional[np.ndarray] = None
+    ) -> List[File]:
+        """Adds files to the index, embedding only their own chunks.
+        Files that are already in the index (by id) are skipped.
+
+        `vectors` are the embeddings of the chunks of all the files, in order,
+        if they were already computed. Only ChunkFAISS indexes take them.
+
+        Returns the files that were added, as they are stored in the index.
+        """
+
+        if vectors is not None and not isinstance(self.index, ChunkFAISS):
+            raise NotImplementedError(
+                f"Adding vectors to a {type(self.index).__name__} index"
+                " is not supported."
+            )
+
+        indexed_ids = {file.id for file in self.files}
+        added_files = []
+        offset = 0
         for file in files:
-            for doc in file.docs:
-                doc.metadata["file_name"] = file.name
-                doc.metadata["file_id"] = file.id
-                all_texts.append(doc)
+            file_vectors = None
+            if vectors is not None:
+                file_vectors = vectors[offset : offset + len(file.docs)]  # noqa: E203
+                offset += len(file.docs)
+            if file.id in indexed_ids or len(file.docs) == 0:
+                continue
+
+            chunks = self.chunks.extend(file.docs, file_name=file.name, file_id=file.id)
+            if file_vectors is None:
+                self.index.add_documents(chunks)
+            else:
+                self.index.add_documents(chunks, vectors=file_vectors)
+
+            added_file = file.derive(chunks)
+            self.files.append(added_file)
+            self._index_sources(added_file)
+            if self._lexical_index is not None:
+                self._lexical_numbers[file.id] = self._lexical_index.add(chunks)
+            indexed_ids.add(file.id)
+            added_files.append(added_file)
 
-        return all_texts
+        if added_files and isinstance(self.index, ChunkFAISS):
+            # The folder may have grown enough for another index type
+            self.index.optimize()
+
+        return added_files
+
+    def remove_files(self, file_ids: Iterable[str]) -> List[File]:
+        """Removes files from the index by id, deleting their vectors from
+        the vector store. Ids that are not in the index are ignored.
+
+        The texts of removed chunks stay in the chunk store until the folder
+        is rebuilt. Returns the files that were removed.
+        """
+
+        file_ids = set(file_ids)
+        removed_files = [file for file in self.files if file.id in file_ids]
+        if not removed_files:
+            return []
+
+        ids: List[str] = []
+        for file in removed_files:
+            docs = file.docs
+            if not isinstance(docs, ChunkSlice) or docs.store is not self.chunks:
+                raise ValueError(f"File {file.name} was not indexed by this index")
+            ids.extend(str(row) for row in docs.rows)
+        self.index.delete(ids)
+
+        for file in removed_files:
+            self._unindex_sources(file)
+            if self._lexical_index is not None:
+                self._lexical_index.remove(self._lexical_numbers.pop(file.id))
+        self.files = [file for file in self.files if file.id not in file_ids]
+
+        return removed_files
+
+    def save(self, path: str) -> None:
+        """Saves the index to a directory: the vectors, the chunk texts and
+        columns, and the name, id and metadata of every file.
+        Only indexes backed by a ChunkFAISS vector store can be saved."""
+
+        index = self.index
+        if not isinstance(index, ChunkFAISS) or index.chunks is not self.chunks:
+            raise NotImplementedError(
+                f"Saving a {type(self.index).__name__} index is not supported."
+            )
+
+        files = []
+        for file in self.files:
+            docs = file.docs
+            if not isinstance(docs, ChunkSlice) or docs.store is not self.chunks:
+                raise ValueError(f"File {file.name} was not indexed by this index")
+            files.append(
+                {
+                    "class": type(file).__name__,
+                    "name": file.name,
+                    "id": file.id,
+                    "metadata": dict(file.metadata),
+                    "start": docs.rows.start,
+                    "stop": docs.rows.stop,
+                }
+            )
+
+        index.save(path)
+        folder = {"version": FOLDER_FORMAT_VERSION, "name": self.name, "files": files}
+        with open(os.path.join(path, FOLDER_FILE), "w") as f:
+            json.dump(folder, f)
+
+    @classmethod
+    def load(
+        cls, path: str, embeddings: Embeddings, mmap: bool = True
+    ) -> "FolderIndex":
+        """Loads an index saved with `save`.
+
+        With `mmap`, the vectors and chunks are memory-mapped rather than read,
+        so loading is near instant whatever the size of the index and worker
+        processes that load the same directory share one copy of it in the
+        page cache. Files added or removed afterwards are not saved unless
+        `save` is called again.
+        """
+
+        with open(os.path.join(path, FOLDER_FILE)) as f:
+            folder = json.load(f)
+        if folder["version"] != FOLDER_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version {folder['version']}")
+
+        index = ChunkFAISS.load(path, embedding=embeddings, mmap=mmap)
+        files = [
+            get_file_class_by_name(file["class"])(
+                name=file["name"],
+                id=file["id"],
+                metadata=file["metadata"],
+                docs=index.chunks[file["start"] : file["stop"]],  # noqa: E203
+            )
+            for file in folder["files"]
+        ]
+
+        folder_index = cls(
+            files=files, index=index, chunks=index.chunks, embeddings=embeddings
+        )
+        folder_index.name = folder["name"]
+        return folder_index
+
+    def get_chunk(self, file_id: str, source: str) -> Optional[Any]:
+        """Returns the chunk of a file with the given source key, if any"""
+        return self._chunks_by_source.get((file_id, source))
+
+    def get_chunks(self, source: str) -> List[Any]:
+        """Returns the chunks with the given source key in all files,
+        in the order of the files"""
+        return [
+            self._chunks_by_source[(file_id, source)]
+            for file_id in self._files_by_source.get(source, [])
+        ]
+
+    @staticmethod
+    def _combine_files(files: List[File]) -> ChunkStore:
+        """Combines all the documents in a list of files into a single
+        columnar ChunkStore, tagged with the name and id of their file.
+        The documents of the files are left untouched."""
+
+        chunks = ChunkStore()
+        for file in files:
+            chunks.extend(file.docs, file_name=file.name, file_id=file.id)
+        chunks.compact()
+
+        return chunks
 
     @classmethod
     def from_files(
         cls, files: List[File], embeddings: Embeddings, vector_store: Type[VectorStore]
     ) -> "FolderIndex":
-        """Creates an index from files."""
+        """Creates an index from files.
+        The files of the index share their chunks with the combined store
+        instead of keeping a copy of their own."""
 
         all_docs = cls._combine_files(files)
 
@@ -42,33 +433,179 @@ class FolderIndex:
             embedding=embeddings,
         )
 
-        return cls(files=files, index=index)
+        indexed_files = []
+        start = 0
+        for file in files:
+            stop = start + len(file.docs)
+            indexed_files.append(file.derive(all_docs[start:stop]))
+            start = stop
 
+        folder_index = cls(
+            files=indexed_files, index=index, chunks=all_docs, embeddings=embeddings
+        )
+        folder_index.build_lexical_index()
+        return folder_index
 
-def embed_files(
-    files: List[File], embedding: str, vector_store: str, **kwargs
-) -> FolderIndex:
-    """Embeds a collection of files and stores them in a FolderIndex."""
+    @classmethod
+    def from_stream(
+        cls,
+        file: File,
+        docs: Iterable[Document],
+        embeddings: Embeddings,
+        vector_store: Type[VectorStore],
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_pending_batches: int = 2,
+    ) -> "FolderIndex":
+        """Creates an index for a single file from a stream of its documents.
+
+        Batches are embedded and added to the index on a background thread as
+        soon as they fill up, so producing the stream (parsing and chunking)
+        overlaps with the embedding requests. At most `max_pending_batches`
+        batches wait to be embedded at any time. The documents are kept in a
+        ChunkStore as they arrive.
+        """
+
+        chunks = ChunkStore()
+        index: Optional[VectorStore] = None
+
+        def add_batch(batch: ChunkSlice) -> None:
+            nonlocal index
+            if index is None:
+                # Converted once the whole file is in
+                index = vector_store.from_documents(
+                    documents=batch,
+                    embedding=embeddings,
+                    optimize=False,
+                )
+            else:
+                index.add_documents(batch)
+
+        pending: Deque[Future] = deque()
+        # A single worker keeps the batches in order
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for batch in _batched(docs, batch_size):
+                rows = chunks.extend(batch, file_name=file.name, file_id=file.id)
+                pending.append(executor.submit(in_current_context(add_batch), rows))
+
+                if len(pending) > max_pending_batches:
+                    pending.popleft().result()
+
+            for future in pending:
+                future.result()
+
+        if index is None:
+            raise ValueError(f"No text to index in {file.name}")
+
+        chunks.compact()
+        if isinstance(index, ChunkFAISS):
+            # Batches were added to an exact index, convert it now that the
+            # size of the file is known
+            index.optimize()
+
+        folder_index = cls(
+            files=[file.derive(chunks[:])],
+            index=index,
+            chunks=chunks,
+            embeddings=embeddings,
+        )
+        folder_index.build_lexical_index()
+        return folder_index
+
+
+def _chunk_key(doc: Document) -> Tuple[Any, ...]:
+    """Identifies a chunk across rankings by its file and source"""
+    metadata = doc.metadata
+    if "source" in metadata:
+        return (metadata.get("file_id"), metadata["source"])
+    return (metadata.get("file_id"), doc.page_content)
+
+
+def get_embeddings(
+    embedding: str,
+    cache_dir: Optional[str] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    **kwargs,
+) -> Embeddings:
+    """Creates the embedding model with the given name.
+    Documents are embedded in token-sized batches with up to `max_workers`
+    requests in flight (see `ConcurrentEmbeddings`).
+    If `cache_dir` is given, chunk embeddings are persisted there and only
+    chunks that were never embedded before with the same model are sent to
+    the embedding API.
+    "local" runs a sentence embedding model on the CPU instead of calling an
+    API (see `LocalEmbeddings`).
+    """
 
     supported_embeddings: dict[str, Type[Embeddings]] = {
         "openai": OpenAIEmbeddings,
+        "local": LocalEmbeddings,
         "debug": FakeEmbeddings,
     }
-    supported_vector_stores: dict[str, Type[VectorStore]] = {
-        "faiss": FAISS,
-        "debug": FakeVectorStore,
-    }
+
+    if embedding == "openai":
+        # Retries are handled by ConcurrentEmbeddings, per batch
+        kwargs.setdefault("max_retries", 1)
+    elif embedding == "local":
+        # The model already uses all the cores for each batch
+        max_workers = 1
 
     if embedding in supported_embeddings:
         _embeddings = supported_embeddings[embedding](**kwargs)
     else:
         raise NotImplementedError(f"Embedding {embedding} not supported.")
 
+    model = f"{embedding}:{getattr(_embeddings, 'model', embedding)}"
+    _embeddings = ConcurrentEmbeddings(_embeddings, max_workers=max_workers)
+
+    if cache_dir is not None:
+        _embeddings = CachedEmbeddings(
+            _embeddings, cache=get_embedding_cache(cache_dir), model=model
+        )
+
+    return _embeddings
+
+
+def get_vector_store(vector_store: str) -> Type[VectorStore]:
+    """Returns the vector store class with the given name.
+    "faiss" picks the FAISS index type from the size of the folder, the
+    "faiss_<index type>" stores always use the named index type and the
+    "faiss_<precision>" stores compress the vectors to the named precision."""
+
+    supported_vector_stores: dict[str, Type[VectorStore]] = {
+        "faiss": ChunkFAISS,
+        "faiss_flat": FlatFAISS,
+        "faiss_ivf_flat": IVFFlatFAISS,
+        "faiss_hnsw": HNSWFAISS,
+        "faiss_ivf_pq": IVFPQFAISS,
+        "faiss_float16": Float16FAISS,
+        "faiss_int8": Int8FAISS,
+        "debug": FakeVectorStore,
+    }
+
     if vector_store in supported_vector_stores:
-        _vector_store = supported_vector_stores[vector_store]
+        return supported_vector_stores[vector_store]
     else:
         raise NotImplementedError(f"Vector store {vector_store} not supported.")
 
-    return FolderIndex.from_files(
-        files=files, embeddings=_embeddings, vector_store=_vector_store
-    )
+
+def embed_files(
+    files: List[File],
+    embedding: str,
+    vector_store: str,
+    cache_dir: Optional[str] = None,
+    **kwargs,
+) -> FolderIndex:
+    """Embeds a collection of files and stores them in a FolderIndex.
+    If `cache_dir` is given, chunk embeddings are persisted there (see
+    `get_embeddings`).
+    """
+
+    _embeddings = get_embeddings(embedding, cache_dir=cache_dir, **kwargs)
+    _vector_store = get_vector_store(vector_store)
+
+    with timed("embed"):
+        folder_index = FolderIndex.from_files(
+            files=files, embeddings=_embeddings, vector_store=_vector_store
+        )
+    increment("chunks_embedded", len(folder_index.chunks))
+    return folder_index
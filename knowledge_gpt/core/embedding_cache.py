@@ -0,0 +1,246 @@
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from hashlib import sha256
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.instrumentation import increment
+
+# Default size cap of the on-disk cache (1 GiB of raw vector bytes)
+DEFAULT_MAX_SIZE_BYTES = 1 << 30
+
+# Name of the database in a cache directory
+CACHE_FILE = "embeddings.sqlite3"
+
+# Stay well below SQLite's limit on the number of host parameters per query
+_QUERY_BATCH_SIZE = 400
+
+
+def text_hash(text: str) -> str:
+    """Get a content hash for a chunk of text"""
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def _batched(items: Sequence, size: int) -> Iterator[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]  # noqa: E203
+
+
+class EmbeddingCache:
+    """Persistent, content-addressed store of embedding vectors.
+
+    Vectors are keyed by (embedding model, chunk text hash) and kept in a SQLite
+    database so they survive restarts and can be shared by several processes.
+    When the total size of the stored vectors exceeds `max_size_bytes`, the least
+    recently used entries are evicted.
+
+    The size is kept as a running total, read once when the cache is opened,
+    so that writes don't scan the table. Other processes may change the
+    database too, so the total is recomputed before anything is evicted.
+    """
+
+    def __init__(self, path: str | Path, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        path = Path(path)
+        if not path.is_file():
+            # A directory was given, keep the database inside it
+            path.mkdir(parents=True, exist_ok=True)
+            path = path / CACHE_FILE
+
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used"
+            " ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        self._size = self._size_bytes()
+
+    def __reduce__(self):
+        # The connection can't be pickled (e.g. by st.cache_data along with an
+        # index), so unpickling reopens the shared cache for the same path
+        return get_embedding_cache, (str(self.path), self.max_size_bytes)
+
+    def __repr__(self) -> str:
+        return (
+            f"EmbeddingCache(path={self.path}, hits={self.hits},"
+            f" misses={self.misses})"
+        )
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that were served from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def size_bytes(self) -> int:
+        """Total number of bytes taken up by the stored vectors"""
+        with self._lock:
+            return self._size_bytes()
+
+    def _size_bytes(self) -> int:
+        """Sums the size of the stored vectors, scanning the whole table"""
+        (size,) = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        return size
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Looks up the vectors for a list of texts.
+        Returns None in place of every text that is not in the cache.
+        """
+        hashes = [text_hash(text) for text in texts]
+        found: dict[str, List[float]] = {}
+
+        with self._lock:
+            for batch in _batched(list(dict.fromkeys(hashes)), _QUERY_BATCH_SIZE):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    "SELECT text_hash, vector FROM embeddings"
+                    f" WHERE model = ? AND text_hash IN ({placeholders})",
+                    (model, *batch),
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            # Mark the hits as recently used for LRU eviction
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(now, model, key) for key in found],
+            )
+            self._conn.commit()
+
+            vectors = [found.get(key) for key in hashes]
+            hits = sum(vector is not None for vector in vectors)
+            # Counted under the lock, lookups come from several embedding threads
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(
+        self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]
+    ) -> None:
+        """Stores the vectors for a list of texts, evicting old entries if needed."""
+        now = time.time()
+        blobs = {
+            text_hash(text): np.asarray(vector, dtype=np.float32).tobytes()
+            for text, vector in zip(texts, vectors)
+        }
+        with self._lock:
+            # Vectors that are replaced no longer count towards the size
+            replaced = 0
+            for batch in _batched(list(blobs), _QUERY_BATCH_SIZE):
+                placeholders = ",".join("?" * len(batch))
+                (size,) = self._conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+                    f" WHERE model = ? AND text_hash IN ({placeholders})",
+                    (model, *batch),
+                ).fetchone()
+                replaced += size
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings"
+                " (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, key, blob, now) for key, blob in blobs.items()],
+            )
+            self._size += sum(len(blob) for blob in blobs.values()) - replaced
+            if self._size > self.max_size_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Deletes the least recently used entries until the cache fits
+        into `max_size_bytes`."""
+        self._size = self._size_bytes()
+        excess = self._size - self.max_size_bytes
+        if excess <= 0:
+            return
+
+        victims = []
+        cursor = self._conn.execute(
+            "SELECT model, text_hash, LENGTH(vector) FROM embeddings"
+            " ORDER BY last_used ASC"
+        )
+        for model, key, size in cursor:
+            victims.append((model, key))
+            excess -= size
+            self._size -= size
+            if excess <= 0:
+                break
+
+        self._conn.executemany(
+            "DELETE FROM embeddings WHERE model = ? AND text_hash = ?", victims
+        )
+
+    def clear(self) -> None:
+        """Removes every entry from the cache and resets the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache(
+    path: str, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES
+) -> EmbeddingCache:
+    """Returns a shared EmbeddingCache for a path so that connections
+    and hit/miss counters are reused across calls."""
+    return EmbeddingCache(path, max_size_bytes=max_size_bytes)
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding model so that document embeddings are looked up in an
+    EmbeddingCache first and only the texts that were never seen are embedded."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(self.model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        increment("embedding_cache_hits", len(texts) - len(missing))
+        increment("embedding_cache_misses", len(missing))
+
+        if missing:
+            # Identical chunks (e.g. repeated headers) only need to be embedded once
+            new_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_vectors = self.embeddings.embed_documents(new_texts)
+            self.cache.put_many(self.model, new_texts, new_vectors)
+
+            by_text = dict(zip(new_texts, new_vectors))
+            for i in missing:
+                vectors[i] = list(by_text[texts[i]])
+
+        return vectors  # type: ignore
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
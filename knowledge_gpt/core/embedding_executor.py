@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+import openai
+from langchain.embeddings.base import Embeddings
+from tenacity import (
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from knowledge_gpt.core.chunking import get_encoding
+from knowledge_gpt.core.instrumentation import in_current_context, increment
+
+# Number of embedding requests in flight at once
+DEFAULT_MAX_WORKERS = 8
+
+# Batches are filled up to this many tokens (about one model context)...
+DEFAULT_MAX_BATCH_TOKENS = 8000
+
+# ...or this many texts, whichever comes first
+DEFAULT_MAX_BATCH_SIZE = 512
+
+_RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed embedding request should be retried: rate limits (429),
+    server errors (5xx), timeouts and dropped connections"""
+    if isinstance(error, _RETRYABLE_ERRORS):
+        return True
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+class ConcurrentEmbeddings(Embeddings):
+    """Wraps an embedding model so that documents are embedded in batches of
+    about `max_batch_tokens` tokens, with up to `max_workers` requests in flight
+    at once instead of one after another.
+
+    Failed requests are retried with exponential backoff if the error is
+    transient (see `is_retryable`). Vectors are returned in the order of the
+    texts.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_retries: int = 6,
+        min_backoff: float = 1,
+        max_backoff: float = 60,
+        model_name: str = "text-embedding-ada-002",
+    ):
+        self.embeddings = embeddings
+        self.max_workers = max_workers
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.encoding = get_encoding(model_name)
+
+    def _retrying(self) -> Retrying:
+        return Retrying(
+            retry=retry_if_exception(is_retryable),
+            wait=wait_random_exponential(min=self.min_backoff, max=self.max_backoff),
+            stop=stop_after_attempt(self.max_retries),
+            before_sleep=lambda _: increment("embedding_retries"),
+            reraise=True,
+        )
+
+    def _batches(self, texts: List[str]) -> Iterator[List[str]]:
+        """Splits texts into consecutive batches of at most `max_batch_tokens`
+        tokens and `max_batch_size` texts. A text longer than `max_batch_tokens`
+        gets a batch of its own."""
+        token_counts = map(len, self.encoding.encode_ordinary_batch(texts))
+
+        batch: List[str] = []
+        batch_tokens = 0
+        for text, num_tokens in zip(texts, token_counts):
+            if batch and (
+                batch_tokens + num_tokens > self.max_batch_tokens
+                or len(batch) >= self.max_batch_size
+            ):
+                increment("embedding_tokens", batch_tokens)
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += num_tokens
+
+        if batch:
+            increment("embedding_tokens", batch_tokens)
+            yield batch
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        increment("embedding_requests")
+        return self._retrying()(self.embeddings.embed_documents, texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = list(self._batches(texts))
+        if len(batches) <= 1 or self.max_workers <= 1:
+            return [vector for batch in batches for vector in self._embed_batch(batch)]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # map keeps the results in the order of the batches
+            results = executor.map(in_current_context(self._embed_batch), batches)
+            return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._retrying()(self.embeddings.embed_query, text)
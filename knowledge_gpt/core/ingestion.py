@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from typing import Dict, Optional
+
+from knowledge_gpt.core.chunking import iter_chunks
+from knowledge_gpt.core.dedup import ChunkDeduplicator
+from knowledge_gpt.core.embedding import (
+    DEFAULT_BATCH_SIZE,
+    FolderIndex,
+    get_embeddings,
+    get_vector_store,
+)
+from knowledge_gpt.core.instrumentation import increment, timed, timed_iter
+from knowledge_gpt.core.parsing import get_file_id, stream_file
+from knowledge_gpt.core.vector_store import ChunkFAISS
+
+
+def ingest_file(
+    file: BytesIO,
+    chunk_size: int,
+    embedding: str,
+    vector_store: str,
+    chunk_overlap: int = 0,
+    model_name: str = "gpt-3.5-turbo",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cache_dir: Optional[str] = None,
+    num_workers: int = 1,
+    index_dir: Optional[str] = None,
+    deduplicate: bool = True,
+    near_duplicates: bool = False,
+    **kwargs,
+) -> FolderIndex:
+    """Reads, chunks and embeds an uploaded file as a single stream.
+
+    Pages are parsed lazily and chunked as they are read, and every batch of
+    `batch_size` chunks is sent to the embedding model as soon as it fills up.
+    Only the chunks (not the parsed pages) are kept in memory, and parsing
+    overlaps with the embedding requests.
+
+    If `index_dir` is given, the index is saved there and loaded (memory-mapped)
+    instead of being built again the next time the same file is ingested with
+    the same settings, also from another process.
+
+    With `deduplicate`, chunks that repeat an earlier chunk of the file (like
+    headers and footers) are not embedded, citing them finds the chunk they
+    repeat. Only exact repeats are dropped unless `near_duplicates` is set.
+
+    Returns a FolderIndex whose only file holds the chunked documents.
+    """
+
+    embeddings = get_embeddings(embedding, cache_dir=cache_dir, **kwargs)
+
+    index_path = None
+    if index_dir is not None:
+        index_key = "-".join(
+            [get_file_id(file), embedding, vector_store]
+            + [str(chunk_size), str(chunk_overlap), model_name]
+            + (["exact-dedup"] if deduplicate else [])
+            + (["near-dup"] if deduplicate and near_duplicates else [])
+        )
+        index_path = os.path.join(index_dir, index_key)
+        if os.path.exists(index_path):
+            with timed("load_index"):
+                return FolderIndex.load(index_path, embeddings=embeddings)
+
+    chunked_file, pages = stream_file(file, num_workers=num_workers)
+    # Parsing and chunking happen as the embedding stage pulls chunks, and
+    # are timed apart from it
+    chunks = timed_iter(
+        "chunk",
+        iter_chunks(
+            timed_iter("parse", pages, counter="pages_parsed"),
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            model_name=model_name,
+        ),
+        counter="chunks",
+    )
+    deduplicator = ChunkDeduplicator(near_duplicates=near_duplicates)
+    if deduplicate:
+        chunks = deduplicator.filter(chunks)
+
+    with timed("embed"):
+        folder_index = FolderIndex.from_stream(
+            file=chunked_file,
+            docs=chunks,
+            embeddings=embeddings,
+            vector_store=get_vector_store(vector_store),
+            batch_size=batch_size,
+        )
+    increment("chunks_embedded", len(folder_index.chunks))
+    if deduplicator.duplicates:
+        folder_index.add_duplicates(chunked_file.id, deduplicator.duplicates)
+
+    if index_path is not None and isinstance(folder_index.index, ChunkFAISS):
+        # Save next to the final path and move it in place, so that other
+        # processes never load a partially written index
+        os.makedirs(index_dir, exist_ok=True)  # type: ignore
+        tmp_path = tempfile.mkdtemp(dir=index_dir)
+        with timed("save_index"):
+            folder_index.save(tmp_path)
+        try:
+            os.rename(tmp_path, index_path)
+        except OSError:
+            # Another process saved the same index first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return folder_index
+
+
+def save_folder_index(
+    folder_index: FolderIndex, path: str, extra_files: Optional[Dict[str, str]] = None
+) -> None:
+    """Saves a folder index to a directory, replacing the index saved there.
+
+    The index (and `extra_files`, a text by file name) is written next to
+    `path` and swapped in, so that a crash never leaves a partially written
+    index behind. Processes that memory-mapped the replaced index can keep
+    reading it.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+
+    with timed("save_index"):
+        tmp_path = tempfile.mkdtemp(dir=parent)
+        folder_index.save(tmp_path)
+        for name, text in (extra_files or {}).items():
+            with open(os.path.join(tmp_path, name), "w") as f:
+                f.write(text)
+
+        old_path = None
+        if os.path.exists(path):
+            old_path = tempfile.mkdtemp(dir=parent)
+            os.rename(path, os.path.join(old_path, "index"))
+        os.rename(tmp_path, path)
+        if old_path is not None:
+            # Memory-mapped files stay readable after they are deleted
+            shutil.rmtree(old_path, ignore_errors=True)
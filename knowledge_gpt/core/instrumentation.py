@@ -0,0 +1,338 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Prefix of the names of all exported metrics
+METRIC_PREFIX = "knowledge_gpt"
+
+# Upper bounds in seconds of the buckets of the duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Number of finished operations kept for the debug panel
+MAX_RECENT_TRACES = 50
+
+
+class Trace:
+    """Timings and counters of one operation, like ingesting a file or
+    answering a query.
+
+    Stage durations are exclusive: the time spent in a stage nested in another
+    (e.g. parsing pages while they are being embedded) is only counted in the
+    inner stage, so the stages of an operation add up to about its duration.
+    """
+
+    def __init__(self, name: str, **labels: str):
+        self.name = name
+        self.labels = labels
+        self.started = time.time()
+        self.seconds: Optional[float] = None
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"Trace(name={self.name}, seconds={self.seconds}, stages={self.stages})"
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def activate(self) -> Iterator["Trace"]:
+        """Makes this the trace that stages and counters are recorded in"""
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def finish(self) -> None:
+        """Records the end of the operation, in the metrics and the log"""
+        if self.seconds is not None:
+            return
+        self.seconds = time.perf_counter() - self._start
+        get_metrics().record_trace(self)
+        logger.info(json.dumps(self.to_dict()))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "operation": self.name,
+            **self.labels,
+            "started": self.started,
+            "seconds": self.seconds,
+            "stages": dict(self.stages),
+            "counters": dict(self.counters),
+        }
+
+
+class _Span:
+    """Time spent in the stages nested in a running stage"""
+
+    __slots__ = ("child_seconds",)
+
+    def __init__(self):
+        self.child_seconds = 0.0
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[_Span]] = ContextVar("span", default=None)
+
+
+def _labels_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(DURATION_BUCKETS, value)
+        if i < len(self.buckets):
+            self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Process-wide counters and duration histograms, exported in the
+    Prometheus text format, plus the most recent traces."""
+
+    def __init__(self, max_recent_traces: int = MAX_RECENT_TRACES):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._durations: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _Histogram] = {}
+        self.recent_traces: Deque[Trace] = deque(maxlen=max_recent_traces)
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if key not in self._durations:
+                self._durations[key] = _Histogram()
+            self._durations[key].observe(seconds)
+
+    def record_trace(self, trace: Trace) -> None:
+        self.observe("operation", trace.seconds or 0.0, operation=trace.name)
+        with self._lock:
+            self.recent_traces.append(trace)
+
+    def get_counter(self, name: str, **labels: str) -> float:
+        return self._counters.get((name, _labels_key(labels)), 0)
+
+    def last_trace(self, name: str) -> Optional[Trace]:
+        """The most recent finished trace of an operation"""
+        with self._lock:
+            for trace in reversed(self.recent_traces):
+                if trace.name == name:
+                    return trace
+        return None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._durations.clear()
+            self.recent_traces.clear()
+
+    def to_prometheus(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            durations = sorted(
+                (key, (list(h.buckets), h.count, h.sum))
+                for key, h in self._durations.items()
+            )
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+
+        for (name, labels), (buckets, count, total) in durations:
+            metric = f"{METRIC_PREFIX}_{name}_seconds"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            cumulative = 0
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(labels + (("le", f"{bound:g}"),))
+                lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+            inf_labels = _format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{metric}_bucket{inf_labels} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total:g}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> Metrics:
+    """Returns the metrics shared by all the sessions of the app"""
+    return Metrics()
+
+
+@contextmanager
+def trace(name: str, **labels: str) -> Iterator[Trace]:
+    """Records the stages and counters of an operation in a new Trace"""
+    operation = Trace(name, **labels)
+    with operation.activate():
+        try:
+            yield operation
+        finally:
+            operation.finish()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def increment(name: str, value: float = 1) -> None:
+    """Adds to a counter of the metrics and of the current trace"""
+    get_metrics().increment(name, value)
+    operation = _current_trace.get()
+    if operation is not None:
+        operation.increment(name, value)
+
+
+@contextmanager
+def timed(stage: str, operation: Optional[Trace] = None) -> Iterator[None]:
+    """Times a stage, excluding the stages nested in it. The time is recorded
+    in the metrics and in `operation`, the current trace by default."""
+    if operation is None:
+        operation = _current_trace.get()
+    parent = _current_span.get()
+    span = _Span()
+    token = _current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        if parent is not None:
+            parent.child_seconds += elapsed
+
+        seconds = max(elapsed - span.child_seconds, 0.0)
+        get_metrics().observe("stage", seconds, stage=stage)
+        if operation is not None:
+            operation.add_time(stage, seconds)
+
+
+def timed_iter(
+    stage: str,
+    iterable: Iterable[T],
+    counter: Optional[str] = None,
+    operation: Optional[Trace] = None,
+) -> Iterator[T]:
+    """Times the production of the items of an iterable as a stage (the time
+    the consumer spends on an item is not counted) and counts the items in
+    `counter`. The trace is the one current when this is called, so the items
+    may be consumed elsewhere."""
+    if operation is None:
+        operation = _current_trace.get()
+    iterator = iter(iterable)
+    while True:
+        with timed(stage, operation):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        if counter is not None:
+            get_metrics().increment(counter)
+            if operation is not None:
+                operation.increment(counter)
+        yield item
+
+
+def in_current_context(func: Callable[..., T]) -> Callable[..., T]:
+    """Wraps a function so that it records into the current trace when it is
+    called on another thread (e.g. by an executor)"""
+    context = copy_context()
+
+    def run_detached(*args: Any, **kwargs: Any) -> T:
+        # Stages on another thread overlap with the caller's instead of being
+        # nested in them, so they are not subtracted from its time
+        _current_span.set(None)
+        return func(*args, **kwargs)
+
+    def run(*args: Any, **kwargs: Any) -> T:
+        # Each call gets its own copy, a context can't run on two threads at once
+        return context.copy().run(run_detached, *args, **kwargs)
+
+    return run
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+@lru_cache(maxsize=None)
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serves the metrics at http://host:port/metrics for Prometheus to scrape,
+    on a background thread. The server is started once per process and port."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
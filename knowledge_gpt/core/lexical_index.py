@@ -0,0 +1,138 @@
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Any, Dict, Hashable, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+# Words, and identifiers made of words joined by "-", ".", "/" or "_"
+# (e.g. part numbers like "AB-1234/5" or clause ids like "4.2.1")
+_TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+_PART_PATTERN = re.compile(r"[^\W_]+")
+
+# Rank offset of reciprocal rank fusion
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into lowercase terms. Identifiers are kept whole and
+    their parts are added as terms of their own, so "AB-1234" matches both
+    "ab-1234" and "1234"."""
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = _PART_PATTERN.findall(token)
+        if len(parts) > 1 or (parts and parts[0] != token):
+            terms.extend(parts)
+    return terms
+
+
+class BM25Index:
+    """In-memory inverted index that ranks documents with Okapi BM25.
+
+    Postings are kept in compact arrays of document numbers and term
+    frequencies, and a query is scored with a few vectorized operations per
+    query term. Documents are kept by reference and returned as they were
+    added (e.g. ChunkViews).
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: List[Any] = []
+        self._lengths = array("I")
+        self._alive = array("b")
+        self._num_alive = 0
+        self._total_length = 0
+        self._postings: Dict[str, Tuple[array, array]] = {}
+
+    def __len__(self) -> int:
+        return self._num_alive
+
+    def add(self, docs: Iterable[Any]) -> range:
+        """Indexes documents (anything with a `page_content`) and returns
+        their numbers in the index"""
+        start = len(self._docs)
+        for doc in docs:
+            number = len(self._docs)
+            terms = tokenize(doc.page_content)
+
+            self._docs.append(doc)
+            self._lengths.append(len(terms))
+            self._alive.append(1)
+            self._num_alive += 1
+            self._total_length += len(terms)
+
+            for term, frequency in Counter(terms).items():
+                if term not in self._postings:
+                    self._postings[term] = (array("I"), array("I"))
+                numbers, frequencies = self._postings[term]
+                numbers.append(number)
+                frequencies.append(frequency)
+
+        return range(start, len(self._docs))
+
+    def remove(self, numbers: Iterable[int]) -> None:
+        """Removes documents by number. Their postings are skipped when
+        scoring rather than deleted."""
+        for number in numbers:
+            if self._alive[number]:
+                self._alive[number] = 0
+                self._num_alive -= 1
+                self._total_length -= self._lengths[number]
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[Any, float]]:
+        """Returns the k documents with the highest BM25 score for the query,
+        with their scores. Documents that share no term with the query are
+        not returned."""
+        if self._num_alive == 0:
+            return []
+
+        alive = np.frombuffer(self._alive, dtype=np.int8).astype(bool)
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        average_length = max(self._total_length / self._num_alive, 1.0)
+        scores = np.zeros(len(self._docs), dtype=np.float64)
+
+        for term in set(tokenize(query)):
+            if term not in self._postings:
+                continue
+            numbers, frequencies = self._postings[term]
+            numbers_np = np.frombuffer(numbers, dtype=np.uint32)
+            live = alive[numbers_np]
+            numbers_np = numbers_np[live]
+            if len(numbers_np) == 0:
+                continue
+            tf = np.frombuffer(frequencies, dtype=np.uint32)[live].astype(np.float64)
+
+            df = len(numbers_np)
+            idf = math.log(1 + (self._num_alive - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (
+                1 - self.b + self.b * lengths[numbers_np] / average_length
+            )
+            scores[numbers_np] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self._docs[i], float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Any]], key: Any, k: int = 4
+) -> List[Any]:
+    """Fuses several rankings of documents into one with reciprocal rank fusion.
+    `key` maps a document to the identity it is matched on across rankings.
+    The first ranking a document appears in provides the returned object."""
+    scores: Dict[Hashable, float] = {}
+    docs: Dict[Hashable, Any] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            doc_key = key(doc)
+            scores[doc_key] = scores.get(doc_key, 0.0) + 1 / (RRF_K + rank + 1)
+            docs.setdefault(doc_key, doc)
+
+    best = sorted(scores, key=scores.__getitem__, reverse=True)[:k]
+    return [docs[doc_key] for doc_key in best]
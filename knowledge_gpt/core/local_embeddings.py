@@ -0,0 +1,170 @@
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# A small sentence embedding model (384 dimensions) with an int8 quantized
+# ONNX export, run on the CPU
+DEFAULT_LOCAL_MODEL = "Xenova/all-MiniLM-L6-v2"
+DEFAULT_ONNX_FILE = "onnx/model_quantized.onnx"
+
+# Longer texts are truncated, the model was trained on inputs of this length
+DEFAULT_MAX_LENGTH = 256
+
+# Texts of similar lengths are batched together, up to this many texts...
+DEFAULT_LOCAL_BATCH_SIZE = 64
+
+# ...or this many tokens including padding, whichever comes first
+DEFAULT_LOCAL_BATCH_TOKENS = 8192
+
+
+def mean_pool(hidden_states: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """Averages the token vectors of each text, ignoring the padding.
+    `hidden_states` has shape (texts, tokens, dimensions) and `attention_mask`
+    (texts, tokens)."""
+    mask = attention_mask.astype(hidden_states.dtype)
+    summed = np.einsum("btd,bt->bd", hidden_states, mask)
+    counts = np.maximum(mask.sum(axis=1, keepdims=True), 1e-9)
+    return summed / counts
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scales vectors to unit length, so that inner products are cosines"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def length_batches(
+    lengths: Sequence[int], max_batch_size: int, max_batch_tokens: int
+) -> List[np.ndarray]:
+    """Groups texts of similar lengths so that little of a batch is padding.
+
+    Returns the indices of the texts of each batch. A batch holds at most
+    `max_batch_size` texts and, once padded to its longest text, at most
+    `max_batch_tokens` tokens (a single longer text gets a batch of its own).
+    """
+    order = np.argsort(np.asarray(lengths), kind="stable")
+    batches = []
+    start = 0
+    for i in range(1, len(order) + 1):
+        size = i - start
+        # The texts are sorted, the last one sets the padded length
+        if i < len(order) and (
+            size < max_batch_size and (size + 1) * lengths[order[i]] <= max_batch_tokens
+        ):
+            continue
+        batches.append(order[start:i])
+        start = i
+    return batches
+
+
+@lru_cache(maxsize=None)
+def get_local_model(
+    model_name: str, onnx_file: str, num_threads: int
+) -> Tuple[Any, Any]:
+    """Loads the tokenizer and the ONNX inference session of a model, once per
+    process. The files are downloaded from the Hugging Face Hub the first
+    time, or read from `model_name` if it is a local directory."""
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError(
+            "Could not import onnxruntime python package, which local "
+            "embeddings need. Please install it with `poetry install --extras "
+            "local` or `pip install onnxruntime`."
+        )
+    from transformers import AutoTokenizer
+
+    if os.path.isdir(model_name):
+        model_path = os.path.join(model_name, onnx_file)
+    else:
+        from huggingface_hub import hf_hub_download
+
+        model_path = hf_hub_download(model_name, onnx_file)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(
+        model_path, options, providers=["CPUExecutionProvider"]
+    )
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return tokenizer, session
+
+
+class LocalEmbeddings(Embeddings):
+    """Embeds texts on the CPU with a sentence embedding model exported to
+    ONNX, no API calls involved.
+
+    The texts are tokenized at once, sorted by length and run through the
+    model in batches padded to their longest text. The vectors are the
+    normalized mean of the token vectors, like sentence-transformers does.
+    """
+
+    def __init__(
+        self,
+        model: str = DEFAULT_LOCAL_MODEL,
+        onnx_file: str = DEFAULT_ONNX_FILE,
+        num_threads: int = os.cpu_count() or 1,
+        max_length: int = DEFAULT_MAX_LENGTH,
+        max_batch_size: int = DEFAULT_LOCAL_BATCH_SIZE,
+        max_batch_tokens: int = DEFAULT_LOCAL_BATCH_TOKENS,
+    ):
+        self.model = model
+        self.onnx_file = onnx_file
+        self.num_threads = num_threads
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.tokenizer, self.session = get_local_model(model, onnx_file, num_threads)
+        self._input_names = {input.name for input in self.session.get_inputs()}
+
+    def _run(self, input_ids: List[List[int]]) -> np.ndarray:
+        """Embeds one batch of tokenized texts"""
+        width = max(len(ids) for ids in input_ids)
+        lengths = np.array([len(ids) for ids in input_ids])
+        attention_mask = (np.arange(width)[None, :] < lengths[:, None]).astype(np.int64)
+        padded = np.full(
+            (len(input_ids), width), self.tokenizer.pad_token_id or 0, dtype=np.int64
+        )
+        padded[attention_mask.astype(bool)] = np.concatenate(input_ids)
+
+        inputs: Dict[str, np.ndarray] = {
+            "input_ids": padded,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(padded),
+        }
+        hidden_states = self.session.run(
+            None, {name: inputs[name] for name in self._input_names}
+        )[0]
+        return normalize(mean_pool(hidden_states, attention_mask))
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        """Embeds texts into a (texts, dimensions) float32 array"""
+        input_ids = self.tokenizer(texts, truncation=True, max_length=self.max_length)[
+            "input_ids"
+        ]
+        lengths = [len(ids) for ids in input_ids]
+
+        vectors = None
+        for batch in length_batches(
+            lengths, self.max_batch_size, self.max_batch_tokens
+        ):
+            batch_vectors = self._run([input_ids[i] for i in batch])
+            if vectors is None:
+                vectors = np.empty(
+                    (len(texts), batch_vectors.shape[1]), dtype=np.float32
+                )
+            vectors[batch] = batch_vectors
+        if vectors is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
@@ -1,15 +1,29 @@
 from io import BytesIO
-from typing import List, Any, Optional
+from typing import (
+    Any,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+from collections import ChainMap
 import re
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 import docx2txt
 from langchain.docstore.document import Document
 import fitz
-from hashlib import md5
+from hashlib import blake2b
 
 from abc import abstractmethod, ABC
 from copy import deepcopy
 
+from knowledge_gpt.core.instrumentation import increment, timed
+
 
 class File(ABC):
     """Represents an uploaded file comprised of Documents"""
@@ -18,12 +32,12 @@ class File(ABC):
         self,
         name: str,
         id: str,
-        metadata: Optional[dict[str, Any]] = None,
-        docs: Optional[List[Document]] = None,
+        metadata: Optional[MutableMapping[str, Any]] = None,
+        docs: Optional[Sequence[Document]] = None,
     ):
         self.name = name
         self.id = id
-        self.metadata = metadata or {}
+        self.metadata: MutableMapping[str, Any] = metadata or {}
         self.docs = docs or []
 
     @classmethod
@@ -31,6 +45,11 @@ class File(ABC):
     def from_bytes(cls, file: BytesIO) -> "File":
         """Creates a File from a BytesIO object"""
 
+    @classmethod
+    def iter_pages(cls, file: BytesIO) -> Iterator[Document]:
+        """Lazily yields the pages of a BytesIO object as Documents"""
+        yield from cls.from_bytes(file).docs
+
     def __repr__(self) -> str:
         return (
             f"File(name={self.name}, id={self.id},"
@@ -49,6 +68,19 @@ class File(ABC):
             docs=deepcopy(self.docs),
         )
 
+    def derive(self, docs: Sequence[Any]) -> "File":
+        """Create a File derived from this one (e.g. chunked or filtered)
+        with the given docs.
+
+        Nothing is copied: the docs are used as they are, and the metadata is
+        a copy-on-write view of this file's metadata, so writing to it never
+        changes this file. Documents may be shared between files and must be
+        treated as immutable.
+        """
+        derived = self.__class__(name=self.name, id=self.id, docs=docs)
+        derived.metadata = ChainMap({}, self.metadata)
+        return derived
+
 
 def strip_consecutive_newlines(text: str) -> str:
     """Strips consecutive newlines from a string
@@ -57,52 +89,199 @@ def strip_consecutive_newlines(text: str) -> str:
     return re.sub(r"\s*\n\s*", "\n", text)
 
 
+def hash_contents(file: BytesIO) -> str:
+    """Hashes the whole contents of a file without moving its position"""
+    # getvalue() returns the bytes a BytesIO was created with, without a copy
+    return blake2b(file.getvalue(), digest_size=16).hexdigest()
+
+
+def get_file_id(file: BytesIO) -> str:
+    """Get a unique id for the contents of an uploaded file.
+
+    The contents are hashed the first time only: the id is memoized in the
+    `content_id` attribute of the file, which must not be modified afterwards.
+    """
+    file_id = getattr(file, "content_id", None)
+    if file_id is None:
+        file_id = hash_contents(file)
+        file.content_id = file_id  # type: ignore
+    return file_id
+
+
 class DocxFile(File):
     @classmethod
     def from_bytes(cls, file: BytesIO) -> "DocxFile":
+        docs = list(cls.iter_pages(file))
+        return cls(name=file.name, id=get_file_id(file), docs=docs)
+
+    @classmethod
+    def iter_pages(cls, file: BytesIO) -> Iterator[Document]:
         text = docx2txt.process(file)
+        # Reading the zip moves the file position, which can affect caching
+        file.seek(0)
         text = strip_consecutive_newlines(text)
         doc = Document(page_content=text.strip())
         doc.metadata["source"] = "p-1"
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
+        yield doc
+
+
+# Minimum number of pages each worker process should get when extracting
+# a PDF in parallel. Below this, process startup outweighs the speedup.
+MIN_PAGES_PER_WORKER = 16
+
+# Bytes of the PDF being extracted, set once in every worker process
+_worker_pdf_bytes: bytes = b""
+
+
+def _init_pdf_worker(pdf_bytes: bytes) -> None:
+    global _worker_pdf_bytes
+    _worker_pdf_bytes = pdf_bytes
+
+
+def _extract_pdf_texts(pdf: fitz.Document, start: int, stop: int) -> List[str]:
+    """Extracts the cleaned up text of the pages in [start, stop)"""
+    texts = []
+    for i in range(start, stop):
+        text = pdf[i].get_text(sort=True)
+        text = strip_consecutive_newlines(text)
+        texts.append(text.strip())
+    return texts
+
+
+def _extract_pdf_range(page_range: Tuple[int, int]) -> List[str]:
+    """Worker task: opens the shared PDF bytes and extracts a range of pages"""
+    with fitz.open(stream=_worker_pdf_bytes, filetype="pdf") as pdf:  # type: ignore
+        return _extract_pdf_texts(pdf, *page_range)
+
+
+def _iter_pdf_texts_parallel(
+    pdf_bytes: bytes, page_count: int, num_workers: int
+) -> Iterator[str]:
+    """Extracts the text of every page, spreading page ranges over a process pool.
+    The PDF bytes are sent to each worker once, when the pool starts.
+    Texts are yielded in page order as soon as their range is done.
+    """
+    # Use a few ranges per worker so that uneven pages balance out
+    num_ranges = min(page_count, num_workers * 4)
+    bounds = [page_count * i // num_ranges for i in range(num_ranges + 1)]
+    page_ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    # Workers are spawned rather than forked: the caller may be a
+    # multithreaded server, and forking while other threads hold locks can
+    # deadlock the children
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_pdf_worker,
+        initargs=(pdf_bytes,),
+    ) as executor:
+        # map preserves the order of the page ranges
+        for texts in executor.map(_extract_pdf_range, page_ranges):
+            yield from texts
+
+
+def _iter_pdf_texts(pdf_bytes: bytes, num_workers: int = 1) -> Iterator[str]:
+    """Lazily extracts the text of every page of a PDF"""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:  # type: ignore
+        page_count = pdf.page_count
+        num_workers = min(num_workers, page_count // MIN_PAGES_PER_WORKER)
+        if num_workers > 1:
+            yield from _iter_pdf_texts_parallel(pdf_bytes, page_count, num_workers)
+        else:
+            for i in range(page_count):
+                yield from _extract_pdf_texts(pdf, i, i + 1)
 
 
 class PdfFile(File):
     @classmethod
-    def from_bytes(cls, file: BytesIO) -> "PdfFile":
-        pdf = fitz.open(stream=file.read(), filetype="pdf")  # type: ignore
-        docs = []
-        for i, page in enumerate(pdf):
-            text = page.get_text(sort=True)
-            text = strip_consecutive_newlines(text)
-            doc = Document(page_content=text.strip())
-            doc.metadata["page"] = i + 1
-            doc.metadata["source"] = f"p-{i+1}"
-            docs.append(doc)
-        # file.read() mutates the file object, which can affect caching
-        # so we need to reset the file pointer to the beginning
-        file.seek(0)
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=docs)
+    def from_bytes(cls, file: BytesIO, num_workers: int = 1) -> "PdfFile":
+        """Creates a PdfFile from a BytesIO object. If `num_workers` is greater
+        than 1, large PDFs are extracted in parallel by that many processes.
+        """
+        # getvalue() neither copies the bytes nor moves the file position,
+        # which could affect caching
+        pdf_bytes = file.getvalue()
+        docs = [
+            cls._page_to_doc(i, text)
+            for i, text in enumerate(_iter_pdf_texts(pdf_bytes, num_workers))
+        ]
+        return cls(name=file.name, id=get_file_id(file), docs=docs)
+
+    @classmethod
+    def iter_pages(cls, file: BytesIO, num_workers: int = 1) -> Iterator[Document]:
+        pdf_bytes = file.getvalue()
+        for i, text in enumerate(_iter_pdf_texts(pdf_bytes, num_workers)):
+            yield cls._page_to_doc(i, text)
+
+    @staticmethod
+    def _page_to_doc(i: int, text: str) -> Document:
+        doc = Document(page_content=text)
+        doc.metadata["page"] = i + 1
+        doc.metadata["source"] = f"p-{i+1}"
+        return doc
 
 
 class TxtFile(File):
     @classmethod
     def from_bytes(cls, file: BytesIO) -> "TxtFile":
-        text = file.read().decode("utf-8", errors="replace")
+        docs = list(cls.iter_pages(file))
+        return cls(name=file.name, id=get_file_id(file), docs=docs)
+
+    @classmethod
+    def iter_pages(cls, file: BytesIO) -> Iterator[Document]:
+        text = file.getvalue().decode("utf-8", errors="replace")
         text = strip_consecutive_newlines(text)
-        file.seek(0)
         doc = Document(page_content=text.strip())
         doc.metadata["source"] = "p-1"
-        return cls(name=file.name, id=md5(file.read()).hexdigest(), docs=[doc])
+        yield doc
+
+
+def get_file_class(file_name: str) -> Type[File]:
+    """Returns the File subclass that can read a file with the given name"""
+    if file_name.lower().endswith(".docx"):
+        return DocxFile
+    elif file_name.lower().endswith(".pdf"):
+        return PdfFile
+    elif file_name.lower().endswith(".txt"):
+        return TxtFile
+    else:
+        raise NotImplementedError(f"File type {file_name.split('.')[-1]} not supported")
+
 
+def get_file_class_by_name(class_name: str) -> Type[File]:
+    """Returns the File subclass with the given class name"""
+    subclasses = list(File.__subclasses__())
+    while subclasses:
+        file_cls = subclasses.pop()
+        if file_cls.__name__ == class_name:
+            return file_cls
+        subclasses.extend(file_cls.__subclasses__())
+    raise NotImplementedError(f"File class {class_name} not supported")
 
-def read_file(file: BytesIO) -> File:
-    """Reads an uploaded file and returns a File object"""
-    if file.name.lower().endswith(".docx"):
-        return DocxFile.from_bytes(file)
-    elif file.name.lower().endswith(".pdf"):
-        return PdfFile.from_bytes(file)
-    elif file.name.lower().endswith(".txt"):
-        return TxtFile.from_bytes(file)
+
+def read_file(file: BytesIO, num_workers: int = 1) -> File:
+    """Reads an uploaded file and returns a File object.
+    `num_workers` is the number of processes used to extract large PDFs.
+    """
+    file_cls = get_file_class(file.name)
+    with timed("parse"):
+        if file_cls is PdfFile:
+            parsed = PdfFile.from_bytes(file, num_workers=num_workers)
+        else:
+            parsed = file_cls.from_bytes(file)
+    increment("pages_parsed", len(parsed.docs))
+    return parsed
+
+
+def stream_file(file: BytesIO, num_workers: int = 1) -> Tuple[File, Iterator[Document]]:
+    """Reads an uploaded file lazily.
+    Returns a File without any docs and an iterator that yields its pages
+    one at a time as they are parsed.
+    `num_workers` is the number of processes used to extract large PDFs.
+    """
+    file_cls = get_file_class(file.name)
+    if file_cls is PdfFile:
+        pages = PdfFile.iter_pages(file, num_workers=num_workers)
     else:
-        raise NotImplementedError(f"File type {file.name.split('.')[-1]} not supported")
+        pages = file_cls.iter_pages(file)
+    return file_cls(name=file.name, id=get_file_id(file)), pages
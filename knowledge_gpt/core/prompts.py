@@ -29,3 +29,16 @@ FINAL ANSWER:"""
 STUFF_PROMPT = PromptTemplate(
     template=template, input_variables=["summaries", "question"]
 )
+
+## Map step of the map-reduce chain, whose answers are combined with STUFF_PROMPT
+map_template = """Extract the information relevant to the question from the provided document excerpts. Summarize it in a few sentences and ALWAYS end with a "SOURCES" section citing only the sources the information came from. If none of the excerpts are relevant to the question, leave both the summary and the SOURCES section empty. Use only the provided documents and do not attempt to fabricate information.
+
+QUESTION: {question}
+=========
+{summaries}
+=========
+RELEVANT INFORMATION:"""
+
+MAP_PROMPT = PromptTemplate(
+    template=map_template, input_variables=["summaries", "question"]
+)
@@ -1,10 +1,59 @@
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from queue import Queue
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains.base import Chain
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from knowledge_gpt.core.prompts import STUFF_PROMPT
+from langchain.chat_models.base import BaseChatModel
 from langchain.docstore.document import Document
-from knowledge_gpt.core.embedding import FolderIndex
+from langchain.prompts import BasePromptTemplate
+from langchain.schema import BaseMessage, LLMResult
 from pydantic import BaseModel
-from langchain.chat_models.base import BaseChatModel
+
+from knowledge_gpt.core.answer_cache import AnswerCache
+from knowledge_gpt.core.chunk_store import as_document
+from knowledge_gpt.core.chunking import get_encoding
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.instrumentation import (
+    in_current_context,
+    increment,
+    timed,
+    timed_iter,
+)
+from knowledge_gpt.core.prompts import MAP_PROMPT, STUFF_PROMPT
+from knowledge_gpt.core.utils import get_context_budget, group_docs, pack_docs
+
+# Separates the answer from the sources it cites in the model output
+SOURCES_MARKER = "SOURCES: "
+
+# Number of chunks retrieved for a query, of which as many as fit into the
+# context window of the model are given to it
+NUM_RETRIEVED_DOCS = 20
+
+# Largest prompt sent to answer a query by default, about five chunks. The
+# cost and latency of a query grow with its prompt, so the window of a large
+# model is only filled if this is raised (or None).
+DEFAULT_MAX_CONTEXT_TOKENS = 2000
+
+# How the answer is generated from the retrieved chunks: "stuff" puts as many
+# as fit into one prompt, "map_reduce" extracts what is relevant from groups of
+# many more chunks in parallel, then answers from the extracts
+CHAIN_TYPES = ["stuff", "map_reduce"]
+
+# Number of chunks retrieved for a query answered with map-reduce
+NUM_MAP_REDUCE_DOCS = 100
+
+# Largest prompt of a map step. Smaller groups make more, shorter LLM calls,
+# which run at the same time.
+MAP_GROUP_TOKENS = 3000
+
+# Number of LLM calls made at once by default, by `query_folder_batch` and by
+# the map step of a map-reduce query
+DEFAULT_MAX_CONCURRENCY = 4
 
 
 class AnswerWithSources(BaseModel):
@@ -12,11 +61,278 @@ class AnswerWithSources(BaseModel):
     sources: List[Document]
 
 
+def _tokenizer_model(llm: BaseChatModel) -> str:
+    """Name of the model whose tokenizer counts the tokens of an LLM"""
+    model_name = getattr(llm, "model_name", "debug")
+    return model_name if model_name != "debug" else "gpt-3.5-turbo"
+
+
+class _UsageHandler(BaseCallbackHandler):
+    """Counts the prompt and completion tokens of the LLM calls of a chain.
+    Uses the usage reported by the API if there is one (it is not reported
+    when streaming), and counts the tokens with tiktoken otherwise."""
+
+    def __init__(self, model_name: str):
+        self.encoding = get_encoding(model_name)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_chat_model_start(
+        self,
+        serialized: dict[str, Any],
+        messages: List[List[BaseMessage]],
+        **kwargs: Any,
+    ) -> None:
+        texts = [message.content for prompt in messages for message in prompt]
+        self.prompt_tokens = sum(map(len, self.encoding.encode_ordinary_batch(texts)))
+        self.completion_tokens = 0
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.completion_tokens += 1
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+        completion_tokens = usage.get("completion_tokens", self.completion_tokens)
+        if not usage and not completion_tokens:
+            texts = [
+                g.text for generations in response.generations for g in generations
+            ]
+            completion_tokens = sum(
+                map(len, self.encoding.encode_ordinary_batch(texts))
+            )
+
+        increment("llm_requests")
+        increment("llm_prompt_tokens", prompt_tokens)
+        increment("llm_completion_tokens", completion_tokens)
+
+
+def _get_chain(
+    llm: BaseChatModel, prompt: BasePromptTemplate = STUFF_PROMPT
+) -> StuffDocumentsChain:
+    return load_qa_with_sources_chain(  # type: ignore
+        llm=llm,
+        chain_type="stuff",
+        prompt=prompt,
+    )
+
+
+def _check_chain_type(chain_type: str) -> None:
+    if chain_type not in CHAIN_TYPES:
+        raise NotImplementedError(f"Chain type {chain_type} not supported.")
+
+
+def _num_retrieved_docs(chain_type: str) -> int:
+    return NUM_MAP_REDUCE_DOCS if chain_type == "map_reduce" else NUM_RETRIEVED_DOCS
+
+
+def _map_docs(
+    query: str,
+    docs: List[Document],
+    llm: BaseChatModel,
+    max_concurrency: int,
+    llm_slots: Optional[threading.BoundedSemaphore] = None,
+) -> List[Document]:
+    """Map step of a map-reduce query: extracts the information relevant to the
+    query from groups of docs, with concurrent LLM calls. Returns the extracts
+    as docs whose source is the sources they cite, for the reduce step.
+
+    Each LLM call holds one of `llm_slots` if given, which bounds the calls of
+    all the queries sharing it."""
+
+    map_chain = _get_chain(llm, MAP_PROMPT)
+    model_name = getattr(llm, "model_name", "debug")
+    with timed("pack"):
+        groups = group_docs(
+            query,
+            map_chain,
+            docs,
+            max_tokens=min(get_context_budget(model_name), MAP_GROUP_TOKENS),
+            model_name=_tokenizer_model(llm),
+        )
+    if not groups:
+        return []
+
+    def run(group: List[Document]) -> str:
+        with llm_slots if llm_slots is not None else nullcontext():
+            return map_chain(
+                {"input_documents": group, "question": query},
+                return_only_outputs=True,
+                callbacks=[_UsageHandler(_tokenizer_model(llm))],
+            )["output_text"]
+
+    # Only the time until the slowest group is done counts
+    with timed("map"), ThreadPoolExecutor(
+        max_workers=min(max_concurrency, len(groups))
+    ) as pool:
+        outputs = list(pool.map(in_current_context(run), groups))
+
+    extracts = []
+    for output in outputs:
+        text, _, sources = output.partition(SOURCES_MARKER)
+        # Groups with nothing relevant have no sources
+        if text.strip() and sources.strip():
+            extracts.append(
+                Document(
+                    page_content=text.strip(), metadata={"source": sources.strip()}
+                )
+            )
+    return extracts
+
+
+def _cache_scope(
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool,
+    retrieval: str,
+    chain_type: str,
+) -> Any:
+    """Answers are only reused for the same files, model and options"""
+    return (
+        getattr(llm, "model_name", "debug"),
+        tuple(file.id for file in folder_index.files),
+        return_all,
+        retrieval,
+        chain_type,
+    )
+
+
+def _check_cache(
+    answer_cache: Optional[AnswerCache], folder_index: FolderIndex
+) -> None:
+    if answer_cache is not None and folder_index.embeddings is None:
+        raise ValueError("The answer cache needs the embeddings of the index")
+
+
+def _pack_query(
+    query: str,
+    candidates: List[Document],
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    chain: StuffDocumentsChain,
+    return_all: bool,
+    answer_cache: Optional[AnswerCache],
+    cache_scope: Any,
+    query_vector: Optional[List[float]],
+    chain_type: str,
+    max_concurrency: int,
+    max_context_tokens: Optional[int],
+    llm_slots: Optional[threading.BoundedSemaphore] = None,
+) -> Tuple[List[Document], Callable[[str], AnswerWithSources]]:
+    """Keeps as many of the candidate chunks as fit into the context window of
+    the model, or of the extracts of the map step of a map-reduce query.
+    Returns them and a function that turns the output of the model into an
+    AnswerWithSources (and caches it)."""
+
+    # Chunks the answer can cite
+    cited_docs = candidates
+    if chain_type == "map_reduce":
+        candidates = _map_docs(query, candidates, llm, max_concurrency, llm_slots)
+
+    max_tokens = get_context_budget(getattr(llm, "model_name", "debug"))
+    if max_context_tokens is not None:
+        max_tokens = min(max_tokens, max_context_tokens)
+    with timed("pack"):
+        relevant_docs = pack_docs(
+            query,
+            chain,
+            candidates,
+            max_tokens=max_tokens,
+            model_name=_tokenizer_model(llm),
+        )
+
+    if chain_type == "stuff":
+        cited_docs = relevant_docs
+
+    def finish(output_text: str) -> AnswerWithSources:
+        sources = cited_docs
+
+        if not return_all:
+            sources = get_sources(output_text, folder_index, cited_docs)
+
+        answer = output_text.split(SOURCES_MARKER)[0]
+
+        answer_with_sources = AnswerWithSources(answer=answer, sources=sources)
+        if answer_cache is not None:
+            answer_cache.put(cache_scope, query_vector, answer_with_sources)
+
+        return answer_with_sources
+
+    return relevant_docs, finish
+
+
+def _prepare_query(
+    query: str,
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    chain: StuffDocumentsChain,
+    return_all: bool,
+    answer_cache: Optional[AnswerCache],
+    use_cache: bool,
+    retrieval: str,
+    chain_type: str,
+    max_concurrency: int,
+    max_context_tokens: Optional[int],
+) -> Tuple[
+    Optional[AnswerWithSources], List[Document], Callable[[str], AnswerWithSources]
+]:
+    """Looks the query up in the answer cache and retrieves the relevant docs:
+    the most similar chunks, as many as fit into the context window of the model.
+
+    Returns the cached answer if there is one, the relevant docs otherwise, and
+    a function that turns the output of the model into an AnswerWithSources
+    (and caches it).
+    """
+
+    _check_chain_type(chain_type)
+    _check_cache(answer_cache, folder_index)
+    query_vector = None
+    cache_scope: Any = None
+    if answer_cache is not None:
+        cache_scope = _cache_scope(folder_index, llm, return_all, retrieval, chain_type)
+        # The query is embedded once, for the cache and the similarity search
+        with timed("embed_query"):
+            query_vector = folder_index.embeddings.embed_query(query)  # type: ignore
+        if use_cache:
+            cached = answer_cache.get(cache_scope, query_vector)
+            increment("answer_cache_hits" if cached else "answer_cache_misses")
+            if cached is not None:
+                return cached, [], lambda _: cached
+
+    candidates = folder_index.search(
+        query,
+        k=_num_retrieved_docs(chain_type),
+        mode=retrieval,
+        query_vector=query_vector,
+    )
+    relevant_docs, finish = _pack_query(
+        query,
+        candidates,
+        folder_index,
+        llm,
+        chain,
+        return_all,
+        answer_cache,
+        cache_scope,
+        query_vector,
+        chain_type,
+        max_concurrency,
+        max_context_tokens,
+    )
+    return None, relevant_docs, finish
+
+
 def query_folder(
     query: str,
     folder_index: FolderIndex,
     llm: BaseChatModel,
     return_all: bool = False,
+    answer_cache: Optional[AnswerCache] = None,
+    use_cache: bool = True,
+    retrieval: str = "vector",
+    chain_type: str = "stuff",
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_context_tokens: Optional[int] = DEFAULT_MAX_CONTEXT_TOKENS,
 ) -> AnswerWithSources:
     """Queries a folder index for an answer.
 
@@ -26,40 +342,336 @@ def query_folder(
         return_all (bool): Whether to return all the documents from the embedding or
         just the sources for the answer.
         model (str): The model to use for the answer generation.
+        answer_cache (AnswerCache): If given, a query similar enough to one that
+        was already answered for the same files and model gets the cached answer.
+        The folder index must know its embeddings to use the cache.
+        use_cache (bool): Set to False to skip the cache lookup for this query.
+        The new answer is still cached.
+        retrieval (str): How the relevant chunks are found, one of "vector"
+        (the default), "lexical" (BM25, without calling the embedding API) or
+        "hybrid" (both, which the app and the API use).
+        chain_type (str): One of CHAIN_TYPES. "map_reduce" answers from many
+        more chunks, for questions about a whole document, with an LLM call
+        per group of chunks and one to combine their answers.
+        max_concurrency (int): Maximum number of map LLM calls in flight at
+        once.
+        max_context_tokens (Optional[int]): Largest prompt given to the model,
+        in tokens. None fills its context window.
         **model_kwargs (Any): Keyword arguments for the model.
 
     Returns:
         AnswerWithSources: The answer and the source documents.
     """
 
-    chain = load_qa_with_sources_chain(
-        llm=llm,
-        chain_type="stuff",
-        prompt=STUFF_PROMPT,
+    chain = _get_chain(llm)
+    cached, relevant_docs, finish = _prepare_query(
+        query,
+        folder_index,
+        llm,
+        chain,
+        return_all,
+        answer_cache,
+        use_cache,
+        retrieval,
+        chain_type,
+        max_concurrency,
+        max_context_tokens,
     )
+    if cached is not None:
+        return cached
+
+    with timed("llm"):
+        result = chain(
+            {"input_documents": relevant_docs, "question": query},
+            return_only_outputs=True,
+            callbacks=[_UsageHandler(_tokenizer_model(llm))],
+        )
+
+    return finish(result["output_text"])
+
+
+def query_folder_batch(
+    queries: List[str],
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool = False,
+    answer_cache: Optional[AnswerCache] = None,
+    use_cache: bool = True,
+    retrieval: str = "vector",
+    chain_type: str = "stuff",
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_context_tokens: Optional[int] = DEFAULT_MAX_CONTEXT_TOKENS,
+) -> List[AnswerWithSources]:
+    """Answers many queries over a folder index. Takes the same arguments as
+    `query_folder`, except that `max_concurrency` bounds the number of LLM
+    calls in flight for the whole batch, the map steps of map-reduce chains
+    included.
+
+    The queries are embedded in one request and searched in one call to the
+    index. The QA chains then run on a thread pool, since they spend most of
+    their time waiting for the API.
+
+    Returns:
+        List[AnswerWithSources]: The answers, in the order of the queries.
+    """
+
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+    _check_chain_type(chain_type)
+    _check_cache(answer_cache, folder_index)
+
+    chain = _get_chain(llm)
+    answers: List[Optional[AnswerWithSources]] = [None] * len(queries)
+    query_vectors: List[Optional[List[float]]] = [None] * len(queries)
+    cache_scope: Any = None
+    if answer_cache is not None and queries:
+        cache_scope = _cache_scope(folder_index, llm, return_all, retrieval, chain_type)
+        with timed("embed_query"):
+            query_vectors = list(
+                folder_index.embeddings.embed_documents(queries)  # type: ignore
+            )
+        if use_cache:
+            for i, query_vector in enumerate(query_vectors):
+                cached = answer_cache.get(cache_scope, query_vector)  # type: ignore
+                increment("answer_cache_hits" if cached else "answer_cache_misses")
+                answers[i] = cached
+
+    pending = [i for i, answer in enumerate(answers) if answer is None]
+    if not pending:
+        return answers  # type: ignore
+
+    all_candidates = folder_index.search_batch(
+        [queries[i] for i in pending],
+        k=_num_retrieved_docs(chain_type),
+        mode=retrieval,
+        query_vectors=[query_vectors[i] for i in pending],
+    )
+
+    # Shared by the QA chains, so that their map steps do not each make up to
+    # max_concurrency calls of their own
+    llm_slots = threading.BoundedSemaphore(max_concurrency)
+
+    def answer_query(i: int, candidates: List[Document]) -> AnswerWithSources:
+        relevant_docs, finish = _pack_query(
+            queries[i],
+            candidates,
+            folder_index,
+            llm,
+            chain,
+            return_all,
+            answer_cache,
+            cache_scope,
+            query_vectors[i],
+            chain_type,
+            max_concurrency,
+            max_context_tokens,
+            llm_slots,
+        )
+        with llm_slots, timed("llm"):
+            result = chain(
+                {"input_documents": relevant_docs, "question": queries[i]},
+                return_only_outputs=True,
+                callbacks=[_UsageHandler(_tokenizer_model(llm))],
+            )
+        return finish(result["output_text"])
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(pending))) as pool:
+        # map yields the results in the order of the queries
+        results = pool.map(in_current_context(answer_query), pending, all_candidates)
+        for i, answer in zip(pending, results):
+            answers[i] = answer
+
+    return answers  # type: ignore
+
+
+class _TokenQueueHandler(BaseCallbackHandler):
+    """Puts the tokens streamed by an LLM into a queue"""
+
+    def __init__(self, queue: Queue):
+        self.queue = queue
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.queue.put(token)
+
+
+_DONE = object()
 
-    relevant_docs = folder_index.index.similarity_search(query, k=5)
-    result = chain(
-        {"input_documents": relevant_docs, "question": query}, return_only_outputs=True
+
+def _stream_chain(
+    chain: Chain,
+    inputs: dict[str, Any],
+    callbacks: Optional[List[BaseCallbackHandler]] = None,
+) -> Iterator[str]:
+    """Runs a chain on a background thread and yields the tokens of its output
+    as the LLM streams them. If the LLM doesn't stream, the whole output is
+    yielded at the end."""
+
+    queue: Queue = Queue()
+    result: dict[str, Any] = {}
+
+    def run() -> None:
+        try:
+            result["output"] = chain(
+                inputs,
+                return_only_outputs=True,
+                callbacks=[_TokenQueueHandler(queue), *(callbacks or [])],
+            )["output_text"]
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            queue.put(_DONE)
+
+    threading.Thread(target=in_current_context(run), daemon=True).start()
+
+    streamed = ""
+    while (token := queue.get()) is not _DONE:
+        streamed += token
+        yield token
+
+    if "error" in result:
+        raise result["error"]
+    if result["output"].startswith(streamed):
+        yield result["output"][len(streamed) :]  # noqa: E203
+
+
+class StreamingAnswer:
+    """Answer to a query that streams in as the model generates it.
+
+    Iterating yields the text of the answer piece by piece, without the
+    sources section. `result` is the full AnswerWithSources, available once
+    the whole answer has streamed in.
+    """
+
+    def __init__(
+        self, chunks: Iterator[str], finish: Callable[[str], AnswerWithSources]
+    ):
+        self._chunks = chunks
+        self._finish = finish
+        self._result: Optional[AnswerWithSources] = None
+
+    def __iter__(self) -> Iterator[str]:
+        output = ""
+        # Text that might be the start of the sources marker is held back
+        pending = ""
+        in_sources = False
+
+        for chunk in self._chunks:
+            output += chunk
+            if in_sources:
+                continue
+
+            pending += chunk
+            if SOURCES_MARKER in pending:
+                in_sources = True
+                pending = pending.split(SOURCES_MARKER)[0]
+                if pending:
+                    yield pending
+                continue
+
+            keep = _marker_prefix_length(pending)
+            if len(pending) > keep:
+                yield pending[: len(pending) - keep]
+                pending = pending[len(pending) - keep :]  # noqa: E203
+
+        if pending and not in_sources:
+            yield pending
+
+        self._result = self._finish(output)
+
+    @property
+    def result(self) -> AnswerWithSources:
+        """The answer and its sources, waiting for the rest of the answer to
+        stream in if needed"""
+        if self._result is None:
+            for _ in self:
+                pass
+        return self._result  # type: ignore
+
+
+def _marker_prefix_length(text: str) -> int:
+    """Length of the longest end of `text` that is a start of SOURCES_MARKER"""
+    for length in range(min(len(text), len(SOURCES_MARKER) - 1), 0, -1):
+        if SOURCES_MARKER.startswith(text[-length:]):
+            return length
+    return 0
+
+
+def stream_query_folder(
+    query: str,
+    folder_index: FolderIndex,
+    llm: BaseChatModel,
+    return_all: bool = False,
+    answer_cache: Optional[AnswerCache] = None,
+    use_cache: bool = True,
+    retrieval: str = "vector",
+    chain_type: str = "stuff",
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_context_tokens: Optional[int] = DEFAULT_MAX_CONTEXT_TOKENS,
+) -> StreamingAnswer:
+    """Queries a folder index for an answer that is streamed as it is generated.
+    Takes the same arguments as `query_folder`. The LLM must be created with
+    `streaming=True` for the answer to arrive token by token, otherwise it
+    arrives in one piece.
+
+    Returns:
+        StreamingAnswer: Yields the text of the answer as it arrives, then
+        holds the answer and the source documents in `result`.
+    """
+
+    chain = _get_chain(llm)
+    cached, relevant_docs, finish = _prepare_query(
+        query,
+        folder_index,
+        llm,
+        chain,
+        return_all,
+        answer_cache,
+        use_cache,
+        retrieval,
+        chain_type,
+        max_concurrency,
+        max_context_tokens,
     )
-    sources = relevant_docs
+    if cached is not None:
+        return StreamingAnswer(iter([cached.answer]), finish)
 
-    if not return_all:
-        sources = get_sources(result["output_text"], folder_index)
+    chunks = _stream_chain(
+        chain,
+        {"input_documents": relevant_docs, "question": query},
+        callbacks=[_UsageHandler(_tokenizer_model(llm))],
+    )
+    # Only the time spent waiting for the model counts, not the time the
+    # caller spends on the tokens
+    return StreamingAnswer(timed_iter("llm", chunks), finish)
 
-    answer = result["output_text"].split("SOURCES: ")[0]
 
-    return AnswerWithSources(answer=answer, sources=sources)
+def get_sources(
+    answer: str,
+    folder_index: FolderIndex,
+    relevant_docs: Optional[List[Document]] = None,
+) -> List[Document]:
+    """Retrieves the docs that were used to answer the question the generated answer.
 
+    A cited source key is looked up in the files of the `relevant_docs` that were
+    given to the model if it matches one of them, and in all files otherwise.
+    """
 
-def get_sources(answer: str, folder_index: FolderIndex) -> List[Document]:
-    """Retrieves the docs that were used to answer the question the generated answer."""
+    source_keys = [s.strip() for s in answer.split(SOURCES_MARKER)[-1].split(", ")]
 
-    source_keys = [s for s in answer.split("SOURCES: ")[-1].split(", ")]
+    cited_files: dict[str, List[str]] = {}
+    for doc in relevant_docs or []:
+        source, file_id = doc.metadata.get("source"), doc.metadata.get("file_id")
+        if source is not None and file_id is not None:
+            cited_files.setdefault(source, []).append(file_id)
 
     source_docs = []
-    for file in folder_index.files:
-        for doc in file.docs:
-            if doc.metadata["source"] in source_keys:
-                source_docs.append(doc)
+    for source in dict.fromkeys(source_keys):
+        if source in cited_files:
+            chunks = [
+                folder_index.get_chunk(file_id, source)
+                for file_id in cited_files[source]
+            ]
+        else:
+            chunks = folder_index.get_chunks(source)
+        source_docs.extend(as_document(chunk) for chunk in chunks if chunk is not None)
     return source_docs
@@ -1,30 +1,145 @@
-from typing import List
+from typing import List, Tuple
+
+from langchain.chains.combine_documents.base import format_document
 from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
 from langchain.docstore.document import Document
 
-from langchain.chat_models import ChatOpenAI
+from knowledge_gpt.core.chunking import get_encoding
 from knowledge_gpt.core.debug import FakeChatModel
-from langchain.chat_models.base import BaseChatModel
+
+# Context window of the supported models, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo": 4096,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "debug": 4096,
+}
+
+# Tokens of the context window kept free for the answer
+ANSWER_TOKENS = 512
+
+
+def get_context_budget(model: str) -> int:
+    """Returns the number of prompt tokens that can be sent to a model
+    while leaving room for the answer."""
+    # Dated versions (e.g. gpt-4-0613) share the window of their model
+    for prefix, window in MODEL_CONTEXT_WINDOWS.items():
+        if model.startswith(prefix):
+            return window - ANSWER_TOKENS
+
+    raise NotImplementedError(f"Model {model} not supported!")
 
 
 def pop_docs_upto_limit(
     query: str, chain: StuffDocumentsChain, docs: List[Document], max_len: int
 ) -> List[Document]:
     """Pops documents from a list until the final prompt length is less
-    than the max length."""
+    than the max length.
+
+    The prompt and each document are only measured once, so this is linear
+    in the number of documents."""
 
-    token_count: int = chain.prompt_length(docs, question=query)  # type: ignore
+    llm = chain.llm_chain.llm
+    token_count: int = chain.prompt_length([], question=query)  # type: ignore
+    separator_count = llm.get_num_tokens(chain.document_separator)
 
-    while token_count > max_len and len(docs) > 0:
-        docs.pop()
-        token_count = chain.prompt_length(docs, question=query)  # type: ignore
+    fitting = 0
+    for i, doc in enumerate(docs):
+        token_count += llm.get_num_tokens(format_document(doc, chain.document_prompt))
+        if i > 0:
+            token_count += separator_count
+        if token_count > max_len:
+            break
+        fitting += 1
 
+    del docs[fitting:]
     return docs
 
 
+def _prompt_token_counts(
+    query: str, chain: StuffDocumentsChain, docs: List[Document], model_name: str
+) -> Tuple[int, int, List[int]]:
+    """Tokens of the prompt without documents, of the separator between
+    documents and of every formatted document, tokenized in a single batch"""
+    encoding = get_encoding(model_name)
+    empty_prompt = chain.llm_chain.prompt.format(
+        **chain._get_inputs([], question=query)
+    )
+    doc_strings = [format_document(doc, chain.document_prompt) for doc in docs]
+    prompt_tokens, separator_tokens, *doc_tokens = map(
+        len,
+        encoding.encode_ordinary_batch(
+            [empty_prompt, chain.document_separator, *doc_strings]
+        ),
+    )
+    return prompt_tokens, separator_tokens, doc_tokens
+
+
+def pack_docs(
+    query: str,
+    chain: StuffDocumentsChain,
+    docs: List[Document],
+    max_tokens: int,
+    model_name: str = "gpt-3.5-turbo",
+) -> List[Document]:
+    """Returns the longest prefix of `docs` (ordered by relevance) whose prompt
+    fits into `max_tokens` tokens of the model.
+
+    The prompt without documents and every formatted document are tokenized
+    once, in a single batch, so packing is linear in the size of the docs.
+    """
+
+    prompt_tokens, separator_tokens, doc_tokens = _prompt_token_counts(
+        query, chain, docs, model_name
+    )
+
+    token_count = prompt_tokens
+    packed = []
+    for doc, num_tokens in zip(docs, doc_tokens):
+        token_count += num_tokens + (separator_tokens if packed else 0)
+        if token_count > max_tokens:
+            break
+        packed.append(doc)
+
+    return packed
+
+
+def group_docs(
+    query: str,
+    chain: StuffDocumentsChain,
+    docs: List[Document],
+    max_tokens: int,
+    model_name: str = "gpt-3.5-turbo",
+) -> List[List[Document]]:
+    """Splits `docs` into consecutive groups whose prompts each fit into
+    `max_tokens` tokens of the model. A document too long to fit with any
+    other gets a group of its own."""
+
+    prompt_tokens, separator_tokens, doc_tokens = _prompt_token_counts(
+        query, chain, docs, model_name
+    )
+
+    groups: List[List[Document]] = []
+    group: List[Document] = []
+    token_count = prompt_tokens
+    for doc, num_tokens in zip(docs, doc_tokens):
+        if group and token_count + separator_tokens + num_tokens > max_tokens:
+            groups.append(group)
+            group, token_count = [], prompt_tokens
+        token_count += num_tokens + (separator_tokens if group else 0)
+        group.append(doc)
+    if group:
+        groups.append(group)
+
+    return groups
+
+
 def get_llm(model: str, **kwargs) -> BaseChatModel:
     if model == "debug":
-        return FakeChatModel()
+        return FakeChatModel(streaming=kwargs.get("streaming", False))
 
     if "gpt" in model:
         return ChatOpenAI(model=model, **kwargs)  # type: ignore
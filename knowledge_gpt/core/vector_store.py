@@ -0,0 +1,700 @@
+import json
+import math
+import os
+import tempfile
+from typing import IO, Any, Iterable, List, Optional, Sequence, Set, Tuple
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import VectorStore
+
+from knowledge_gpt.core.chunk_store import ChunkSlice, ChunkStore
+
+INDEX_FILE = "index.faiss"
+SETTINGS_FILE = "vector_store.json"
+# Full precision vectors kept to rescore the candidates of compressed indexes
+VECTORS_FILE = "vectors.npy"
+
+# Kinds of FAISS index a ChunkFAISS can use. Vectors are always added to an
+# exact "flat" index first and converted by `optimize`.
+INDEX_TYPES = ["flat", "ivf_flat", "hnsw", "ivf_pq"]
+
+# The "auto" index type stays flat up to this many vectors...
+AUTO_FLAT_MAX_VECTORS = 20_000
+# ...then uses HNSW up to this many, then IVF-Flat, whose build time and
+# memory grow more slowly. IVF-PQ loses too much recall to be picked
+# automatically, it has to be asked for.
+AUTO_HNSW_MAX_VECTORS = 200_000
+
+# Approximate indexes are not worth training on fewer vectors than this
+MIN_TRAINING_VECTORS = 1000
+
+# Number of inverted lists searched by IVF indexes
+DEFAULT_NPROBE = 16
+# Size of the candidate list of HNSW searches
+DEFAULT_EF_SEARCH = 64
+# Number of neighbours of each HNSW node
+HNSW_M = 32
+# Maximum number of sub-quantizers (bytes per vector) of IVF-PQ indexes
+PQ_M = 64
+
+# Precisions the vectors can be stored in by the index: 4, 2 or 1 byte(s) per
+# dimension. IVF-PQ indexes quantize the vectors in their own way.
+PRECISIONS = ["float32", "float16", "int8"]
+# Ways to lower the dimension of the vectors before they are indexed:
+# projecting them on their principal components or keeping the first ones
+# (for embeddings trained for it, like OpenAI's text-embedding-3 models)
+DIM_REDUCTIONS = ["pca", "truncate"]
+
+# Compressed indexes fetch this many times more candidates than asked for,
+# which are then ranked again with the full precision vectors
+DEFAULT_RESCORE_FACTOR = 4
+
+# HNSW indexes are rebuilt without their deleted rows once more than this
+# fraction of their vectors is deleted
+MAX_DELETED_FRACTION = 0.25
+
+# int8 ranges are widened by this fraction on both sides, so that vectors
+# added after training are not clipped
+INT8_RANGE_MARGIN = 0.1
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """Picks an index type for a number of vectors"""
+    if num_vectors <= AUTO_FLAT_MAX_VECTORS:
+        return "flat"
+    if num_vectors <= AUTO_HNSW_MAX_VECTORS:
+        return "hnsw"
+    return "ivf_flat"
+
+
+def _num_lists(num_vectors: int) -> int:
+    """Number of IVF lists: about 4 * sqrt(n), with enough vectors per list
+    to train the coarse quantizer"""
+    return max(1, min(4 * int(math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _quantizer_type(precision: str) -> int:
+    if precision == "float16":
+        return faiss.ScalarQuantizer.QT_fp16
+    elif precision == "int8":
+        return faiss.ScalarQuantizer.QT_8bit
+    raise NotImplementedError(f"Precision {precision} not supported.")
+
+
+def _dim_transform(
+    dim_reduction: str, dim_in: int, dim_out: int
+) -> faiss.VectorTransform:
+    if dim_reduction == "pca":
+        return faiss.PCAMatrix(dim_in, dim_out)
+    elif dim_reduction == "truncate":
+        return faiss.RemapDimensionsTransform(dim_in, dim_out, False)
+    raise NotImplementedError(f"Dimension reduction {dim_reduction} not supported.")
+
+
+def build_index(
+    index_type: str,
+    vectors: np.ndarray,
+    ids: np.ndarray,
+    precision: str = "float32",
+    dim: Optional[int] = None,
+    dim_reduction: str = "pca",
+) -> faiss.Index:
+    """Builds (and trains if needed) an index of the given type over vectors,
+    stored under the given ids.
+
+    With a `precision` other than float32, the vectors are scalar quantized.
+    With a `dim` lower than theirs, the vectors are reduced to `dim`
+    dimensions first (PCA needs at least `dim` vectors to be trained).
+    """
+    num_vectors, full_dim = vectors.shape
+
+    transform = None
+    dim = dim or full_dim
+    if dim < full_dim and (dim_reduction != "pca" or num_vectors >= dim):
+        transform = _dim_transform(dim_reduction, full_dim, dim)
+    else:
+        dim = full_dim
+
+    if index_type == "flat":
+        if precision == "float32":
+            index = faiss.IndexFlatL2(dim)
+        else:
+            index = faiss.IndexScalarQuantizer(dim, _quantizer_type(precision))
+    elif index_type == "hnsw":
+        if precision == "float32":
+            index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        else:
+            index = faiss.IndexHNSWSQ(dim, _quantizer_type(precision), HNSW_M)
+    elif index_type == "ivf_flat":
+        quantizer = faiss.IndexFlatL2(dim)
+        if precision == "float32":
+            index = faiss.IndexIVFFlat(quantizer, dim, _num_lists(num_vectors))
+        else:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dim, _num_lists(num_vectors), _quantizer_type(precision)
+            )
+    elif index_type == "ivf_pq":
+        # As many sub-quantizers as possible (up to PQ_M) that divide the dim
+        m = max(m for m in range(1, min(PQ_M, dim) + 1) if dim % m == 0)
+        bits = min(8, int(math.log2(num_vectors)))
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, _num_lists(num_vectors), m, bits)
+    else:
+        raise NotImplementedError(f"Index type {index_type} not supported.")
+
+    sq = getattr(index, "sq", None)
+    if sq is not None and precision == "int8":
+        sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        sq.rangestat_arg = INT8_RANGE_MARGIN
+    if transform is not None:
+        index = faiss.IndexPreTransform(transform, index)
+    if index_type in ("flat", "hnsw"):
+        # Only IVF indexes store ids of their own
+        index = faiss.IndexIDMap(index)
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def _base_index(index: faiss.Index) -> faiss.Index:
+    """The index that stores the vectors, without the id map and transform"""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def is_compressed(index: faiss.Index) -> bool:
+    """Whether an index stores approximations of the vectors (reduced or
+    quantized) instead of the vectors themselves"""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return True
+    return not isinstance(
+        index, (faiss.IndexFlat, faiss.IndexHNSWFlat, faiss.IndexIVFFlat)
+    )
+
+
+def get_index_type(index: faiss.Index) -> str:
+    """Returns the type of an index built by `build_index`"""
+    index = _base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+class ChunkFAISS(VectorStore):
+    """FAISS vector store whose chunks live in a ChunkStore.
+
+    Every vector is stored under the row of its chunk in the store, so search
+    results map straight back to chunks and Documents are only created for
+    the hits that are returned.
+
+    Vectors are searched exactly ("flat") until `optimize` converts the index
+    to `index_type`: an inverted file ("ivf_flat"), a graph ("hnsw") or an
+    inverted file of product-quantized vectors ("ivf_pq"). With "auto", the
+    type is chosen from the number of vectors by `choose_index_type`.
+    `nprobe` and `ef_search` trade recall for speed in IVF and HNSW searches.
+
+    `optimize` also compresses the vectors: to `precision` ("float16" or
+    "int8"), and to `dim` dimensions by `dim_reduction`. Searches of a
+    compressed index then fetch `rescore_factor` times more candidates and
+    rank them again with the full precision vectors, which are kept apart in
+    a memory-mapped file rather than in memory: a temporary file while
+    vectors are added, the saved one after loading (with a `rescore_factor`
+    of 0, they are not kept at all).
+    """
+
+    index_type: str = "auto"
+    precision: str = "float32"
+    dim: Optional[int] = None
+    dim_reduction: str = "pca"
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        chunks: Optional[ChunkStore] = None,
+        index: Optional[faiss.Index] = None,
+        index_type: Optional[str] = None,
+        nprobe: int = DEFAULT_NPROBE,
+        ef_search: int = DEFAULT_EF_SEARCH,
+        precision: Optional[str] = None,
+        dim: Optional[int] = None,
+        dim_reduction: Optional[str] = None,
+        rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+        vectors: Optional[np.ndarray] = None,
+    ):
+        self.embedding = embedding
+        self.chunks = chunks if chunks is not None else ChunkStore()
+        self.index = index
+        self.index_type = index_type or type(self).index_type
+        if self.index_type not in INDEX_TYPES + ["auto"]:
+            raise NotImplementedError(f"Index type {self.index_type} not supported.")
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+
+        self.precision = precision or type(self).precision
+        if self.precision not in PRECISIONS:
+            raise NotImplementedError(f"Precision {self.precision} not supported.")
+        self.dim = dim or type(self).dim
+        self.dim_reduction = dim_reduction or type(self).dim_reduction
+        if self.dim_reduction not in DIM_REDUCTIONS:
+            raise NotImplementedError(
+                f"Dimension reduction {self.dim_reduction} not supported."
+            )
+        self.rescore_factor = rescore_factor
+        # Full precision vectors by row, to rescore the candidates of a
+        # compressed index
+        self.vectors = vectors if self.compresses and rescore_factor > 0 else None
+
+        # Rows deleted from an index that can't remove vectors (HNSW), and
+        # the selector that skips them during searches
+        self._deleted: Set[int] = set()
+        self._deleted_selector: Optional[Tuple[Any, ...]] = None
+        # File a read-only (memory-mapped) index was loaded from
+        self._mmap_path: Optional[str] = None
+        # Temporary file `vectors` are mapped from while they are added
+        self._vectors_file: Optional[IO[bytes]] = None
+
+        self.set_search_params()
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        if self.index is not None:
+            # A memory-mapped index is serialized without being read into
+            # memory, the copy gets its own index
+            state["index"] = faiss.serialize_index(self.index)
+        state["_mmap_path"] = None
+        state["_deleted_selector"] = None
+        # The copy gets its own vectors, moved to a file when more are added
+        state["_vectors_file"] = None
+        if self.vectors is not None:
+            state["vectors"] = np.asarray(self.vectors)
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        state.setdefault("_deleted_selector", None)
+        state.setdefault("_vectors_file", None)
+        if state["index"] is not None:
+            state["index"] = faiss.deserialize_index(state["index"])
+        self.__dict__.update(state)
+        self.set_search_params()
+
+    def set_search_params(
+        self, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+    ) -> None:
+        """Sets the number of lists searched by IVF indexes and the size of
+        the candidate list of HNSW searches"""
+        self.nprobe = nprobe or self.nprobe
+        self.ef_search = ef_search or self.ef_search
+
+        index_type = self.built_index_type
+        if index_type in ("ivf_flat", "ivf_pq"):
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        elif index_type == "hnsw":
+            _base_index(self.index).hnsw.efSearch = self.ef_search
+
+    @property
+    def compresses(self) -> bool:
+        """Whether `optimize` compresses the vectors"""
+        return self.precision != "float32" or self.dim is not None
+
+    @property
+    def built_index_type(self) -> Optional[str]:
+        """Type of the current index, None if nothing was indexed yet"""
+        return get_index_type(self.index) if self.index is not None else None
+
+    def optimize(self) -> None:
+        """Converts the exact index into the configured index type once there
+        are enough vectors to train it. Indexes that were already converted
+        are left as they are."""
+        if self.built_index_type != "flat":
+            return
+
+        num_vectors = self.index.ntotal
+        index_type = self.index_type
+        if index_type == "auto":
+            index_type = choose_index_type(num_vectors)
+        if num_vectors < MIN_TRAINING_VECTORS:
+            index_type = "flat"
+        if index_type == "flat" and (not self.compresses or is_compressed(self.index)):
+            return
+
+        ids = faiss.vector_to_array(self.index.id_map)
+        if self.vectors is not None:
+            vectors = np.asarray(self.vectors[ids], dtype=np.float32)
+        else:
+            vectors = self.index.index.reconstruct_n(0, num_vectors)
+        self.index = build_index(
+            index_type,
+            vectors,
+            ids,
+            precision=self.precision,
+            dim=self.dim,
+            dim_reduction=self.dim_reduction,
+        )
+        self._mmap_path = None
+        self.set_search_params()
+
+    def _ensure_writable(self) -> None:
+        """Reads a memory-mapped index into memory, as it can't be changed
+        on disk"""
+        if self._mmap_path is not None:
+            self.index = faiss.read_index(self._mmap_path)
+            self._mmap_path = None
+            self.set_search_params()
+
+    def save(self, path: str) -> None:
+        """Saves the vectors and the chunks to a directory"""
+        self.chunks.save(path)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(path, INDEX_FILE))
+        if self.vectors is not None:
+            np.save(os.path.join(path, VECTORS_FILE), self.vectors[: len(self.chunks)])
+
+        settings = {
+            "index_type": self.index_type,
+            "nprobe": self.nprobe,
+            "ef_search": self.ef_search,
+            "precision": self.precision,
+            "dim": self.dim,
+            "dim_reduction": self.dim_reduction,
+            "rescore_factor": self.rescore_factor,
+            "deleted": sorted(self._deleted),
+        }
+        with open(os.path.join(path, SETTINGS_FILE), "w") as f:
+            json.dump(settings, f)
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings, mmap: bool = True) -> "ChunkFAISS":
+        """Loads a vector store saved with `save`, memory-mapping the vectors
+        and chunks if `mmap` is set. Vectors added or removed after loading
+        are not written back to the directory."""
+        chunks = ChunkStore.load(path, mmap_mode=mmap)
+
+        index = None
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            # Maps the vectors, graph and inverted lists of every index type,
+            # so that processes loading the same index share its pages
+            flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+            index = faiss.read_index(index_path, flags)
+
+        settings: dict[str, Any] = {}
+        settings_path = os.path.join(path, SETTINGS_FILE)
+        if os.path.exists(settings_path):
+            with open(settings_path) as f:
+                settings = json.load(f)
+
+        vectors = None
+        vectors_path = os.path.join(path, VECTORS_FILE)
+        if os.path.exists(vectors_path):
+            vectors = np.load(vectors_path, mmap_mode="r" if mmap else None)
+
+        vector_store = cls(
+            embedding=embedding,
+            chunks=chunks,
+            index=index,
+            index_type=settings.get("index_type"),
+            nprobe=settings.get("nprobe", DEFAULT_NPROBE),
+            ef_search=settings.get("ef_search", DEFAULT_EF_SEARCH),
+            precision=settings.get("precision"),
+            dim=settings.get("dim"),
+            dim_reduction=settings.get("dim_reduction"),
+            rescore_factor=settings.get("rescore_factor", DEFAULT_RESCORE_FACTOR),
+            vectors=vectors,
+        )
+        vector_store._deleted = set(settings.get("deleted", []))
+        if mmap and index is not None:
+            vector_store._mmap_path = index_path
+        return vector_store
+
+    def _add_rows(
+        self, rows: Sequence[int], vectors: Optional[np.ndarray] = None
+    ) -> List[str]:
+        """Embeds the chunks in the given rows of the store and indexes them.
+        Chunks whose `vectors` are given are not embedded again."""
+        if len(rows) == 0:
+            return []
+
+        if vectors is None:
+            texts = [self.chunks.text(row) for row in rows]
+            vectors = self.embedding.embed_documents(texts)
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if self.index is None:
+            self.index = faiss.IndexIDMap(faiss.IndexFlatL2(vectors.shape[1]))
+        self._ensure_writable()
+        self.index.add_with_ids(vectors, np.array(rows, dtype=np.int64))
+        if self.compresses and self.rescore_factor > 0:
+            self._keep_vectors(rows, vectors)
+
+        return [str(row) for row in rows]
+
+    def _keep_vectors(self, rows: Sequence[int], vectors: np.ndarray) -> None:
+        """Stores the full precision vectors of rows, for rescoring. They are
+        written to a memory-mapped temporary file, so that they don't take
+        memory next to the compressed index."""
+        size = max(rows) + 1
+        if self._vectors_file is None or size > len(self.vectors):
+            # Grown by doubling so that adding batches stays linear. Vectors
+            # loaded from a saved store are copied to the temporary file.
+            kept = self.vectors
+            capacity = size if kept is None else max(size, 2 * len(kept))
+            copy = kept is not None and self._vectors_file is None
+            if self._vectors_file is None:
+                self._vectors_file = tempfile.TemporaryFile()
+            self._vectors_file.truncate(capacity * vectors.shape[1] * 4)
+            self.vectors = np.memmap(
+                self._vectors_file,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, vectors.shape[1]),
+            )
+            if copy:
+                self.vectors[: len(kept)] = kept
+        self.vectors[np.asarray(rows)] = vectors
+
+    def add_documents(
+        self,
+        documents: Sequence[Any],
+        vectors: Optional[np.ndarray] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Indexes documents, with their `vectors` if they were already
+        embedded. Rows of this store's ChunkStore are indexed without being
+        copied."""
+        if isinstance(documents, ChunkSlice) and documents.store is self.chunks:
+            return self._add_rows(documents.rows, vectors)
+        return self._add_rows(self.chunks.extend(documents).rows, vectors)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        return self.add_documents(
+            [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(texts, metadatas)
+            ]
+        )
+
+    def delete(self, ids: List[str]) -> Optional[bool]:
+        """Deletes vectors by id (the row of their chunk in the store).
+        The chunks themselves stay in the store."""
+        if self.index is None or len(ids) == 0:
+            return False
+        rows = [int(i) for i in ids]
+        if self.built_index_type == "hnsw":
+            # HNSW graphs can't remove nodes, deleted rows are skipped by
+            # searches instead, until there are enough to rebuild the graph
+            self._deleted.update(rows)
+            self._deleted_selector = None
+            if len(self._deleted) > MAX_DELETED_FRACTION * self.index.ntotal:
+                self._compact()
+            return True
+
+        self._ensure_writable()
+        removed = self.index.remove_ids(np.array(rows, dtype=np.int64))
+        return removed > 0
+
+    def _compact(self) -> None:
+        """Rebuilds an HNSW index without its deleted rows. Indexes whose
+        full precision vectors were not kept can't be rebuilt and keep
+        skipping them."""
+        if self.compresses and self.vectors is None:
+            return
+
+        ids = faiss.vector_to_array(self.index.id_map)
+        keep = ~np.isin(ids, np.fromiter(self._deleted, dtype=np.int64))
+        if self.vectors is not None:
+            vectors = np.asarray(self.vectors[ids[keep]], dtype=np.float32)
+        else:
+            vectors = _base_index(self.index).reconstruct_n(0, len(ids))[keep]
+        self.index = build_index(
+            "hnsw",
+            vectors,
+            ids[keep],
+            precision=self.precision,
+            dim=self.dim,
+            dim_reduction=self.dim_reduction,
+        )
+        self._deleted = set()
+        self._deleted_selector = None
+        self._mmap_path = None
+        self.set_search_params()
+
+    def _search_params(self) -> Optional[faiss.SearchParameters]:
+        """Search parameters skipping the deleted rows, if there are any"""
+        if not self._deleted:
+            return None
+        if self._deleted_selector is None:
+            deleted = faiss.IDSelectorBatch(
+                np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted))
+            )
+            # The selectors are kept together, the outer one only points to
+            # the inner one
+            not_deleted = faiss.IDSelectorNot(deleted)
+            params = faiss.SearchParameters(sel=not_deleted)
+            self._deleted_selector = (deleted, not_deleted, params)
+        return self._deleted_selector[-1]
+
+    @classmethod
+    def from_documents(
+        cls,
+        documents: Sequence[Any],
+        embedding: Embeddings,
+        optimize: bool = True,
+        **kwargs: Any,
+    ) -> "ChunkFAISS":
+        """Creates a vector store from documents. A ChunkStore (or a slice of
+        one) is used as it is, without copying the chunks.
+
+        Without `optimize`, the index stays exact until `optimize` is called,
+        so that a store built in batches is trained on all of its vectors."""
+        if isinstance(documents, ChunkStore):
+            vector_store = cls(embedding=embedding, chunks=documents)
+            vector_store._add_rows(range(len(documents)))
+        elif isinstance(documents, ChunkSlice):
+            vector_store = cls(embedding=embedding, chunks=documents.store)
+            vector_store._add_rows(documents.rows)
+        else:
+            vector_store = cls(embedding=embedding)
+            vector_store.add_documents(documents)
+        if optimize:
+            vector_store.optimize()
+        return vector_store
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> "ChunkFAISS":
+        vector_store = cls(embedding=embedding)
+        vector_store.add_texts(texts, metadatas)
+        return vector_store
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Returns the k closest chunks and their L2 distance to the vector"""
+        return [
+            (self.chunks[row].to_document(), score)
+            for row, score in self.search_rows(embedding, k)
+        ]
+
+    def search_rows(
+        self, embedding: Sequence[float], k: int = 4
+    ) -> List[Tuple[int, float]]:
+        """Returns the rows of the k closest chunks and their L2 distance to
+        the vector"""
+        return self.search_rows_batch(np.array([embedding], dtype=np.float32), k)[0]
+
+    def search_rows_batch(
+        self, embeddings: np.ndarray, k: int = 4
+    ) -> List[List[Tuple[int, float]]]:
+        """Like `search_rows` for each row of a matrix of vectors, with a
+        single search of the index"""
+        queries = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.index is None or self.index.ntotal == 0:
+            return [[] for _ in queries]
+
+        rescore = self.vectors is not None and is_compressed(self.index)
+        fetch = k * self.rescore_factor if rescore else k
+        # Deleted rows are skipped by the search itself, so its width doesn't
+        # grow with their number
+        scores, rows = self.index.search(queries, fetch, params=self._search_params())
+
+        results = []
+        for query, query_rows, query_scores in zip(queries, rows, scores):
+            hits = [
+                (int(row), float(score))
+                for row, score in zip(query_rows, query_scores)
+                if row != -1
+            ]
+            if rescore and hits:
+                hits = self._rescore(query, [row for row, _ in hits])
+            results.append(hits[:k])
+        return results
+
+    def similarity_search_by_vectors(
+        self, embeddings: Sequence[Sequence[float]], k: int = 4
+    ) -> List[List[Document]]:
+        """Returns the k closest chunks to each vector, with a single search
+        of the index"""
+        return [
+            [self.chunks[row].to_document() for row, _ in hits]
+            for hits in self.search_rows_batch(
+                np.array(embeddings, dtype=np.float32), k
+            )
+        ]
+
+    def _rescore(self, query: np.ndarray, rows: List[int]) -> List[Tuple[int, float]]:
+        """Ranks rows by the L2 distance of their full precision vectors to the
+        query, like a flat index would"""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)  # type: ignore
+        scores = ((vectors - query) ** 2).sum(axis=1)
+        order = np.argsort(scores, kind="stable")
+        return [(rows[i], float(scores[i])) for i in order]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        docs_and_scores = self.similarity_search_with_score_by_vector(
+            embedding, k, **kwargs
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        docs_and_scores = self.similarity_search_with_score(query, k, **kwargs)
+        return [doc for doc, _ in docs_and_scores]
+
+
+class FlatFAISS(ChunkFAISS):
+    index_type = "flat"
+
+
+class IVFFlatFAISS(ChunkFAISS):
+    index_type = "ivf_flat"
+
+
+class HNSWFAISS(ChunkFAISS):
+    index_type = "hnsw"
+
+
+class IVFPQFAISS(ChunkFAISS):
+    index_type = "ivf_pq"
+
+
+class Float16FAISS(ChunkFAISS):
+    precision = "float16"
+
+
+class Int8FAISS(ChunkFAISS):
+    precision = "int8"
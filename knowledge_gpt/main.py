@@ -1,3 +1,5 @@
+import os
+
 import streamlit as st
 
 from knowledge_gpt.components.sidebar import sidebar
@@ -8,21 +10,55 @@ from knowledge_gpt.ui import (
     is_file_valid,
     is_open_ai_key_valid,
     display_file_read_error,
+    display_trace,
 )
 
 from knowledge_gpt.core.caching import bootstrap_caching
 
-from knowledge_gpt.core.parsing import read_file
-from knowledge_gpt.core.chunking import chunk_file
-from knowledge_gpt.core.embedding import embed_files
-from knowledge_gpt.core.qa import query_folder
+from knowledge_gpt.core.ingestion import ingest_file
+from knowledge_gpt.core.embedding import DEFAULT_RETRIEVAL, RETRIEVAL_MODES
+from knowledge_gpt.core.qa import (
+    CHAIN_TYPES,
+    DEFAULT_MAX_CONTEXT_TOKENS,
+    stream_query_folder,
+)
+from knowledge_gpt.core.answer_cache import get_answer_cache
+from knowledge_gpt.core.instrumentation import start_metrics_server, trace
 from knowledge_gpt.core.utils import get_llm
 
 
-EMBEDDING = "openai"
-VECTOR_STORE = "faiss"
+# "openai", or "local" to embed on the CPU without calling the OpenAI API
+EMBEDDING = os.environ.get("EMBEDDING", "openai")
+# "faiss", or e.g. "faiss_int8" to keep the vectors of many files in less memory
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "faiss")
 MODEL_LIST = ["gpt-3.5-turbo", "gpt-4"]
 
+# Number of CPU threads used by the local embedding model (all by default)
+EMBEDDING_THREADS = os.environ.get("EMBEDDING_THREADS")
+
+# Set to persist chunk embeddings on disk across sessions and restarts
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
+
+# Set to save indexes on disk and reload them (memory-mapped) after a restart
+INDEX_DIR = os.environ.get("INDEX_DIR")
+
+# Set (e.g. to 0.95) to reuse answers to questions whose embedding has at
+# least this cosine similarity to a question already asked about the file
+ANSWER_CACHE_THRESHOLD = os.environ.get("ANSWER_CACHE_THRESHOLD")
+
+# Largest prompt sent to answer a question, in tokens. Set to "none" to fill
+# the context window of the model, which costs more per question.
+MAX_CONTEXT_TOKENS = os.environ.get(
+    "MAX_CONTEXT_TOKENS", str(DEFAULT_MAX_CONTEXT_TOKENS)
+).lower()
+
+# Number of processes used to extract text from large PDFs. Every upload
+# starts its own pool, so PDFs are extracted serially unless this is set.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 1))
+
+# Set to serve Prometheus metrics at http://localhost:<port>/metrics
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
 # Uncomment to enable debug mode
 # MODEL_LIST.insert(0, "debug")
 
@@ -32,6 +68,9 @@ st.header("📖KnowledgeGPT")
 # Enable caching for expensive functions
 bootstrap_caching()
 
+if METRICS_PORT is not None:
+    start_metrics_server(int(METRICS_PORT))
+
 sidebar()
 
 openai_api_key = st.session_state.get("OPENAI_API_KEY")
@@ -55,33 +94,63 @@ model: str = st.selectbox("Model", options=MODEL_LIST)  # type: ignore
 with st.expander("Advanced Options"):
     return_all_chunks = st.checkbox("Show all chunks retrieved from vector search")
     show_full_doc = st.checkbox("Show parsed contents of the document")
+    retrieval = st.selectbox(
+        "Retrieval",
+        options=RETRIEVAL_MODES,
+        index=RETRIEVAL_MODES.index(DEFAULT_RETRIEVAL),
+        help="Find relevant chunks by meaning (vector), by exact words"
+        " (lexical) or both (hybrid)",
+    )
+    chain_type = st.selectbox(
+        "Answer from",
+        options=CHAIN_TYPES,
+        help="The most relevant chunks that fit into one prompt (stuff), or"
+        " many more chunks summarized in parallel (map_reduce), for questions"
+        " about the whole document",
+    )
+    bypass_answer_cache = ANSWER_CACHE_THRESHOLD is not None and st.checkbox(
+        "Don't reuse cached answers"
+    )
+    show_timings = st.checkbox("Show where time was spent")
 
 
 if not uploaded_file:
     st.stop()
 
-try:
-    file = read_file(uploaded_file)
-except Exception as e:
-    display_file_read_error(e, file_name=uploaded_file.name)
-
-chunked_file = chunk_file(file, chunk_size=300, chunk_overlap=0)
-
-if not is_file_valid(file):
-    st.stop()
-
-
 if not is_open_ai_key_valid(openai_api_key, model):
     st.stop()
 
 
+embedding = EMBEDDING if model != "debug" else "debug"
+embedding_kwargs = {}
+if embedding == "openai":
+    embedding_kwargs["openai_api_key"] = openai_api_key
+elif embedding == "local" and EMBEDDING_THREADS:
+    embedding_kwargs["num_threads"] = int(EMBEDDING_THREADS)
+
 with st.spinner("Indexing document... This may take a while⏳"):
-    folder_index = embed_files(
-        files=[chunked_file],
-        embedding=EMBEDDING if model != "debug" else "debug",
-        vector_store=VECTOR_STORE if model != "debug" else "debug",
-        openai_api_key=openai_api_key,
-    )
+    # Parsing, chunking and embedding run as one stream so that large
+    # documents are never held in memory in full
+    try:
+        with trace("ingest") as ingest_trace:
+            folder_index = ingest_file(
+                uploaded_file,
+                chunk_size=300,
+                chunk_overlap=0,
+                embedding=embedding,
+                vector_store=VECTOR_STORE if model != "debug" else "debug",
+                cache_dir=EMBEDDING_CACHE_DIR,
+                num_workers=PDF_WORKERS,
+                index_dir=INDEX_DIR,
+                **embedding_kwargs,
+            )
+    except Exception as e:
+        display_file_read_error(e, file_name=uploaded_file.name)
+
+chunked_file = folder_index.files[0]
+
+if not is_file_valid(chunked_file):
+    st.stop()
 
 with st.form(key="qa_form"):
     query = st.text_area("Ask a question about the document")
@@ -91,7 +160,9 @@ with st.form(key="qa_form"):
 if show_full_doc:
     with st.expander("Document"):
         # Hack to get around st.markdown rendering LaTeX
-        st.markdown(f"<p>{wrap_doc_in_html(file.docs)}</p>", unsafe_allow_html=True)
+        st.markdown(
+            f"<p>{wrap_doc_in_html(chunked_file.docs)}</p>", unsafe_allow_html=True
+        )
 
 
 if submit:
@@ -101,17 +172,39 @@ if submit:
     # Output Columns
     answer_col, sources_col = st.columns(2)
 
-    llm = get_llm(model=model, openai_api_key=openai_api_key, temperature=0)
-    result = query_folder(
-        folder_index=folder_index,
-        query=query,
-        return_all=return_all_chunks,
-        llm=llm,
+    llm = get_llm(
+        model=model, openai_api_key=openai_api_key, temperature=0, streaming=True
     )
-
-    with answer_col:
-        st.markdown("#### Answer")
-        st.markdown(result.answer)
+    with trace("query") as query_trace:
+        streaming_answer = stream_query_folder(
+            folder_index=folder_index,
+            query=query,
+            return_all=return_all_chunks,
+            llm=llm,
+            answer_cache=(
+                get_answer_cache(float(ANSWER_CACHE_THRESHOLD))
+                if ANSWER_CACHE_THRESHOLD is not None
+                else None
+            ),
+            use_cache=not bypass_answer_cache,
+            retrieval=retrieval,
+            chain_type=chain_type,
+            max_context_tokens=(
+                int(MAX_CONTEXT_TOKENS) if MAX_CONTEXT_TOKENS != "none" else None
+            ),
+        )
+
+        with answer_col:
+            st.markdown("#### Answer")
+            # Render the answer as it streams in
+            answer_placeholder = st.empty()
+            answer = ""
+            for chunk in streaming_answer:
+                answer += chunk
+                answer_placeholder.markdown(answer + "▌")
+            answer_placeholder.markdown(answer)
+
+        result = streaming_answer.result
 
     with sources_col:
         st.markdown("#### Sources")
@@ -119,3 +212,9 @@ if submit:
             st.markdown(source.page_content)
             st.markdown(source.metadata["source"])
             st.markdown("---")
+
+if show_timings:
+    with st.expander("Where time was spent", expanded=True):
+        display_trace(ingest_trace)
+        if submit:
+            display_trace(query_trace)
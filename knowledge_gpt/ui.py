@@ -2,6 +2,7 @@ from typing import List
 import streamlit as st
 from langchain.docstore.document import Document
 from knowledge_gpt.core.parsing import File
+from knowledge_gpt.core.instrumentation import Trace
 import openai
 from streamlit.logger import get_logger
 from typing import NoReturn
@@ -36,8 +37,32 @@ def is_file_valid(file: File) -> bool:
     return True
 
 
+def display_trace(trace: Trace) -> None:
+    """Shows the time spent in each stage of an operation and its counters"""
+    st.markdown(f"**{trace.name.capitalize()}** took {trace.seconds or 0:.3f}s")
+    if not trace.stages:
+        st.caption("Nothing was computed, the result came from the cache")
+        return
+    st.table(
+        {
+            "stage": list(trace.stages),
+            "seconds": [f"{seconds:.3f}" for seconds in trace.stages.values()],
+        }
+    )
+    if trace.counters:
+        st.table(
+            {
+                "counter": list(trace.counters),
+                "value": [f"{value:g}" for value in trace.counters.values()],
+            }
+        )
+
+
 def display_file_read_error(e: Exception, file_name: str) -> NoReturn:
-    st.error("Error reading file. Make sure the file is not corrupted or encrypted")
+    st.error(
+        "Error reading file. Make sure the file is not corrupted or encrypted"
+        " and has selectable text"
+    )
     logger.error(f"{e.__class__.__name__}: {e}. Extension: {file_name.split('.')[-1]}")
     st.stop()
 
@@ -0,0 +1,96 @@
+from typing import List
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.answer_cache import AnswerCache
+from knowledge_gpt.core.debug import FakeChatModel, FakeVectorStore
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.qa import query_folder
+
+from .fake_file import FakeFile
+
+
+def test_similar_queries_hit():
+    cache = AnswerCache(threshold=0.9)
+    cache.put("scope", [1.0, 0.0], "answer")
+
+    assert cache.get("scope", [1.0, 0.1]) == "answer"
+    assert cache.get("scope", [0.0, 1.0]) is None
+    assert cache.get("other scope", [1.0, 0.0]) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.hit_rate == 1 / 3
+
+
+def test_most_similar_query_wins():
+    cache = AnswerCache(threshold=0.5)
+    cache.put("scope", [1.0, 0.0], "first")
+    cache.put("scope", [1.0, 1.0], "second")
+
+    assert cache.get("scope", [1.0, 0.9]) == "second"
+
+
+def test_entries_expire():
+    cache = AnswerCache(ttl_seconds=0)
+    cache.put("scope", [1.0], "answer")
+
+    assert cache.get("scope", [1.0]) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", [1.0], "a")
+    cache.put("b", [1.0], "b")
+    assert cache.get("a", [1.0]) == "a"
+
+    cache.put("c", [1.0], "c")
+
+    assert len(cache) == 2
+    assert cache.get("b", [1.0]) is None
+    assert cache.get("a", [1.0]) == "a"
+
+
+class WordEmbeddings(Embeddings):
+    """Embeds a text as the counts of a few words"""
+
+    words = ["answer", "life", "universe"]
+
+    def __init__(self):
+        self.queries = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries += 1
+        return [float(text.lower().count(word)) + 0.01 for word in self.words]
+
+
+def test_query_folder_uses_answer_cache():
+    embeddings = WordEmbeddings()
+    folder_index = FolderIndex(
+        files=[FakeFile(name="file1", id="1", docs=[Document(page_content="1")])],
+        index=FakeVectorStore(texts=["1"]),
+        embeddings=embeddings,
+    )
+    llm = FakeChatModel()
+    cache = AnswerCache(threshold=0.99)
+
+    first = query_folder("The answer to life?", folder_index, llm, answer_cache=cache)
+    second = query_folder("the ANSWER to LIFE", folder_index, llm, answer_cache=cache)
+    third = query_folder(
+        "The answer to life?",
+        folder_index,
+        FakeChatModel(),
+        answer_cache=cache,
+        use_cache=False,
+    )
+
+    assert second is first
+    assert third is not first
+    # Only the first and third queries reach a model
+    assert llm.i == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Each query is embedded once
+    assert embeddings.queries == 3
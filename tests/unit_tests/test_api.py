@@ -0,0 +1,165 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+from knowledge_gpt.api import FolderRegistry, create_app
+from knowledge_gpt.core.embedding import get_embeddings
+
+TEXT = "The answer to life, the universe and everything is 42.\n" * 20
+
+
+def make_registry(index_dir: Optional[str] = None) -> FolderRegistry:
+    return FolderRegistry(
+        embeddings=get_embeddings("debug"), vector_store="faiss", index_dir=index_dir
+    )
+
+
+def run_with_client(
+    registry: FolderRegistry, test: Callable[[TestClient], Awaitable[None]]
+) -> None:
+    async def run() -> None:
+        async with TestClient(TestServer(create_app(registry))) as client:
+            await test(client)
+
+    asyncio.run(run())
+
+
+async def create_folder_with_file(client: TestClient) -> str:
+    response = await client.post("/folders", json={"name": "docs"})
+    assert response.status == 201
+    folder_id = (await response.json())["id"]
+
+    form = FormData()
+    form.add_field("file", TEXT.encode(), filename="answer.txt")
+    response = await client.post(f"/folders/{folder_id}/files", data=form)
+    assert response.status == 201
+    body = await response.json()
+    assert body["file"]["name"] == "answer.txt"
+    assert body["file"]["chunks"] > 0
+    assert "embed" in body["timings"]
+    return folder_id
+
+
+def test_ingest_and_query():
+    async def test(client: TestClient) -> None:
+        folder_id = await create_folder_with_file(client)
+
+        queries = [
+            client.post(
+                f"/folders/{folder_id}/query",
+                json={"query": "What is the answer?", "model": "debug"},
+            )
+            for _ in range(4)
+        ]
+        for response in await asyncio.gather(*queries):
+            assert response.status == 200
+            body = await response.json()
+            assert body["answer"] == "The answer is 42. "
+            assert "llm" in body["timings"]
+
+        folders = await (await client.get("/folders")).json()
+        assert [folder["name"] for folder in folders] == ["docs"]
+        assert len(folders[0]["files"]) == 1
+
+    run_with_client(make_registry(), test)
+
+
+def test_query_batch():
+    async def test(client: TestClient) -> None:
+        folder_id = await create_folder_with_file(client)
+
+        response = await client.post(
+            f"/folders/{folder_id}/query_batch",
+            json={
+                "queries": ["What is the answer?", "Why?", "What else?"],
+                "model": "debug",
+            },
+        )
+        assert response.status == 200
+        body = await response.json()
+        assert [answer["answer"] for answer in body["answers"]] == [
+            "The answer is 42. "
+        ] * 3
+        assert "llm" in body["timings"]
+
+        response = await client.post(
+            f"/folders/{folder_id}/query_batch", json={"queries": []}
+        )
+        assert response.status == 400
+        response = await client.post(
+            f"/folders/{folder_id}/query_batch",
+            json={"queries": ["Why?"], "concurrency": 0},
+        )
+        assert response.status == 400
+
+    run_with_client(make_registry(), test)
+
+
+def test_upload_raw_bytes_and_remove_file():
+    async def test(client: TestClient) -> None:
+        response = await client.post("/folders", json={"name": "docs"})
+        folder_id = (await response.json())["id"]
+
+        response = await client.post(
+            f"/folders/{folder_id}/files?name=answer.txt", data=TEXT.encode()
+        )
+        assert response.status == 201
+        file_id = (await response.json())["file"]["id"]
+
+        response = await client.delete(f"/folders/{folder_id}/files/{file_id}")
+        assert response.status == 204
+        folder = await (await client.get(f"/folders/{folder_id}")).json()
+        assert folder["files"] == []
+
+        response = await client.delete(f"/folders/{folder_id}/files/{file_id}")
+        assert response.status == 404
+
+    run_with_client(make_registry(), test)
+
+
+def test_errors():
+    async def test(client: TestClient) -> None:
+        response = await client.post("/folders/missing/query", json={"query": "?"})
+        assert response.status == 404
+        assert "error" in await response.json()
+
+        response = await client.post("/folders", json={"name": "docs"})
+        folder_id = (await response.json())["id"]
+
+        response = await client.post(
+            f"/folders/{folder_id}/query", json={"query": "?", "model": "debug"}
+        )
+        assert response.status == 409
+
+        response = await client.post(
+            f"/folders/{folder_id}/files?name=image.png", data=b"\x89PNG"
+        )
+        assert response.status == 415
+
+        response = await client.post(f"/folders/{folder_id}/query", json={})
+        assert response.status == 400
+
+    run_with_client(make_registry(), test)
+
+
+def test_folders_are_saved_and_loaded(tmp_path):
+    folder_ids = []
+
+    async def ingest(client: TestClient) -> None:
+        folder_ids.append(await create_folder_with_file(client))
+
+    run_with_client(make_registry(str(tmp_path)), ingest)
+
+    registry = make_registry(str(tmp_path))
+    assert list(registry.folders) == folder_ids
+
+    async def query(client: TestClient) -> None:
+        response = await client.post(
+            f"/folders/{folder_ids[0]}/query",
+            json={"query": "What is the answer?", "model": "debug"},
+        )
+        assert response.status == 200
+
+    run_with_client(registry, query)
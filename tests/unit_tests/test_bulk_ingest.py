@@ -0,0 +1,131 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from knowledge_gpt.bulk_ingest import (
+    CHECKPOINT_VECTORS_FILE,
+    CHECKPOINTS_DIR,
+    ingest_directory,
+    iter_checkpoints,
+    load_manifest,
+)
+from knowledge_gpt.core.chunk_store import ChunkStore
+from knowledge_gpt.core.embedding import FolderIndex, get_embeddings
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_documents(directory, count):
+    os.makedirs(directory / "nested", exist_ok=True)
+    for i in range(count):
+        path = directory / ("nested" if i % 2 else "") / f"doc_{i}.txt"
+        path.write_text(f"Document number {i} says the answer is {i * 2}.\n" * 10)
+    (directory / "image.png").write_bytes(b"\x89PNG")
+
+
+def ingest(directory, index_path, **kwargs):
+    return ingest_directory(
+        str(directory),
+        str(index_path),
+        embeddings=get_embeddings("debug"),
+        num_workers=2,
+        embed_batch_chunks=3,
+        out=io.StringIO(),
+        **kwargs,
+    )
+
+
+def test_ingest_directory(tmp_path):
+    write_documents(tmp_path / "docs", 6)
+
+    folder_index = ingest(tmp_path / "docs", tmp_path / "index")
+
+    assert sorted(file.name for file in folder_index.files) == sorted(
+        [f"doc_{i}.txt" for i in range(0, 6, 2)]
+        + [os.path.join("nested", f"doc_{i}.txt") for i in range(1, 6, 2)]
+    )
+    loaded = FolderIndex.load(str(tmp_path / "index"), get_embeddings("debug"))
+    assert len(loaded.files) == 6
+    assert len(load_manifest(str(tmp_path / "index"))) == 6
+
+
+def test_resume_after_interruption(tmp_path):
+    write_documents(tmp_path / "docs", 6)
+
+    def interrupt(files_done):
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        ingest(
+            tmp_path / "docs",
+            tmp_path / "index",
+            checkpoint_every=2,
+            on_checkpoint=interrupt,
+        )
+    assert len(load_manifest(str(tmp_path / "index"))) == 2
+
+    checkpoints = []
+    folder_index = ingest(
+        tmp_path / "docs",
+        tmp_path / "index",
+        checkpoint_every=2,
+        on_checkpoint=checkpoints.append,
+    )
+
+    # Only the 4 files that were not checkpointed are read again
+    assert checkpoints == [4, 6, 6]
+    assert len(folder_index.files) == 6
+
+
+def test_checkpoints_only_write_new_files(tmp_path):
+    write_documents(tmp_path / "docs", 6)
+
+    def interrupt(files_done):
+        if files_done == 6:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        ingest(
+            tmp_path / "docs",
+            tmp_path / "index",
+            checkpoint_every=2,
+            on_checkpoint=interrupt,
+        )
+
+    checkpoints = list(iter_checkpoints(str(tmp_path / "index")))
+    assert [len(checkpoint["files"]) for _, checkpoint in checkpoints] == [2, 2, 2]
+    for path, _ in checkpoints:
+        vectors = np.load(os.path.join(path, CHECKPOINT_VECTORS_FILE))
+        assert len(vectors) == len(ChunkStore.load(path))
+
+    # The checkpoints are merged into the index without reading files again
+    folder_index = ingest(tmp_path / "docs", tmp_path / "index")
+    assert len(folder_index.files) == 6
+    assert not os.path.exists(tmp_path / "index" / CHECKPOINTS_DIR)
+    loaded = FolderIndex.load(str(tmp_path / "index"), get_embeddings("debug"))
+    assert len(loaded.files) == 6
+    assert len(loaded.chunks) == len(folder_index.chunks)
+
+
+def test_changed_files_are_replaced(tmp_path):
+    write_documents(tmp_path / "docs", 2)
+    folder_index = ingest(tmp_path / "docs", tmp_path / "index")
+    old_ids = {file.name: file.id for file in folder_index.files}
+
+    path = tmp_path / "docs" / "doc_0.txt"
+    path.write_text("This document was rewritten.")
+    os.utime(path, (0, 0))
+    folder_index = ingest(tmp_path / "docs", tmp_path / "index")
+
+    new_ids = {file.name: file.id for file in folder_index.files}
+    assert new_ids.keys() == old_ids.keys()
+    assert new_ids["doc_0.txt"] != old_ids["doc_0.txt"]
+    assert (
+        new_ids[os.path.join("nested", "doc_1.txt")]
+        == old_ids[os.path.join("nested", "doc_1.txt")]
+    )
+    assert load_manifest(str(tmp_path / "index"))["doc_0.txt"].mtime == 0
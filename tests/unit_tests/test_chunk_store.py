@@ -0,0 +1,102 @@
+import pickle
+
+import pytest
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.chunk_store import ChunkStore, ChunkView, as_document
+
+
+def make_docs():
+    return [
+        Document(
+            page_content="first",
+            metadata={"page": 1, "chunk": 1, "source": "1-1"},
+        ),
+        Document(
+            page_content="second",
+            metadata={"page": 1, "chunk": 2, "source": "1-2"},
+        ),
+        Document(page_content="third", metadata={"source": "custom"}),
+    ]
+
+
+def test_store_round_trips_documents():
+    store = ChunkStore.from_documents(make_docs())
+
+    assert len(store) == 3
+    assert [doc.page_content for doc in store] == ["first", "second", "third"]
+    assert store[0].metadata == {"page": 1, "chunk": 1, "source": "1-1"}
+    assert store[2].metadata == {"source": "custom"}
+    assert store[1].to_document() == make_docs()[1]
+
+
+def test_store_tags_file():
+    store = ChunkStore()
+    rows = store.extend(make_docs()[:2], file_name="file1", file_id="1")
+    store.extend(make_docs()[2:], file_name="file2", file_id="2")
+
+    assert len(rows) == 2
+    assert rows[1].metadata["file_name"] == "file1"
+    assert store[2].metadata["file_id"] == "2"
+    assert store.file_id(0) == "1"
+
+
+def test_compact_keeps_texts():
+    store = ChunkStore()
+    for doc in make_docs():
+        store.extend([doc])
+    assert len(store._buffers) == 3
+
+    store.compact()
+
+    assert len(store._buffers) == 1
+    assert [doc.page_content for doc in store] == ["first", "second", "third"]
+    assert store.source(2) == "custom"
+
+
+def test_slices_are_views():
+    store = ChunkStore.from_documents(make_docs())
+    chunks = store[1:]
+
+    assert len(chunks) == 2
+    assert chunks.store is store
+    assert chunks[0] == ChunkView(store, 1)
+    assert chunks[1:][0].page_content == "third"
+    with pytest.raises(ValueError):
+        store[::2]
+
+
+def test_as_document():
+    store = ChunkStore.from_documents(make_docs())
+    doc = make_docs()[0]
+
+    assert as_document(doc) is doc
+    assert as_document(store[0]) == doc
+
+
+def test_store_pickles():
+    store = ChunkStore.from_documents(make_docs())
+    copy = pickle.loads(pickle.dumps(store))
+
+    assert [doc.to_document() for doc in copy] == [doc.to_document() for doc in store]
+
+
+def test_save_and_load_mmap(tmp_path):
+    store = ChunkStore.from_documents(make_docs())
+    store.save(str(tmp_path))
+
+    loaded = ChunkStore.load(str(tmp_path), mmap_mode=True)
+    assert [doc.to_document() for doc in loaded] == make_docs()
+
+    # Adding chunks copies the columns but keeps the mapped texts
+    loaded.extend([Document(page_content="fourth")])
+    loaded.compact()
+    assert [doc.page_content for doc in loaded] == [
+        "first",
+        "second",
+        "third",
+        "fourth",
+    ]
+
+    copy = pickle.loads(pickle.dumps(loaded))
+    assert copy[0].page_content == "first"
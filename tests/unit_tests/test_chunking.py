@@ -1,7 +1,7 @@
 import pytest
 from langchain.docstore.document import Document
 
-from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.chunking import TokenChunker, chunk_file, iter_chunks
 from .fake_file import FakeFile
 
 
@@ -53,3 +53,46 @@ def test_chunk_file_multi_page_no_overlap(multi_page_file):
 
     assert chunked_file.docs[0].metadata["source"] == "1-1"
     assert chunked_file.docs[1].metadata["source"] == "2-1"
+
+
+def test_iter_chunks_is_lazy(multi_page_file):
+    chunks = iter_chunks(iter(multi_page_file.docs), chunk_size=10, chunk_overlap=0)
+
+    first_chunk = next(chunks)
+    assert first_chunk.page_content == "This is the first page"
+    assert first_chunk.metadata["source"] == "1-1"
+
+    assert [chunk.metadata["source"] for chunk in chunks] == ["2-1"]
+
+
+def test_token_chunker_respects_chunk_size():
+    text = "\n".join(f"Line number {i} of a long page." for i in range(200))
+    chunker = TokenChunker(chunk_size=50)
+
+    chunks = chunker.split_text(text)
+
+    assert len(chunks) > 1
+    assert all(len(chunker.encoding.encode(chunk)) <= 50 for chunk in chunks)
+    # Chunks end on line breaks, so no line is cut in half
+    assert "\n".join(chunks) == text
+
+
+def test_token_chunker_overlap():
+    text = " ".join(f"word{i}" for i in range(100))
+    chunks = TokenChunker(chunk_size=20, chunk_overlap=5).split_text(text)
+
+    assert len(chunks) > 1
+    for previous, current in zip(chunks, chunks[1:]):
+        assert previous.split()[-1] in current.split()
+
+
+def test_token_chunker_does_not_split_characters():
+    text = "日本語のテキスト" * 50
+    chunks = TokenChunker(chunk_size=7).split_text(text)
+
+    assert "".join(chunks) == text
+
+
+def test_token_chunker_invalid_overlap():
+    with pytest.raises(ValueError):
+        TokenChunker(chunk_size=10, chunk_overlap=10)
@@ -0,0 +1,123 @@
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.chunk_store import ChunkStore
+from knowledge_gpt.core.chunking import chunk_file
+from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.dedup import ChunkDeduplicator
+from knowledge_gpt.core.embedding import FolderIndex
+from knowledge_gpt.core.qa import get_sources
+
+from .fake_file import FakeFile
+
+DISCLAIMER = (
+    "This document is provided for information purposes only and does not "
+    "constitute an offer to sell or a solicitation of an offer to buy any "
+    "security. Past performance is no guarantee of future results, and the "
+    "value of investments can go down as well as up."
+)
+
+
+def test_exact_duplicates_ignore_whitespace_but_not_case():
+    deduplicator = ChunkDeduplicator()
+
+    assert deduplicator.find(DISCLAIMER) is None
+    assert deduplicator.find("  " + DISCLAIMER.replace(" ", "\n")) == 0
+    assert deduplicator.find(DISCLAIMER.upper()) is None
+    assert deduplicator.find("Shipping to the US") is None
+    assert deduplicator.find("Shipping to the us") is None
+
+
+def test_near_duplicates():
+    deduplicator = ChunkDeduplicator(near_duplicates=True)
+    other = "Revenue grew by twelve percent in the third quarter of the year."
+
+    assert deduplicator.find(DISCLAIMER) is None
+    assert deduplicator.find(other) is None
+    assert deduplicator.find(DISCLAIMER.replace("go down", "fall")) == 0
+    assert deduplicator.find(other.replace("third", "fourth")) is None
+    assert deduplicator.num_unique == 3
+
+
+def make_file() -> FakeFile:
+    pages = [f"Page {page} says something else.\n\n{DISCLAIMER}" for page in (1, 2)]
+    pages.append(DISCLAIMER.replace("information", "informational"))
+    return FakeFile(
+        name="report.pdf",
+        id="report",
+        docs=[
+            Document(page_content=text, metadata={"page": page})
+            for page, text in enumerate(pages, 1)
+        ],
+    )
+
+
+def test_chunk_file_drops_duplicates():
+    chunked_file = chunk_file(
+        make_file(), chunk_size=50, deduplicate=True, near_duplicates=True
+    )
+
+    assert [doc.page_content for doc in chunked_file.docs] == [
+        "Page 1 says something else.",
+        DISCLAIMER,
+        "Page 2 says something else.",
+    ]
+    assert chunked_file.docs[1].metadata["duplicates"] == ["2-2", "3-1"]
+
+
+def test_chunks_that_differ_in_facts_are_kept():
+    first = (
+        "The first lot of the auction, a set of six silver spoons made in London "
+        "around 1760, was sold to a private collector after a short bidding war "
+        "between two dealers and a museum. The hammer price was 120,000 dollars, "
+        "well above the estimate published in the catalogue, and the buyer "
+        "premium was paid by the collector on the day of the sale."
+    )
+    second = first.replace("first", "second").replace("120,000", "480,000")
+    file = FakeFile(
+        name="auction.pdf",
+        id="auction",
+        docs=[
+            Document(page_content=text, metadata={"page": page})
+            for page, text in enumerate([first, second, "\n" + first], 1)
+        ],
+    )
+
+    # Nothing is dropped by default
+    chunked_file = chunk_file(file, chunk_size=200)
+    assert len(chunked_file.docs) == 3
+
+    # Only the exact repeat of the first lot is dropped, near duplicate
+    # detection would merge the two lots
+    chunked_file = chunk_file(file, chunk_size=200, deduplicate=True)
+    assert [doc.page_content for doc in chunked_file.docs] == [first, second]
+    assert chunked_file.docs[0].metadata["duplicates"] == ["3-1"]
+
+    chunked_file = chunk_file(
+        file, chunk_size=200, deduplicate=True, near_duplicates=True
+    )
+    assert [doc.page_content for doc in chunked_file.docs] == [first]
+
+
+def test_citing_a_duplicate_finds_the_kept_chunk():
+    chunked_file = chunk_file(
+        make_file(), chunk_size=50, deduplicate=True, near_duplicates=True
+    )
+    folder_index = FolderIndex(files=[chunked_file], index=FakeVectorStore(texts=[]))
+
+    sources = get_sources("The answer. SOURCES: 3-1", folder_index)
+
+    assert [doc.page_content for doc in sources] == [DISCLAIMER]
+    assert sources[0].metadata["source"] == "1-2"
+    assert folder_index.get_chunks("2-2") == folder_index.get_chunks("1-2")
+
+
+def test_duplicates_are_saved(tmp_path):
+    store = ChunkStore.from_documents(
+        [Document(page_content=DISCLAIMER, metadata={"page": 1, "chunk": 1})]
+    )
+    store.add_duplicates(0, ["2-1", "3-1"])
+    store.save(str(tmp_path))
+
+    loaded = ChunkStore.load(str(tmp_path))
+
+    assert loaded[0].metadata["duplicates"] == ["2-1", "3-1"]
@@ -1,8 +1,12 @@
+import numpy as np
+import pytest
+
 from knowledge_gpt.core.embedding import FolderIndex, embed_files
 from .fake_file import FakeFile
 from langchain.docstore.document import Document
 from knowledge_gpt.core.parsing import File
-from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.debug import FakeEmbeddings, FakeVectorStore
+from knowledge_gpt.core.vector_store import Int8FAISS, is_compressed
 from typing import List
 
 
@@ -40,6 +44,23 @@ def test_combining_files():
     assert all_docs[3].metadata["file_id"] == "2"
 
 
+def test_combining_files_does_not_mutate_shared_docs():
+    """Tests that a document shared by two files keeps its own metadata."""
+
+    doc = Document(page_content="1", metadata={"source": "1-1"})
+    files: List[File] = [
+        FakeFile(name="file1", id="1", docs=[doc]),
+        FakeFile(name="file2", id="2", docs=[doc]),
+    ]
+
+    all_docs = FolderIndex._combine_files(files)
+
+    assert doc.metadata == {"source": "1-1"}
+    assert all_docs[0].metadata["file_id"] == "1"
+    assert all_docs[1].metadata["file_id"] == "2"
+    assert all_docs[0].metadata["source"] == "1-1"
+
+
 def test_embed_fake_embedding_vector_store():
     """Tests that embedding files works for a fake embedding
     and a fake vector store.
@@ -74,3 +95,211 @@ def test_embed_fake_embedding_vector_store():
     assert folder_index.index.texts[3] == "4"
     assert folder_index.index.texts[0] == folder_index.files[0].docs[0].page_content
     assert folder_index.index.texts[1] == folder_index.files[0].docs[1].page_content
+
+
+def test_index_from_stream_in_batches():
+    """Tests that a stream of documents is indexed in order in several batches."""
+
+    file = FakeFile(name="file1", id="1")
+    docs = (Document(page_content=str(i)) for i in range(10))
+
+    folder_index = FolderIndex.from_stream(
+        file=file,
+        docs=docs,
+        embeddings=FakeEmbeddings(),
+        vector_store=FakeVectorStore,
+        batch_size=3,
+    )
+
+    assert isinstance(folder_index.index, FakeVectorStore)
+    assert len(folder_index.files) == 1
+    assert folder_index.index.texts == [str(i) for i in range(10)]
+
+    indexed_file = folder_index.files[0]
+    assert indexed_file.name == file.name
+    assert [doc.page_content for doc in indexed_file.docs] == [
+        str(i) for i in range(10)
+    ]
+    assert indexed_file.docs[0].metadata["file_id"] == "1"
+
+
+class GrowingEmbeddings(FakeEmbeddings):
+    """Vectors of the texts "0", "1", ... whose values grow with the text"""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [int(text) / 100 + i for i in range(4)]
+
+
+def test_compressed_index_from_stream_is_trained_on_all_batches():
+    file = FakeFile(name="file1", id="1")
+    docs = (Document(page_content=str(i)) for i in range(300))
+
+    folder_index = FolderIndex.from_stream(
+        file=file,
+        docs=docs,
+        embeddings=GrowingEmbeddings(),
+        vector_store=Int8FAISS,
+        batch_size=100,
+    )
+
+    # Vectors of the last batch are outside the range of the first one, they
+    # would be clipped by an index trained on the first batch only
+    index = folder_index.index.index
+    assert is_compressed(index)
+    vectors = index.index.reconstruct_n(0, 300)
+    expected = np.array([GrowingEmbeddings().embed_query(str(i)) for i in range(300)])
+    assert np.abs(vectors - expected).max() < 0.05
+
+
+def test_index_from_empty_stream():
+    with pytest.raises(ValueError):
+        FolderIndex.from_stream(
+            file=FakeFile(name="file1", id="1"),
+            docs=iter([]),
+            embeddings=FakeEmbeddings(),
+            vector_store=FakeVectorStore,
+        )
+
+
+def make_file(name: str, id: str, texts: List[str]) -> File:
+    return FakeFile(
+        name=name,
+        id=id,
+        docs=[
+            Document(page_content=text, metadata={"source": f"1-{i + 1}"})
+            for i, text in enumerate(texts)
+        ],
+    )
+
+
+def test_add_and_remove_files():
+    """Tests that files are added and removed without re-indexing the folder."""
+
+    folder_index = embed_files(
+        files=[make_file("file1", "1", ["a", "b"])],
+        embedding="debug",
+        vector_store="faiss",
+    )
+    index = folder_index.index
+
+    added = folder_index.add_files(
+        [make_file("file1", "1", ["a", "b"]), make_file("file2", "2", ["c"])]
+    )
+
+    # file1 is already indexed and is skipped
+    assert [file.id for file in added] == ["2"]
+    assert folder_index.index is index
+    assert index.index.ntotal == 3
+    assert folder_index.get_chunk("2", "1-1").page_content == "c"
+
+    removed = folder_index.remove_files(["1", "3"])
+
+    assert [file.id for file in removed] == ["1"]
+    assert [file.id for file in folder_index.files] == ["2"]
+    assert index.index.ntotal == 1
+    assert folder_index.get_chunk("1", "1-1") is None
+    assert folder_index.get_chunks("1-1")[0].page_content == "c"
+    assert [doc.page_content for doc in index.similarity_search("a", k=4)] == ["c"]
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_and_load(tmp_path, mmap):
+    """Tests that a saved index loads back with the same files and vectors."""
+
+    folder_index = embed_files(
+        files=[
+            make_file("file1", "1", ["a", "b"]),
+            make_file("file2", "2", ["c", "ünïcode"]),
+        ],
+        embedding="debug",
+        vector_store="faiss",
+    )
+    folder_index.save(str(tmp_path))
+
+    loaded = FolderIndex.load(str(tmp_path), embeddings=FakeEmbeddings(), mmap=mmap)
+
+    assert [(file.name, file.id) for file in loaded.files] == [
+        ("file1", "1"),
+        ("file2", "2"),
+    ]
+    assert all(isinstance(file, FakeFile) for file in loaded.files)
+    assert [doc.page_content for doc in loaded.files[1].docs] == ["c", "ünïcode"]
+    assert loaded.files[1].docs[1].metadata == {
+        "source": "1-2",
+        "file_name": "file2",
+        "file_id": "2",
+    }
+    assert loaded.get_chunk("2", "1-2").page_content == "ünïcode"
+    assert loaded.index.index.ntotal == 4
+    assert len(loaded.index.similarity_search("a", k=4)) == 4
+
+    # A loaded index can still grow
+    loaded.add_files([make_file("file3", "3", ["d"])])
+    assert loaded.get_chunk("3", "1-1").page_content == "d"
+    assert loaded.get_chunk("1", "1-1").page_content == "a"
+    assert loaded.index.index.ntotal == 5
+
+
+def test_save_unsupported_vector_store(tmp_path):
+    folder_index = embed_files(
+        files=[make_file("file1", "1", ["a"])],
+        embedding="debug",
+        vector_store="debug",
+    )
+    with pytest.raises(NotImplementedError):
+        folder_index.save(str(tmp_path))
+
+
+def test_search_modes():
+    """Tests lexical, vector and hybrid retrieval over a folder."""
+
+    folder_index = embed_files(
+        files=[
+            make_file("file1", "1", ["the pump", "part AB-1234"]),
+            make_file("file2", "2", ["the valve"]),
+        ],
+        embedding="debug",
+        vector_store="faiss",
+    )
+
+    lexical = folder_index.search("AB-1234", k=2, mode="lexical")
+    assert [doc.page_content for doc in lexical] == ["part AB-1234"]
+    assert lexical[0].metadata["file_id"] == "1"
+
+    hybrid = folder_index.search("AB-1234", k=3, mode="hybrid")
+    assert len(hybrid) == 3
+    assert hybrid[0].page_content == "part AB-1234"
+
+    assert len(folder_index.search("AB-1234", k=3, mode="vector")) == 3
+    with pytest.raises(NotImplementedError):
+        folder_index.search("AB-1234", mode="unknown")
+
+    folder_index.add_files([make_file("file3", "3", ["part AB-1234 again"])])
+    folder_index.remove_files(["1"])
+    lexical = folder_index.search("AB-1234", k=2, mode="lexical")
+    assert [doc.page_content for doc in lexical] == ["part AB-1234 again"]
+
+
+@pytest.mark.parametrize("mode", ["vector", "lexical", "hybrid"])
+def test_search_batch_matches_search(mode):
+    folder_index = embed_files(
+        files=[
+            make_file("file1", "1", ["the pump", "part AB-1234"]),
+            make_file("file2", "2", ["the valve", "part CD-5678"]),
+        ],
+        embedding="debug",
+        vector_store="faiss",
+    )
+    queries = ["AB-1234", "the valve", "CD-5678"]
+    # The debug embeddings are random, the same vectors are given to both
+    vectors = folder_index.embeddings.embed_documents(queries)
+
+    batch = folder_index.search_batch(queries, k=3, mode=mode, query_vectors=vectors)
+
+    assert batch == [
+        folder_index.search(query, k=3, mode=mode, query_vector=vector)
+        for query, vector in zip(queries, vectors)
+    ]
@@ -0,0 +1,155 @@
+import pickle
+from typing import List
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.embedding import embed_files
+from knowledge_gpt.core.embedding_cache import (
+    CACHE_FILE,
+    CachedEmbeddings,
+    EmbeddingCache,
+    get_embedding_cache,
+)
+from knowledge_gpt.core.parsing import File
+
+from .fake_file import FakeFile
+
+
+class CountingEmbeddings(Embeddings):
+    """Deterministic embeddings that record which texts were embedded"""
+
+    def __init__(self):
+        self.embedded: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(len(text)), 1.0]
+
+
+def test_cache_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(tmp_path)
+    cache.put_many("model", ["a", "bb"], [[1.0, 2.0], [3.0, 4.0]])
+
+    vectors = cache.get_many("model", ["a", "bb", "ccc"])
+
+    assert vectors == [[1.0, 2.0], [3.0, 4.0], None]
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+
+def test_cache_is_keyed_by_model(tmp_path):
+    cache = EmbeddingCache(tmp_path)
+    cache.put_many("model-1", ["a"], [[1.0]])
+
+    assert cache.get_many("model-2", ["a"]) == [None]
+
+
+def test_cache_persists_across_instances(tmp_path):
+    EmbeddingCache(tmp_path).put_many("model", ["a"], [[1.0, 2.0]])
+
+    assert EmbeddingCache(tmp_path).get_many("model", ["a"]) == [[1.0, 2.0]]
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    # Each vector takes up 8 bytes, so only two of them fit
+    cache = EmbeddingCache(tmp_path, max_size_bytes=16)
+    cache.put_many("model", ["a"], [[1.0, 1.0]])
+    cache.put_many("model", ["b"], [[2.0, 2.0]])
+    cache.get_many("model", ["a"])
+    cache.put_many("model", ["c"], [[3.0, 3.0]])
+
+    assert len(cache) == 2
+    assert cache.size_bytes() == 16
+    assert cache.get_many("model", ["a", "b", "c"]) == [[1.0, 1.0], None, [3.0, 3.0]]
+
+
+def test_cache_keeps_a_running_size(tmp_path):
+    cache = EmbeddingCache(tmp_path, max_size_bytes=100)
+    scans = []
+    scan = cache._size_bytes
+    cache._size_bytes = lambda: scans.append(1) or scan()
+
+    cache.put_many("model", ["a", "b"], [[1.0, 1.0], [2.0, 2.0]])
+    cache.put_many("model", ["a"], [[1.0, 1.0, 1.0]])
+
+    # Writes below the limit don't scan the table, replaced vectors are
+    # counted once
+    assert (cache._size, scans) == (20, [])
+    assert EmbeddingCache(tmp_path)._size == 20
+
+    cache.put_many("model", [str(i) for i in range(12)], [[0.0, 0.0]] * 12)
+    assert scans
+    assert cache._size == scan() <= 100
+
+
+def test_cached_embeddings_only_embed_new_texts(tmp_path):
+    base = CountingEmbeddings()
+    embeddings = CachedEmbeddings(base, cache=EmbeddingCache(tmp_path), model="test")
+
+    first = embeddings.embed_documents(["one", "two", "one"])
+    second = embeddings.embed_documents(["two", "three"])
+
+    assert base.embedded == ["one", "two", "three"]
+    assert first == [[3.0, 1.0], [3.0, 1.0], [3.0, 1.0]]
+    assert second == [[3.0, 1.0], [5.0, 1.0]]
+
+
+def test_embed_files_with_cache_dir(tmp_path):
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content="1"), Document(page_content="2")],
+        ),
+    ]
+
+    for _ in range(2):
+        embed_files(
+            files=files,
+            embedding="debug",
+            vector_store="faiss",
+            cache_dir=str(tmp_path),
+        )
+
+    cache = get_embedding_cache(str(tmp_path))
+    assert len(cache) == 2
+    assert cache.misses == 2
+    assert cache.hits == 2
+
+
+def test_cache_pickles_by_path(tmp_path):
+    cache = EmbeddingCache(tmp_path, max_size_bytes=100)
+    cache.put_many("model", ["a"], [[1.0, 2.0]])
+
+    copy = pickle.loads(pickle.dumps(cache))
+
+    assert copy.path == cache.path
+    assert copy.max_size_bytes == 100
+    assert copy.get_many("model", ["a"]) == [[1.0, 2.0]]
+    assert pickle.loads(pickle.dumps(cache)) is copy
+
+
+def test_embed_files_with_cache_dir_pickles(tmp_path):
+    """The app caches the result of embed_files with st.cache_data"""
+    folder_index = embed_files(
+        files=[FakeFile(name="file1", id="1", docs=[Document(page_content="1")])],
+        embedding="debug",
+        vector_store="faiss",
+        cache_dir=str(tmp_path),
+    )
+
+    copy = pickle.loads(pickle.dumps(folder_index))
+
+    assert len(copy.files) == 1
+
+
+def test_cache_directory_with_a_dot(tmp_path):
+    cache = EmbeddingCache(tmp_path / "cache.v2")
+
+    assert cache.path == tmp_path / "cache.v2" / CACHE_FILE
+    # The database file itself can be given too
+    assert EmbeddingCache(cache.path).path == cache.path
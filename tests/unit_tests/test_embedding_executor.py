@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+from typing import List
+
+import openai
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.embedding_executor import ConcurrentEmbeddings, is_retryable
+
+
+class SlowEmbeddings(Embeddings):
+    """Embeddings that take a random time per request and fail the first
+    `failures` requests with the given error"""
+
+    def __init__(self, failures: int = 0, error: Exception = None):
+        self.failures = failures
+        self.error = error
+        self.batches: List[List[str]] = []
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise self.error
+            self.batches.append(texts)
+        time.sleep(random.random() / 100)
+        return [[float(text)] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(text)]
+
+
+def make_embeddings(embeddings: Embeddings, **kwargs) -> ConcurrentEmbeddings:
+    return ConcurrentEmbeddings(embeddings, min_backoff=0, max_backoff=0, **kwargs)
+
+
+def test_results_keep_order():
+    embeddings = SlowEmbeddings()
+    texts = [str(i) for i in range(100)]
+
+    vectors = make_embeddings(
+        embeddings, max_workers=4, max_batch_size=7
+    ).embed_documents(texts)
+
+    assert vectors == [[float(i)] for i in range(100)]
+    assert len(embeddings.batches) == 15
+    assert max(len(batch) for batch in embeddings.batches) == 7
+
+
+def test_batches_are_sized_by_tokens():
+    embeddings = make_embeddings(SlowEmbeddings(), max_batch_tokens=10)
+    # Every text is 5 tokens
+    texts = ["one two three four five"] * 5 + ["one " * 30]
+
+    batches = list(embeddings._batches(texts))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1, 1]
+
+
+def test_transient_errors_are_retried():
+    error = openai.error.RateLimitError("Too many requests", http_status=429)
+    embeddings = SlowEmbeddings(failures=2, error=error)
+
+    vectors = make_embeddings(embeddings).embed_documents(["1", "2"])
+
+    assert vectors == [[1.0], [2.0]]
+
+
+def test_other_errors_are_raised():
+    error = openai.error.InvalidRequestError("Bad request", param=None)
+    embeddings = SlowEmbeddings(failures=1, error=error)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        make_embeddings(embeddings).embed_documents(["1", "2"])
+    assert embeddings.batches == []
+
+
+def test_is_retryable():
+    assert is_retryable(openai.error.APIError("Server error", http_status=502))
+    assert not is_retryable(openai.error.APIError("Not found", http_status=404))
+    assert not is_retryable(ValueError())
@@ -0,0 +1,82 @@
+from io import BytesIO
+
+from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.ingestion import ingest_file
+from knowledge_gpt.core.parsing import PdfFile
+
+from .test_parsing import SAMPLE_ROOT
+
+
+def test_ingest_file():
+    with open(SAMPLE_ROOT / "test_hello_multi.pdf", "rb") as f:
+        file = BytesIO(f.read())
+        file.name = "test_hello_multi.pdf"
+
+    folder_index = ingest_file(
+        file,
+        chunk_size=300,
+        embedding="debug",
+        vector_store="debug",
+        batch_size=2,
+    )
+
+    assert isinstance(folder_index.index, FakeVectorStore)
+    assert folder_index.index.texts == [
+        "Hello World 1",
+        "Hello World 2",
+        "Hello World 3",
+    ]
+
+    (chunked_file,) = folder_index.files
+    assert isinstance(chunked_file, PdfFile)
+    assert chunked_file.name == "test_hello_multi.pdf"
+    assert [doc.metadata["source"] for doc in chunked_file.docs] == [
+        "1-1",
+        "2-1",
+        "3-1",
+    ]
+
+
+def test_ingest_file_saves_and_loads_index(tmp_path, monkeypatch):
+    with open(SAMPLE_ROOT / "test_hello_multi.pdf", "rb") as f:
+        file = BytesIO(f.read())
+        file.name = "test_hello_multi.pdf"
+
+    kwargs = dict(
+        chunk_size=300,
+        embedding="debug",
+        vector_store="faiss",
+        index_dir=str(tmp_path),
+    )
+    folder_index = ingest_file(file, **kwargs)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # The second time the file is not parsed at all
+    monkeypatch.setattr("knowledge_gpt.core.ingestion.stream_file", None)
+    loaded = ingest_file(file, **kwargs)
+
+    assert loaded.index.index.ntotal == folder_index.index.index.ntotal == 3
+    assert [doc.page_content for doc in loaded.files[0].docs] == [
+        "Hello World 1",
+        "Hello World 2",
+        "Hello World 3",
+    ]
+
+
+def test_ingest_file_drops_duplicate_chunks():
+    footer = "Confidential. Do not distribute without the written consent of ACME."
+    file = BytesIO(
+        "\n\n".join(
+            f"Section {i} of the report.\n\n{footer}" for i in range(4)
+        ).encode()
+    )
+    file.name = "report.txt"
+
+    folder_index = ingest_file(
+        file, chunk_size=20, embedding="debug", vector_store="faiss", batch_size=2
+    )
+
+    assert folder_index.index.index.ntotal == 5
+    (chunk,) = [doc for doc in folder_index.files[0].docs if doc.page_content == footer]
+    assert chunk.metadata["duplicates"] == ["1-4", "1-6", "1-8"]
+    assert folder_index.get_chunk(folder_index.files[0].id, "1-8") == chunk
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from knowledge_gpt.core.debug import FakeChatModel
+from knowledge_gpt.core.instrumentation import (
+    Metrics,
+    get_metrics,
+    in_current_context,
+    increment,
+    timed,
+    timed_iter,
+    trace,
+)
+from knowledge_gpt.core.qa import query_folder, stream_query_folder
+
+from .test_qa import make_folder_index
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    get_metrics().reset()
+
+
+def test_nested_stages_are_exclusive():
+    with trace("ingest") as operation:
+        with timed("embed"):
+            time.sleep(0.02)
+            with timed("parse"):
+                time.sleep(0.05)
+
+    assert operation.stages["parse"] >= 0.05
+    # Would be at least 0.07 if the nested stage was counted
+    assert 0.02 <= operation.stages["embed"] < 0.05
+    assert operation.seconds >= sum(operation.stages.values())
+    assert get_metrics().last_trace("ingest") is operation
+
+
+def test_timed_iter_counts_items_and_skips_consumer_time():
+    def produce():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    with trace("ingest") as operation:
+        for _ in timed_iter("parse", produce(), counter="pages_parsed"):
+            time.sleep(0.02)
+
+    # Would be at least 0.09 if the consumer's time was counted
+    assert 0.03 <= operation.stages["parse"] < 0.07
+    assert operation.counters["pages_parsed"] == 3
+
+
+def test_counters_from_other_threads_reach_the_trace():
+    with trace("ingest") as operation:
+        threads = [
+            threading.Thread(target=in_current_context(increment), args=("requests",))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert operation.counters["requests"] == 4
+    assert get_metrics().get_counter("requests") == 4
+
+
+def test_prometheus_format():
+    metrics = Metrics()
+    metrics.increment("pages_parsed", 3)
+    metrics.observe("stage", 0.02, stage="parse")
+    metrics.observe("stage", 3.0, stage="parse")
+
+    lines = metrics.to_prometheus().splitlines()
+
+    assert "# TYPE knowledge_gpt_pages_parsed_total counter" in lines
+    assert "knowledge_gpt_pages_parsed_total 3" in lines
+    assert "# TYPE knowledge_gpt_stage_seconds histogram" in lines
+    assert 'knowledge_gpt_stage_seconds_bucket{stage="parse",le="0.01"} 0' in lines
+    assert 'knowledge_gpt_stage_seconds_bucket{stage="parse",le="0.025"} 1' in lines
+    assert 'knowledge_gpt_stage_seconds_bucket{stage="parse",le="+Inf"} 2' in lines
+    assert 'knowledge_gpt_stage_seconds_count{stage="parse"} 2' in lines
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_query_stages(streaming):
+    folder_index = make_folder_index()
+    llm = FakeChatModel(streaming=streaming)
+
+    with trace("query") as operation:
+        if streaming:
+            stream_query_folder("What is the answer?", folder_index, llm).result
+        else:
+            query_folder("What is the answer?", folder_index, llm)
+
+    assert set(operation.stages) == {"search", "pack", "llm"}
+    assert operation.counters["llm_requests"] == 1
+    assert operation.counters["llm_prompt_tokens"] > 0
+    assert operation.counters["llm_completion_tokens"] > 0
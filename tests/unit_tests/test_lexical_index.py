@@ -0,0 +1,70 @@
+from langchain.docstore.document import Document
+
+from knowledge_gpt.core.lexical_index import (
+    BM25Index,
+    reciprocal_rank_fusion,
+    tokenize,
+)
+
+
+def make_docs():
+    return [
+        Document(page_content="The pump is rated for 40 bar."),
+        Document(page_content="Replace part AB-1234 every year."),
+        Document(page_content="The pump and the valve are made of steel."),
+        Document(page_content="Clause 4.2.1 covers the warranty."),
+    ]
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("Part AB-1234, clause 4.2.1") == [
+        "part",
+        "ab-1234",
+        "ab",
+        "1234",
+        "clause",
+        "4.2.1",
+        "4",
+        "2",
+        "1",
+    ]
+
+
+def test_search_ranks_by_bm25():
+    index = BM25Index()
+    docs = make_docs()
+    index.add(docs)
+
+    results = index.search("pump rating", k=4)
+
+    assert [doc for doc, _ in results] == [docs[0], docs[2]]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_search_exact_identifiers():
+    index = BM25Index()
+    docs = make_docs()
+    index.add(docs)
+
+    assert index.search("ab-1234", k=1)[0][0] is docs[1]
+    assert index.search("What does clause 4.2.1 say?", k=1)[0][0] is docs[3]
+    assert index.search("unknown words", k=4) == []
+
+
+def test_removed_docs_are_not_returned():
+    index = BM25Index()
+    docs = make_docs()
+    numbers = index.add(docs)
+
+    index.remove([numbers[0]])
+
+    assert len(index) == 3
+    assert [doc for doc, _ in index.search("pump", k=4)] == [docs[2]]
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion(
+        [["a", "b", "c"], ["c", "d", "a"]], key=lambda doc: doc, k=3
+    )
+
+    assert fused == ["a", "c", "b"]
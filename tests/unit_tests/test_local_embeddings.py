@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from knowledge_gpt.core import local_embeddings
+from knowledge_gpt.core.local_embeddings import (
+    LocalEmbeddings,
+    length_batches,
+    mean_pool,
+    normalize,
+)
+
+
+class FakeTokenizer:
+    pad_token_id = 0
+
+    def __call__(self, texts, truncation, max_length):
+        # One token per word, the token id is the length of the word
+        return {
+            "input_ids": [
+                [len(word) for word in text.split()][:max_length] for text in texts
+            ]
+        }
+
+
+class FakeSession:
+    """Token vectors are [token id, 1], so pooling gives the mean word length"""
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def get_inputs(self):
+        return [
+            SimpleNamespace(name="input_ids"),
+            SimpleNamespace(name="attention_mask"),
+        ]
+
+    def run(self, output_names, inputs):
+        input_ids = inputs["input_ids"]
+        self.batch_shapes.append(input_ids.shape)
+        hidden_states = np.stack(
+            [input_ids.astype(np.float32), np.ones(input_ids.shape, np.float32)],
+            axis=-1,
+        )
+        # Padding gets a vector that would skew the mean if it wasn't ignored
+        hidden_states[inputs["attention_mask"] == 0] = 100.0
+        return [hidden_states]
+
+
+def test_mean_pool_ignores_padding():
+    hidden_states = np.array([[[1.0, 2.0], [3.0, 4.0], [9.0, 9.0]]])
+    attention_mask = np.array([[1, 1, 0]])
+
+    assert mean_pool(hidden_states, attention_mask).tolist() == [[2.0, 3.0]]
+
+
+def test_normalize():
+    vectors = normalize(np.array([[3.0, 4.0], [0.0, 0.0]]))
+
+    assert vectors.tolist() == [[0.6, 0.8], [0.0, 0.0]]
+
+
+def test_length_batches():
+    lengths = [5, 1, 4, 2, 3, 10]
+
+    batches = length_batches(lengths, max_batch_size=2, max_batch_tokens=8)
+
+    assert [batch.tolist() for batch in batches] == [[1, 3], [4, 2], [0], [5]]
+
+
+def test_embeddings_keep_the_order_of_the_texts(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(
+        local_embeddings,
+        "get_local_model",
+        lambda *args: (FakeTokenizer(), session),
+    )
+    embeddings = LocalEmbeddings(max_batch_size=2)
+    texts = ["aaaa aaaa", "a", "aa aaaa", "aaa aaa aaa"]
+
+    vectors = np.array(embeddings.embed_documents(texts))
+
+    expected = normalize(np.array([[4.0, 1.0], [1.0, 1.0], [3.0, 1.0], [3.0, 1.0]]))
+    assert np.allclose(vectors, expected)
+    assert session.batch_shapes == [(2, 2), (2, 3)]
+    assert np.allclose(embeddings.embed_query("aa aaaa"), expected[2])
@@ -1,11 +1,15 @@
+import fitz
 import pytest
 from io import BytesIO
 
+import knowledge_gpt.core.parsing as parsing
 from knowledge_gpt.core.parsing import (
     DocxFile,
     PdfFile,
     TxtFile,
+    get_file_id,
     read_file,
+    stream_file,
     strip_consecutive_newlines,
 )
 from pathlib import Path
@@ -161,3 +165,87 @@ def test_strip_consecutive_newlines():
     text = "\nHello\nWorld\n"
     expected = "\nHello\nWorld\n"
     assert strip_consecutive_newlines(text) == expected
+
+
+def test_pdf_file_parallel_extraction_matches_sequential(monkeypatch):
+    # Build a PDF with enough pages to be split over several workers
+    pdf = fitz.open()
+    for i in range(10):
+        page = pdf.new_page()
+        page.insert_text((72, 72), f"Page number {i + 1}")
+    pdf_bytes = pdf.tobytes()
+
+    monkeypatch.setattr(parsing, "MIN_PAGES_PER_WORKER", 1)
+
+    files = []
+    for num_workers in [1, 3]:
+        file = BytesIO(pdf_bytes)
+        file.name = "test_parallel.pdf"
+        files.append(PdfFile.from_bytes(file, num_workers=num_workers))
+
+    sequential, parallel = files
+    assert len(parallel.docs) == 10
+    assert parallel.id == sequential.id
+    assert [doc.page_content for doc in parallel.docs] == [
+        f"Page number {i + 1}" for i in range(10)
+    ]
+    assert [doc.metadata for doc in parallel.docs] == [
+        doc.metadata for doc in sequential.docs
+    ]
+
+
+def test_stream_file_yields_pages_lazily():
+    with open(SAMPLE_ROOT / "test_hello_multi.pdf", "rb") as f:
+        file = BytesIO(f.read())
+        file.name = "test_hello_multi.pdf"
+
+    streamed_file, pages = stream_file(file)
+    assert isinstance(streamed_file, PdfFile)
+    assert streamed_file.docs == []
+    assert streamed_file.id == read_file(file).id
+
+    first_page = next(pages)
+    assert first_page.page_content == "Hello World 1"
+    assert first_page.metadata["page"] == 1
+
+    assert [doc.page_content for doc in pages] == ["Hello World 2", "Hello World 3"]
+
+
+def test_file_derive():
+    document = Document(page_content="test content", metadata={"page": "1"})
+    file = FakeFile("test_file", "1234", {"author": "test"}, [document])
+
+    derived = file.derive(docs=file.docs[:1])
+
+    assert isinstance(derived, FakeFile)
+    assert derived.name == file.name
+    assert derived.id == file.id
+
+    # Documents are shared, not copied
+    assert derived.docs[0] is document
+
+    # Metadata is readable through the derived file but copy-on-write
+    assert derived.metadata["author"] == "test"
+    derived.metadata["author"] = "changed"
+    assert derived.metadata["author"] == "changed"
+    assert file.metadata["author"] == "test"
+
+
+def test_file_id_is_computed_once():
+    with open(SAMPLE_ROOT / "test_hello_multi.pdf", "rb") as f:
+        file = BytesIO(f.read())
+        file.name = "test_hello_multi.pdf"
+
+    file_id = get_file_id(file)
+    assert file.tell() == 0
+    assert file.content_id == file_id
+
+    # The contents are not hashed again
+    file.content_id = "memoized"
+    assert get_file_id(file) == "memoized"
+    assert read_file(file).id == "memoized"
+    assert file.tell() == 0
+
+    # Another upload of the same contents gets the same id
+    copy = BytesIO(file.getvalue())
+    assert get_file_id(copy) == file_id
@@ -1,12 +1,25 @@
+import pytest
 from langchain.docstore.document import Document
-from knowledge_gpt.core.qa import get_sources
+from knowledge_gpt.core.qa import (
+    DEFAULT_MAX_CONTEXT_TOKENS,
+    StreamingAnswer,
+    get_sources,
+    query_folder,
+    query_folder_batch,
+    stream_query_folder,
+)
 from knowledge_gpt.core.embedding import FolderIndex
 
-from typing import List
+import re
+import threading
+import time
+from typing import Any, List
 from .fake_file import FakeFile
 from knowledge_gpt.core.parsing import File
 
-from knowledge_gpt.core.debug import FakeVectorStore
+from knowledge_gpt.core.debug import FakeChatModel, FakeVectorStore
+from knowledge_gpt.core.chunking import get_encoding
+from knowledge_gpt.core.utils import get_context_budget, get_llm
 
 
 def test_getting_sources_from_answer():
@@ -40,3 +53,297 @@ def test_getting_sources_from_answer():
     assert sources[1].metadata["source"] == "2"
     assert sources[2].metadata["source"] == "3"
     assert sources[3].metadata["source"] == "4"
+
+
+def test_getting_sources_with_same_key_in_several_files():
+    """Test that a source key shared by several files is resolved against the
+    files of the documents given to the model."""
+    files: List[File] = [
+        FakeFile(
+            name="file1",
+            id="1",
+            docs=[Document(page_content="a", metadata={"source": "1-1"})],
+        ),
+        FakeFile(
+            name="file2",
+            id="2",
+            docs=[Document(page_content="b", metadata={"source": "1-1"})],
+        ),
+    ]
+    folder_index = FolderIndex(files=files, index=FakeVectorStore(texts=[]))
+
+    answer = "This is the answer. SOURCES: 1-1"
+
+    sources = get_sources(answer, folder_index)
+    assert [doc.page_content for doc in sources] == ["a", "b"]
+
+    relevant_docs = [
+        Document(page_content="b", metadata={"source": "1-1", "file_id": "2"})
+    ]
+    sources = get_sources(answer, folder_index, relevant_docs)
+    assert [doc.page_content for doc in sources] == ["b"]
+    assert folder_index.get_chunk("1", "1-1").page_content == "a"
+    assert folder_index.get_chunk("1", "1-2") is None
+
+
+def make_folder_index() -> FolderIndex:
+    return FolderIndex(
+        files=[
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[
+                    Document(page_content=str(i), metadata={"source": str(i)})
+                    for i in range(1, 5)
+                ],
+            )
+        ],
+        index=FakeVectorStore(texts=["1", "2", "3", "4"]),
+    )
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_streaming_answer(streaming):
+    """Test that the answer streams in without its sources."""
+    folder_index = make_folder_index()
+
+    streaming_answer = stream_query_folder(
+        "What is the answer?", folder_index, FakeChatModel(streaming=streaming)
+    )
+    chunks = list(streaming_answer)
+
+    if streaming:
+        assert chunks[0] == "The"
+        assert len(chunks) > 1
+    assert "".join(chunks) == "The answer is 42. "
+    assert streaming_answer.result.answer == "The answer is 42. "
+    assert [doc.page_content for doc in streaming_answer.result.sources] == [
+        "1",
+        "2",
+        "3",
+        "4",
+    ]
+
+
+def test_streaming_answer_matches_query_folder():
+    folder_index = make_folder_index()
+
+    expected = query_folder("What is the answer?", folder_index, FakeChatModel())
+    streamed = stream_query_folder(
+        "What is the answer?", folder_index, FakeChatModel(streaming=True)
+    ).result
+
+    assert streamed == expected
+
+
+def test_marker_split_across_tokens():
+    chunks = iter(["The answer", " is 42. SOU", "RCES", ": 1"])
+    streaming_answer = StreamingAnswer(chunks, lambda output: output)
+
+    assert "".join(streaming_answer) == "The answer is 42. "
+    assert streaming_answer.result == "The answer is 42. SOURCES: 1"
+
+
+def test_query_folder_searches_by_vector_by_default():
+    result = query_folder("3", make_folder_index(), get_llm("debug"), return_all=True)
+
+    # The debug store returns every chunk, each of them once
+    assert [doc.page_content for doc in result.sources] == ["1", "2", "3", "4"]
+
+
+class PromptRecordingChatModel(FakeChatModel):
+    """Records the prompts it is given"""
+
+    prompts: List[str] = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        self.prompts.append(messages[-1].content)
+        return "The answer. SOURCES: 1"
+
+
+def test_prompt_is_capped_at_max_context_tokens():
+    # Chunks of about 500 tokens, more than fit into the context window
+    texts = [f"chunk {i} " * 250 for i in range(10)]
+    folder_index = FolderIndex(
+        files=[
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[
+                    Document(page_content=text, metadata={"source": str(i)})
+                    for i, text in enumerate(texts)
+                ],
+            )
+        ],
+        index=FakeVectorStore(texts=texts),
+    )
+    encoding = get_encoding("gpt-3.5-turbo")
+
+    def prompt_tokens(**kwargs) -> int:
+        llm = PromptRecordingChatModel(prompts=[])
+        query_folder("What?", folder_index, llm, retrieval="vector", **kwargs)
+        return len(encoding.encode(llm.prompts[-1]))
+
+    assert 1000 < prompt_tokens() <= DEFAULT_MAX_CONTEXT_TOKENS
+    assert prompt_tokens(max_context_tokens=1000) <= 1000
+    assert 3000 < prompt_tokens(max_context_tokens=None) <= get_context_budget("debug")
+
+
+class EchoChatModel(FakeChatModel):
+    """Answers with the question it was asked"""
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        question = re.findall(r"QUESTION: (.*)", messages[-1].content)[-1]
+        return f"You asked {question}. SOURCES: 1"
+
+
+def test_query_folder_batch_keeps_the_order_of_the_queries():
+    folder_index = make_folder_index()
+    queries = [f"question {i}" for i in range(10)]
+
+    answers = query_folder_batch(
+        queries, folder_index, EchoChatModel(), max_concurrency=3
+    )
+
+    assert [answer.answer for answer in answers] == [
+        f"You asked {query}. " for query in queries
+    ]
+    assert [doc.page_content for doc in answers[0].sources] == ["1"]
+    assert answers[0] == query_folder("question 0", folder_index, EchoChatModel())
+
+
+def test_query_folder_batch_with_the_debug_model():
+    answers = query_folder_batch(
+        ["What is the answer?", "Why?", "What else?"],
+        make_folder_index(),
+        get_llm("debug"),
+        max_concurrency=3,
+    )
+
+    assert [answer.answer for answer in answers] == ["The answer is 42. "] * 3
+    assert all(len(answer.sources) == 4 for answer in answers)
+
+
+class MapReduceChatModel(FakeChatModel):
+    """Cites all the sources it is given, except in groups of irrelevant
+    chunks. The map calls wait for each other, so they must run at once."""
+
+    barrier: Any
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        prompt = messages[-1].content
+        sources = ", ".join(re.findall(r"^Source: (.*)$", prompt, re.MULTILINE))
+        if "RELEVANT INFORMATION:" not in prompt:
+            return f"The summary. SOURCES: {sources}"
+
+        self.barrier.wait(timeout=5)
+        if "irrelevant" in prompt:
+            return "SOURCES: "
+        return f"Extract. SOURCES: {sources}"
+
+
+def test_map_reduce_answer():
+    # Chunks of about 1000 tokens, two fit into the prompt of a map step
+    texts = ["relevant " * 1000] * 4 + ["irrelevant " * 1000] * 2
+    folder_index = FolderIndex(
+        files=[
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[
+                    Document(page_content=text, metadata={"source": f"{i}-1"})
+                    for i, text in enumerate(texts, 1)
+                ],
+            )
+        ],
+        index=FakeVectorStore(texts=texts),
+    )
+    llm = MapReduceChatModel(barrier=threading.Barrier(3))
+
+    result = query_folder(
+        "Summarize the document", folder_index, llm, chain_type="map_reduce"
+    )
+
+    assert result.answer == "The summary. "
+    assert [doc.metadata["source"] for doc in result.sources] == [
+        "1-1",
+        "2-1",
+        "3-1",
+        "4-1",
+    ]
+    with pytest.raises(NotImplementedError):
+        query_folder("Summarize", folder_index, llm, chain_type="refine")
+
+
+class ConcurrencyRecordingChatModel(FakeChatModel):
+    """Records the largest number of calls it was answering at once"""
+
+    active: int = 0
+    peak: int = 0
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        with self._lock:
+            self.active -= 1
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def test_map_reduce_batch_bounds_all_llm_calls():
+    # Three groups of two chunks of about 1000 tokens are mapped per question
+    texts = ["relevant " * 1000] * 6
+    folder_index = FolderIndex(
+        files=[
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[
+                    Document(page_content=text, metadata={"source": str(i)})
+                    for i, text in enumerate(texts, 1)
+                ],
+            )
+        ],
+        index=FakeVectorStore(texts=texts),
+    )
+    llm = ConcurrencyRecordingChatModel()
+
+    answers = query_folder_batch(
+        ["What?", "Why?", "How?", "When?"],
+        folder_index,
+        llm,
+        chain_type="map_reduce",
+        max_concurrency=2,
+    )
+
+    assert [answer.answer for answer in answers] == ["The answer is 42. "] * 4
+    assert llm.i == 4 * 4
+    assert llm.peak == 2
+
+
+def test_map_reduce_answer_with_the_debug_model():
+    # Two groups of two chunks of about 1000 tokens are mapped
+    texts = ["relevant " * 1000] * 4
+    folder_index = FolderIndex(
+        files=[
+            FakeFile(
+                name="file1",
+                id="1",
+                docs=[
+                    Document(page_content=text, metadata={"source": str(i)})
+                    for i, text in enumerate(texts, 1)
+                ],
+            )
+        ],
+        index=FakeVectorStore(texts=texts),
+    )
+    llm = get_llm("debug")
+
+    result = query_folder(
+        "Summarize the document", folder_index, llm, chain_type="map_reduce"
+    )
+
+    assert llm.i == 3
+    assert result.answer == "The answer is 42. "
+    assert [doc.metadata["source"] for doc in result.sources] == ["1", "2", "3", "4"]
@@ -1,8 +1,16 @@
-from knowledge_gpt.core.utils import pop_docs_upto_limit
+import pytest
+
+from knowledge_gpt.core.utils import (
+    get_context_budget,
+    group_docs,
+    pack_docs,
+    pop_docs_upto_limit,
+)
 from langchain.docstore.document import Document
 from knowledge_gpt.core.debug import FakeChatModel
 from langchain.chains.qa_with_sources.loading import _load_stuff_chain
 from knowledge_gpt.core.prompts import STUFF_PROMPT
+from knowledge_gpt.core.chunking import get_encoding
 
 
 def test_single_doc_popped():
@@ -39,3 +47,59 @@ def test_all_docs_popped():
     )
 
     assert len(filtered_docs) == 0
+
+
+def test_docs_packed_into_budget():
+    """Test that the most relevant documents that fit into the budget are kept."""
+
+    docs = [
+        Document(page_content="Hello " * 500, metadata={"source": str(i)})
+        for i in range(4)
+    ]
+    chain = _load_stuff_chain(llm=FakeChatModel(), prompt=STUFF_PROMPT)
+
+    assert pack_docs("test", chain, docs, max_tokens=1500) == docs[:2]
+    assert pack_docs("test", chain, docs, max_tokens=100_000) == docs
+    assert pack_docs("test", chain, docs, max_tokens=500) == []
+
+
+def test_docs_grouped_into_budget():
+    """Test that documents are split into groups that each fit into the budget."""
+
+    docs = [
+        Document(page_content="Hello " * 500, metadata={"source": str(i)})
+        for i in range(5)
+    ]
+    chain = _load_stuff_chain(llm=FakeChatModel(), prompt=STUFF_PROMPT)
+
+    assert group_docs("test", chain, docs, max_tokens=1500) == [
+        docs[:2],
+        docs[2:4],
+        docs[4:],
+    ]
+    assert group_docs("test", chain, docs, max_tokens=100_000) == [docs]
+    # Documents that don't fit on their own are not dropped
+    assert group_docs("test", chain, docs, max_tokens=500) == [[doc] for doc in docs]
+
+
+def test_packed_prompt_fits_budget():
+    """Test that the packed prompt is within a few tokens of its estimate."""
+
+    docs = [
+        Document(page_content=f"Chunk number {i}. " * 20, metadata={"source": str(i)})
+        for i in range(20)
+    ]
+    chain = _load_stuff_chain(llm=FakeChatModel(), prompt=STUFF_PROMPT)
+
+    packed = pack_docs("test", chain, docs, max_tokens=1500)
+    prompt = chain.llm_chain.prompt.format(**chain._get_inputs(packed, question="test"))
+
+    assert 0 < len(packed) < len(docs)
+    assert abs(len(get_encoding("gpt-3.5-turbo").encode(prompt)) - 1500) < 150
+
+
+def test_context_budget():
+    assert get_context_budget("gpt-4") < get_context_budget("gpt-4-32k")
+    assert get_context_budget("gpt-4-0613") == get_context_budget("gpt-4")
+    with pytest.raises(NotImplementedError):
+        get_context_budget("unknown")
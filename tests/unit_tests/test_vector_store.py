@@ -0,0 +1,248 @@
+import os
+import pickle
+import tracemalloc
+from typing import List
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from knowledge_gpt.core.chunk_store import ChunkStore
+from knowledge_gpt.core.debug import FakeEmbeddings
+from knowledge_gpt.core.vector_store import (
+    HNSWFAISS,
+    IVFPQFAISS,
+    ChunkFAISS,
+    FlatFAISS,
+    Float16FAISS,
+    Int8FAISS,
+    IVFFlatFAISS,
+    choose_index_type,
+    is_compressed,
+)
+
+
+def make_store() -> ChunkStore:
+    return ChunkStore.from_documents(
+        Document(page_content=str(i), metadata={"page": 1, "chunk": i + 1})
+        for i in range(5)
+    )
+
+
+def test_from_chunk_store_shares_chunks():
+    chunks = make_store()
+    vector_store = ChunkFAISS.from_documents(chunks, FakeEmbeddings())
+
+    assert vector_store.chunks is chunks
+    assert vector_store.index.ntotal == 5
+
+
+def test_add_slices_of_the_same_store():
+    chunks = make_store()
+    vector_store = ChunkFAISS.from_documents(chunks[:2], FakeEmbeddings())
+    vector_store.add_documents(chunks[2:])
+
+    assert vector_store.chunks is chunks
+    assert vector_store.index.ntotal == 5
+
+
+def test_search_returns_documents():
+    vector_store = ChunkFAISS.from_texts(
+        ["a", "b", "c"], FakeEmbeddings(), metadatas=[{"source": "x"}] * 3
+    )
+
+    docs = vector_store.similarity_search("query", k=2)
+
+    assert len(docs) == 2
+    assert all(isinstance(doc, Document) for doc in docs)
+    assert all(doc.metadata == {"source": "x"} for doc in docs)
+
+
+def test_search_empty_store():
+    assert ChunkFAISS(FakeEmbeddings()).similarity_search("query") == []
+
+
+def test_pickle_round_trip():
+    vector_store = ChunkFAISS.from_documents(make_store(), FakeEmbeddings())
+    copy = pickle.loads(pickle.dumps(vector_store))
+
+    assert copy.index.ntotal == 5
+    assert len(copy.chunks) == 5
+    assert len(copy.similarity_search("query", k=5)) == 5
+
+
+class RandomEmbeddings(Embeddings):
+    """Random but fixed vectors for the texts "0", "1", ..."""
+
+    def __init__(self, num_vectors: int, dim: int = 8):
+        self.vectors = np.random.default_rng(0).random((num_vectors, dim))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[int(text)].tolist()
+
+
+def make_large_store(num_chunks: int) -> ChunkStore:
+    return ChunkStore.from_documents(
+        Document(page_content=str(i), metadata={"page": 1, "chunk": i + 1})
+        for i in range(num_chunks)
+    )
+
+
+@pytest.mark.parametrize("vector_store_cls", [FlatFAISS, HNSWFAISS])
+def test_loaded_indexes_are_memory_mapped(tmp_path, vector_store_cls):
+    embeddings = RandomEmbeddings(2000)
+    vector_store = vector_store_cls.from_documents(make_large_store(2000), embeddings)
+    vector_store.save(str(tmp_path))
+
+    loaded = ChunkFAISS.load(str(tmp_path), embeddings, mmap=True)
+    index_file = str(tmp_path / "index.faiss")
+    if os.path.exists("/proc/self/maps"):
+        with open("/proc/self/maps") as f:
+            assert index_file in f.read()
+    assert loaded.similarity_search("42")[0].page_content == "42"
+
+    # Pickling copies the index without reading the mapped one into memory
+    copy = pickle.loads(pickle.dumps(loaded))
+    assert loaded._mmap_path == index_file
+    assert copy.similarity_search("42")[0].page_content == "42"
+
+    # The index is read into memory to be changed
+    loaded.delete(["42"])
+    loaded.add_documents(make_large_store(2)[:1])
+    assert loaded._mmap_path is None
+
+
+def test_choose_index_type():
+    assert choose_index_type(100) == "flat"
+    assert choose_index_type(100_000) == "hnsw"
+    assert choose_index_type(1_000_000) == "ivf_flat"
+
+
+def test_hnsw_is_rebuilt_without_deleted_rows():
+    vector_store = HNSWFAISS.from_documents(
+        make_large_store(2000), RandomEmbeddings(2000)
+    )
+
+    vector_store.delete([str(i) for i in range(400)])
+    assert vector_store.index.ntotal == 2000
+    assert "42" not in [
+        doc.page_content for doc in vector_store.similarity_search("42", k=10)
+    ]
+    assert len(vector_store.similarity_search("42", k=10)) == 10
+
+    # Past a quarter of deleted rows the graph is rebuilt without them
+    vector_store.delete([str(i) for i in range(400, 600)])
+    assert vector_store.index.ntotal == 1400
+    assert vector_store._deleted == set()
+    assert vector_store.similarity_search("1000")[0].page_content == "1000"
+
+
+def test_small_stores_stay_flat():
+    vector_store = IVFFlatFAISS.from_documents(make_store(), FakeEmbeddings())
+
+    assert vector_store.built_index_type == "flat"
+
+
+@pytest.mark.parametrize(
+    "vector_store_cls,index_type",
+    [(IVFFlatFAISS, "ivf_flat"), (HNSWFAISS, "hnsw"), (IVFPQFAISS, "ivf_pq")],
+)
+def test_approximate_indexes(tmp_path, vector_store_cls, index_type):
+    vector_store = vector_store_cls.from_documents(
+        make_large_store(2000), RandomEmbeddings(2000)
+    )
+    assert vector_store.built_index_type == index_type
+    assert vector_store.index.ntotal == 2000
+
+    # Querying with an indexed vector finds it
+    docs = vector_store.similarity_search("42", k=5)
+    if index_type != "ivf_pq":
+        assert docs[0].page_content == "42"
+    assert len(docs) == 5
+
+    vector_store.delete(["42"])
+    assert "42" not in [
+        doc.page_content for doc in vector_store.similarity_search("42")
+    ]
+
+    # Settings and deletions survive saving, and memory-mapped IVF indexes can
+    # still be changed
+    vector_store.set_search_params(nprobe=4, ef_search=32)
+    vector_store.save(str(tmp_path))
+    loaded = ChunkFAISS.load(str(tmp_path), RandomEmbeddings(2000), mmap=True)
+    assert loaded.built_index_type == index_type
+    assert (loaded.index_type, loaded.nprobe, loaded.ef_search) == (index_type, 4, 32)
+    assert "42" not in [doc.page_content for doc in loaded.similarity_search("42")]
+    loaded.delete(["43"])
+    assert "43" not in [doc.page_content for doc in loaded.similarity_search("43")]
+
+
+class Int8PCAFAISS(ChunkFAISS):
+    index_type = "hnsw"
+    precision = "int8"
+    dim = 4
+
+
+@pytest.mark.parametrize(
+    "vector_store_cls,num_chunks",
+    [(Float16FAISS, 100), (Int8FAISS, 100), (Int8FAISS, 2000), (Int8PCAFAISS, 2000)],
+)
+def test_compressed_indexes(tmp_path, vector_store_cls, num_chunks):
+    embeddings = RandomEmbeddings(num_chunks + 10)
+    chunks = make_large_store(num_chunks + 10)
+    vector_store = vector_store_cls.from_documents(chunks[:num_chunks], embeddings)
+    assert is_compressed(vector_store.index)
+
+    # Candidates are rescored with the full precision vectors
+    docs_and_scores = vector_store.similarity_search_with_score("42", k=5)
+    assert docs_and_scores[0] == (chunks[42].to_document(), 0.0)
+    if vector_store.dim is None:
+        exact = FlatFAISS.from_documents(chunks[:num_chunks], embeddings)
+        expected = exact.similarity_search_with_score("42", k=5)
+        assert [doc for doc, _ in docs_and_scores] == [doc for doc, _ in expected]
+        assert [score for _, score in docs_and_scores] == pytest.approx(
+            [score for _, score in expected]
+        )
+
+    # Searching many vectors at once finds the same rows
+    queries = np.array([embeddings.embed_query(str(i)) for i in (3, 42, 77)])
+    assert vector_store.search_rows_batch(queries, k=5) == [
+        vector_store.search_rows(query, k=5) for query in queries
+    ]
+
+    # The full precision vectors are memory-mapped after loading, and
+    # copied when more chunks are added
+    vector_store.save(str(tmp_path))
+    loaded = ChunkFAISS.load(str(tmp_path), embeddings, mmap=True)
+    assert loaded.precision == vector_store_cls.precision
+    assert isinstance(loaded.vectors, np.memmap)
+    loaded.add_documents(loaded.chunks[num_chunks:])
+    added = str(num_chunks + 5)
+    assert loaded.similarity_search(added)[0].page_content == added
+
+
+def test_rescoring_vectors_are_not_kept_in_memory():
+    embeddings = RandomEmbeddings(2001, dim=64)
+    chunks = make_large_store(2000)
+
+    tracemalloc.start()
+    try:
+        vector_store = Int8FAISS.from_documents(chunks, embeddings)
+        in_memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    # The full precision vectors are mapped from a temporary file, only the
+    # compressed index (which isn't traced) and the chunks take memory
+    assert isinstance(vector_store.vectors, np.memmap)
+    assert in_memory < 2000 * 64 * 4 / 2
+    assert vector_store.similarity_search("42")[0].page_content == "42"
+
+    copy = pickle.loads(pickle.dumps(vector_store))
+    copy.add_documents(make_large_store(2001)[2000:])
+    assert isinstance(copy.vectors, np.memmap)
+    assert copy.similarity_search("42")[0].page_content == "42"